@@ -171,5 +171,25 @@ class NoModuleConfig(object):
         return default
 
 
+# Functions to call in each HTTP listener process, after it has been
+# forked and after the extension modules are loaded. Use this for
+# resources which must not be shared between processes, like sockets
+# and database connections. It's needed if the modules are loaded in
+# the master process (the "PreloadModules" setting), and harmless if
+# they are not, so extension modules can use it either way:
+#
+#   @akara.register_post_fork
+#   def open_database():
+#       global db
+#       db = connect(akara.module_config().get("dsn"))
+#
+_post_fork_hooks = []
+
+def register_post_fork(func):
+    "Call func() in each new HTTP listener process. Returns func."
+    _post_fork_hooks.append(func)
+    return func
+
+
 from version import version_info
 __version__ = '.'.join(version_info)
@@ -151,7 +151,9 @@ class cache(object):
            to the service using urllib2.urlopen().  The result of this operation 
            mimics the file-like object returned by urlopen().   Reading from the file
            will return raw data.  Invoking the .info() method will return HTTP
-           metadata about the request."""
+           metadata about the request.  A service can return the file as
+           environ["wsgi.file_wrapper"](f) to send the data without reading
+           it into memory."""
 
         # Check to see if the cache has been initialized or not.  This has to be done here since
         # it is currently not possible to fully initialize the cache in __init__().
@@ -86,6 +86,158 @@ def status(args):
             print "PID is", pid, "and there is a process with that PID"
             # XXX try to connect to the server?
             print "Akara is running"
+            print_scoreboard(settings["scoreboard_file"])
+
+def print_scoreboard(scoreboard_file):
+    "Display the per-process information from the server's scoreboard"
+    import time
+    from akara import scoreboard
+
+    print "Scoreboard file:", repr(scoreboard_file)
+    try:
+        board = scoreboard.Scoreboard.open(scoreboard_file)
+    except (IOError, scoreboard.Error), err:
+        print "*** Cannot read the scoreboard:", err
+        return
+    try:
+        now = time.time()
+        slots = board.slots()
+        scaling = board.scaling()
+    finally:
+        board.close()
+
+    if scaling["enabled"]:
+        print ("Predictive scaling: %.2f requests/s (%.2f long term), %.3fs/request, "
+               "backlog %d" % (scaling["arrival_rate"], scaling["arrival_rate_slow"],
+                               scaling["service_time"], scaling["backlog"]))
+        print ("  target %d-%d servers, %d started, %d stopped" %
+               (scaling["target"], scaling["high_target"],
+                scaling["spawned"], scaling["stopped"]))
+
+    counts = {}
+    for slot in slots:
+        counts[slot["state_name"]] = counts.get(slot["state_name"], 0) + 1
+    print "Server processes: %d (%s)" % (
+        len(slots), ", ".join("%d %s" % (n, name) for (name, n) in sorted(counts.items())))
+    if not slots:
+        return
+    print " %4s %7s %-10s %9s %12s %9s  %s" % (
+        "Slot", "PID", "State", "Requests", "Bytes", "Seconds", "Request")
+    for slot in slots:
+        if slot["request_start"]:
+            seconds = slot["request_time"] or (now - slot["request_start"])
+            seconds = "%.3f" % (seconds,)
+            request = "%s /%s (%s)" % (slot["method"], slot["mount_point"], slot["client"])
+        else:
+            seconds = "-"
+            request = "-"
+        print " %4d %7d %-10s %9d %12d %9s  %s" % (
+            slot["slot"], slot["pid"], slot["state_name"],
+            slot["requests"], slot["bytes"], seconds, request)
+
+
+def server_stats(args):
+    "Display the per-mount-point request statistics"
+    from akara import stats
+    try:
+        settings, config = read_config.read_config(args.config_filename)
+    except read_config.Error, err:
+        raise SystemExit(str(err))
+    try:
+        table = stats.Stats.open(settings["stats_file"])
+    except (IOError, stats.Error), err:
+        raise SystemExit("Cannot read the statistics: %s" % (err,))
+    try:
+        report = table.report()
+    finally:
+        table.close()
+
+    if args.format == "json":
+        from amara.thirdparty import json
+        print json.dumps(stats.json_document(report), indent=2)
+        return
+    if args.format == "prometheus":
+        sys.stdout.write(stats.prometheus_text(report))
+        return
+
+    def ms(seconds):
+        if seconds is None:
+            return "-"
+        if seconds == float("inf"):
+            return "inf"
+        return "%.1f" % (seconds * 1000,)
+    print " %-32s %9s %7s %7s %7s %7s %12s %8s %8s %8s %8s" % (
+        "Mount point", "Requests", "2xx", "3xx", "4xx", "5xx", "Bytes",
+        "Mean ms", "p50", "p90", "p99")
+    for entry in report:
+        if not entry["requests"]:
+            continue
+        mean = entry["seconds"] / entry["requests"]
+        print " %-32s %9d %7d %7d %7d %7d %12d %8s %8s %8s %8s" % (
+            entry["mount_point"], entry["requests"],
+            entry["status"]["2xx"], entry["status"]["3xx"],
+            entry["status"]["4xx"], entry["status"]["5xx"],
+            entry["bytes"], ms(mean),
+            ms(stats.quantile(entry["buckets"], 0.5)),
+            ms(stats.quantile(entry["buckets"], 0.9)),
+            ms(stats.quantile(entry["buckets"], 0.99)))
+
+    cached = [entry for entry in report if entry["cache_hits"] or entry["cache_misses"]]
+    if cached:
+        print
+        print " %-32s %-40s %9s %9s" % ("Pipeline", "Cached stage", "Hits", "Misses")
+        for entry in cached:
+            print " %-32s %-40s %9d %9d" % (entry["mount_point"], entry["ident"],
+                                            entry["cache_hits"], entry["cache_misses"])
+
+
+def profile(args):
+    "Profile requests to a mount point, or get the results"
+    import time
+    from akara import profiling
+    try:
+        settings, config = read_config.read_config(args.config_filename)
+    except read_config.Error, err:
+        raise SystemExit(str(err))
+    profile_dir = settings["profile_dir"]
+
+    if args.header:
+        secret = settings["profile_secret"]
+        if not secret:
+            raise SystemExit("Set 'ProfileSecret' in the configuration file to use --header")
+        expires = int(time.time()) + profiling.HEADER_LIFETIME
+        print "X-Akara-Profile: %s" % (
+            profiling.signature(secret, args.mount_point, expires),)
+        return
+
+    if args.save:
+        data = profiling.merged_profile(profile_dir, args.mount_point)
+        if data is None:
+            raise SystemExit("No profile for %r in %r" % (args.mount_point, profile_dir))
+        f = open(args.save, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        print "Saved the profile for %r to %r" % (args.mount_point, args.save)
+        return
+
+    if args.count <= 0:
+        raise SystemExit("The number of requests must be positive")
+    try:
+        control = profiling.Control.open(os.path.join(profile_dir, profiling.CONTROL_FILE))
+    except (IOError, profiling.Error), err:
+        raise SystemExit("Cannot reach the profiler (is Akara running?): %s" % (err,))
+    try:
+        try:
+            run = control.request(args.mount_point, args.count)
+        except profiling.Error, err:
+            raise SystemExit(str(err))
+    finally:
+        control.close()
+    profiling.remove_old_runs(profile_dir, args.mount_point, run)
+    print "Profiling the next %d request(s) to %r" % (args.count, args.mount_point)
+    print "Get the results with: akara profile --save FILE %s" % (args.mount_point,)
 
 
 def setup_config_file():
@@ -142,31 +294,41 @@ def setup(args):
     print "    akara start"
 
 
-# This function is not multi-process safe. It's meant to be
-# called by hand during the development process
-def error_log_rotate(args):
+def _rotate_file(filename, what):
     import datetime
-    settings, config = read_config.read_config(args.config_filename)
-    error_log = settings["error_log"]
-
-    ext  = ""
     i = 0
     timestamp = datetime.datetime.now().isoformat().split(".")[0]
-    template = error_log + "." + timestamp
-    archived_error_log = template
-    while os.path.exists(archived_error_log):
+    template = filename + "." + timestamp
+    archived_filename = template
+    while os.path.exists(archived_filename):
         i += 1
-        archived_error_log = template + "_" + str(i)
+        archived_filename = template + "_" + str(i)
 
     try:
-        os.rename(error_log, archived_error_log)
+        os.rename(filename, archived_filename)
     except OSError, err:
-        if not os.path.exists(error_log):
-            print "No error log found at %r" % error_log
+        if not os.path.exists(filename):
+            print "No %s found at %r" % (what, filename)
         else:
             raise
     else:
-        print "Rotated log file from %r to %r" % (error_log, archived_error_log)
+        print "Rotated %s from %r to %r" % (what, filename, archived_filename)
+
+# Rename the log files then, if Akara is running, send it a SIGUSR2.
+# The log writer reopens the files and the records which were still
+# on their way end up in the new files.
+def log_rotate(args):
+    settings, config = read_config.read_config(args.config_filename)
+    _rotate_file(settings["error_log"], "log file")
+    _rotate_file(settings["access_log"], "access log file")
+
+    try:
+        pid = int(open(settings["pid_file"]).readline())
+        os.kill(pid, signal.SIGUSR2)
+    except (IOError, ValueError, OSError):
+        print "Akara is not running"
+    else:
+        print "Told Akara (PID %d) to reopen the log files" % (pid,)
     
 
 ######################################################################
@@ -209,6 +371,23 @@ parser_restart.set_defaults(func=restart)
 parser_status = subparsers.add_parser("status", help="display a status report")
 parser_status.set_defaults(func=status)
 
+parser_stats = subparsers.add_parser("stats",
+                                     help="display request counts and latencies for each mount point")
+parser_stats.add_argument("--format", choices=("table", "json", "prometheus"), default="table",
+                          help="output format (default: table)")
+parser_stats.set_defaults(func=server_stats)
+
+parser_profile = subparsers.add_parser("profile",
+                                       help="profile the next requests to a mount point")
+parser_profile.add_argument("mount_point", help="the mount point to profile")
+parser_profile.add_argument("count", nargs="?", type=int, default=100,
+                            help="how many requests to profile (default: 100)")
+parser_profile.add_argument("--save", metavar="FILE",
+                            help="instead, save the merged pstats profile to FILE")
+parser_profile.add_argument("--header", action="store_true",
+                            help="instead, print a signed X-Akara-Profile request header")
+parser_profile.set_defaults(func=profile)
+
 parser_setup = subparsers.add_parser("setup", help="set up directories and files for Akara")
 parser_setup.set_defaults(func=setup)
 
@@ -218,8 +397,8 @@ parser_setup.set_defaults(func=setup)
 # with the possibility (excepting non-orthagonality).
 
 parser_setup = subparsers.add_parser("rotate",
-                                     help="rotate out the current Akara error log")
-parser_setup.set_defaults(func=error_log_rotate)
+                                     help="rotate out the current Akara error and access logs")
+parser_setup.set_defaults(func=log_rotate)
 
 
 def main(argv):
@@ -0,0 +1,277 @@
+"""gzip and deflate Content-Encoding for Akara services
+
+Services opt in with the 'compress' parameter of simple_service,
+service and method_dispatcher, or by wrapping a WSGI application with
+compress(). The response is compressed if the client accepts gzip or
+deflate, the status is 200, the Content-Type is text, XML, JSON or
+JavaScript, and there isn't already a Content-Encoding. Every such
+response gets "Vary: Accept-Encoding", compressed or not.
+
+A list of strings is compressed all at once and gets a new
+Content-Length. Any other iterator is compressed as it is read and
+is sent without a Content-Length (the server uses chunked encoding).
+
+A file from wsgi.file_wrapper, such as a static file or a result from
+akara.caching, is compressed once. Each server process keeps the
+compressed bytes in a cache keyed on the file's inode, size and
+modification time, so the next request for an unchanged file reuses
+them.
+
+"""
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+from akara.thirdparty import httpserver
+
+__all__ = ("compress",)
+
+COMPRESSION_LEVEL = 6
+# Don't bother with responses smaller than this
+MIN_SIZE = 256
+# The cache of compressed files in each server process. Files which
+# compress to more than MAX_CACHED_SIZE are compressed each time.
+CACHE_SIZE = 16 * 1024 * 1024
+MAX_CACHED_SIZE = CACHE_SIZE // 4
+
+_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,  # gzip header and trailer
+    "deflate": zlib.MAX_WBITS,    # zlib header, as HTTP's "deflate" means
+    }
+
+_compressible_pat = re.compile(
+    r"^(text/|application/(json|javascript|x-javascript|xml|xhtml\+xml)\s*(;|$)"
+    r"|[^;]*\+(xml|json)\s*(;|$))", re.I)
+
+
+def choose_encoding(accept_encoding):
+    """Return "gzip", "deflate" or None for an Accept-Encoding header
+
+    gzip wins a tie. Codings with q=0 are refused.
+    """
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    for term in accept_encoding.split(","):
+        coding, _, params = term.partition(";")
+        coding = coding.strip().lower()
+        if coding == "x-gzip":
+            coding = "gzip"
+        q = 1.0
+        params = params.strip()
+        if params[:2].lower() == "q=":
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[coding] = q
+    best = None
+    best_q = 0.0
+    for coding in ("gzip", "deflate"):
+        q = qvalues.get(coding, qvalues.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def _compressor(encoding):
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, _WBITS[encoding])
+
+def compress_string(data, encoding):
+    "Compress 'data' with the 'gzip' or 'deflate' content-coding"
+    c = _compressor(encoding)
+    return c.compress(data) + c.flush()
+
+def _compress_iter(result, encoding):
+    c = _compressor(encoding)
+    try:
+        for chunk in result:
+            data = c.compress(chunk)
+            if data:
+                yield data
+        yield c.flush()
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+
+class _VariantCache(object):
+    "Compressed files, most recently used last"
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                key, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+_cache = _VariantCache(CACHE_SIZE)
+
+def _file_key(wrapper, encoding):
+    fd = wrapper.fileno()
+    if fd is None:
+        return None
+    st = os.fstat(fd)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+            wrapper.start_offset(), wrapper.size(), encoding)
+
+def _compress_file(wrapper, encoding):
+    # Returns the compressed file as a string, or None if it's not
+    # a regular file or it's too large to keep
+    key = _file_key(wrapper, encoding)
+    if key is None:
+        return None
+    data = _cache.get(key)
+    if data is None:
+        if key[-2] > CACHE_SIZE:
+            # Too large to read in just to find out
+            return None
+        data = compress_string("".join(wrapper), encoding)
+        if len(data) <= MAX_CACHED_SIZE:
+            _cache.put(key, data)
+    return data
+
+
+def _header(headers, name):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+def _is_compressible(status, headers):
+    if not status.startswith("200"):
+        return False
+    content_type = _header(headers, "Content-Type")
+    if content_type is None or not _compressible_pat.match(content_type):
+        return False
+    if _header(headers, "Content-Encoding") is not None:
+        return False
+    if "no-transform" in (_header(headers, "Cache-Control") or "").lower():
+        return False
+    return True
+
+def _add_vary(headers):
+    vary = _header(headers, "Vary")
+    if vary is None:
+        headers.append(("Vary", "Accept-Encoding"))
+    elif vary.strip() != "*" and "accept-encoding" not in vary.lower():
+        headers[:] = [(k, v) for (k, v) in headers if k.lower() != "vary"]
+        headers.append(("Vary", vary + ", Accept-Encoding"))
+
+def _encoded_headers(headers, encoding, content_length):
+    new_headers = []
+    for k, v in headers:
+        lk = k.lower()
+        if lk == "content-length":
+            continue
+        if lk == "etag" and v.endswith('"'):
+            # A different entity, so a different tag
+            v = v[:-1] + "-" + encoding + '"'
+        new_headers.append((k, v))
+    new_headers.append(("Content-Encoding", encoding))
+    if content_length is not None:
+        new_headers.append(("Content-Length", str(content_length)))
+    return new_headers
+
+
+class _Response(object):
+    # Holds on to the start_response() arguments until the
+    # application returns, then decides whether to compress
+    def __init__(self, start_response):
+        self._start_response = start_response
+        self._write = None
+        self.deferred = True
+        self.started = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if not self.deferred:
+            return self._start_response(status, headers, exc_info)
+        self.started = (status, list(headers), exc_info)
+        return self.write
+
+    def write(self, data):
+        # Not compressed. Send the headers as they are.
+        if self.deferred:
+            self.send(*self.started)
+        self._write(data)
+
+    def send(self, status, headers, exc_info=None):
+        self.deferred = False
+        self._write = self._start_response(status, headers, exc_info)
+
+
+def compress(app, min_size=MIN_SIZE):
+    """Wrap a WSGI application so its responses can be compressed
+
+    See the module documentation. Responses with a Content-Length less
+    than 'min_size' are not compressed.
+    """
+    def compress_app(environ, start_response):
+        encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+        response = _Response(start_response)
+        result = app(environ, response.start_response)
+        if not response.deferred:
+            # It used write()
+            return result
+        if response.started is None:
+            # It will call start_response() later, as it's iterated
+            response.deferred = False
+            return result
+        status, headers, exc_info = response.started
+        if not _is_compressible(status, headers):
+            response.send(status, headers, exc_info)
+            return result
+        _add_vary(headers)
+
+        content_length = _header(headers, "Content-Length")
+        if content_length is not None:
+            # send_headers() gives it as an int
+            content_length = str(content_length).strip()
+        if (encoding is None or
+            (content_length is not None and content_length.isdigit() and
+             int(content_length) < min_size)):
+            response.send(status, headers, exc_info)
+            return result
+
+        if isinstance(result, httpserver.FileWrapper):
+            data = _compress_file(result, encoding)
+            if data is not None:
+                if hasattr(result, "close"):
+                    result.close()
+                response.send(status, _encoded_headers(headers, encoding, len(data)),
+                              exc_info)
+                return [data]
+        elif isinstance(result, (list, tuple)):
+            body = "".join(result)
+            if len(body) < min_size:
+                response.send(status, headers, exc_info)
+                return [body]
+            data = compress_string(body, encoding)
+            response.send(status, _encoded_headers(headers, encoding, len(data)),
+                          exc_info)
+            return [data]
+
+        response.send(status, _encoded_headers(headers, encoding, None), exc_info)
+        return _compress_iter(result, encoding)
+
+    # The registry uses the docstring to describe the service
+    compress_app.__doc__ = getattr(app, "__doc__", None)
+    return compress_app
@@ -3,6 +3,7 @@
 They test functionality from the akara.services modules
 """
 import os
+import time
 
 from amara import tree, parse
 
@@ -11,6 +12,7 @@ from akara.services import *
 from akara.pipeline import *
 from akara.registry import register_template, register_services, get_internal_service_url
 from akara import request, response
+from akara.eventloop import http_request, Return, UpstreamError
 
 ## These are all errors in the simple_service definition.
 # They are caught in the server. Do them now because any
@@ -162,6 +164,21 @@ def test_iterator():
     yield "When the hurlyburly's done,\n"
     yield "When the battle's lost and won.\n"
 
+# A file from wsgi.file_wrapper, from part way in. The server
+# sends it with sendfile() if it can, and knows its length.
+@simple_service("GET", "http://example.com/test")
+def test_file_wrapper():
+    import tempfile
+    f = tempfile.TemporaryFile()
+    f.write("0123456789" * 10000)
+    f.flush()
+    return request.environ["wsgi.file_wrapper"](f, offset=5, length=50000)
+
+@simple_service("GET", "http://example.com/test", content_type="text/plain",
+                compress=True)
+def test_compress():
+    return "When shall we three meet again?\n" * 100
+
 
 # Basic args (repeats are not allowed)
 @simple_service("GET", "http://example.com/test_args", None, "text/plain")
@@ -354,6 +371,48 @@ def test_get_call_count():
     _call_count += 1
     return s
 
+### used in test_server.py:test_post_fork
+_post_fork_pids = []
+@akara.register_post_fork
+def _record_post_fork():
+    _post_fork_pids.append(os.getpid())
+
+@simple_service("GET", "http://example.com/post_fork")
+def test_post_fork():
+    return "%s %s" % (os.getpid(), " ".join(map(str, _post_fork_pids)))
+
+### used in test_server.py:test_concurrent_requests
+# Checks that akara.request/akara.response aren't shared between
+# requests handled at the same time (the ThreadsPerServer setting)
+@simple_service("GET", "http://example.com/per_request_state")
+def test_per_request_state(name, delay="0.2"):
+    response.add_header("X-Akara-Name", name)
+    time.sleep(float(delay))
+    return "%s %s" % (name, request.environ["QUERY_STRING"])
+
+### used in test_server.py:test_async_service*
+@async_service("GET", "http://example.com/test_async_fetch")
+def test_async_fetch(a="Andrew", b="Sara"):
+    "Fetch from two services at once, then from a third"
+    import akara.global_config
+    root = akara.global_config.internal_server_root
+    first, second = yield [http_request(root + "test_args?a=" + a),
+                           http_request(root + "test_args?a=" + b)]
+    third = yield http_request(root + "test_echo_simple_get?x=" + a)
+    response.add_header("X-Upstream-Status", str(third.status))
+    raise Return("%s|%s|%s" % (first.body, second.body, third.body))
+
+@async_service("GET", "http://example.com/test_async_error")
+def test_async_error(catch="0"):
+    try:
+        # Nothing should be listening on port 1
+        yield http_request("http://127.0.0.1:1/", timeout=5)
+    except UpstreamError:
+        if catch == "1":
+            raise Return("caught")
+        raise
+    raise Return("connected?")
+
 #### pipelines
 
 @simple_service("POST", "service:rot13")
@@ -44,7 +44,7 @@ FEED_ENVELOPE = module_config().warn("feed_envelope",
 
 #text/uri-list from RFC 2483
 SERVICE_ID = 'http://purl.org/akara/services/demo/atom.json'
-@simple_service('GET', SERVICE_ID, 'akara.atom.json', 'application/json')
+@simple_service('GET', SERVICE_ID, 'akara.atom.json', 'application/json', compress=True)
 def atom_json(url):
     '''
     Convert Atom syntax to Exhibit JSON
@@ -87,7 +87,7 @@ def aggregate_atom():
 # We love Atom, but for sake of practicality (and JSON fans), here is
 # a transform for general feeds
 SERVICE_ID = 'http://purl.org/akara/services/demo/webfeed.json'
-@simple_service('GET', SERVICE_ID, 'akara.webfeed.json', 'application/json')
+@simple_service('GET', SERVICE_ID, 'akara.webfeed.json', 'application/json', compress=True)
 def webfeed_json(url):
     """Convert an Atom feed to Exhibit JSON
     
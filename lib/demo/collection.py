@@ -65,7 +65,7 @@ import httplib
 from string import Template
 from gettext import gettext as _
 from contextlib import closing
-from wsgiref.util import shift_path_info, request_uri
+from wsgiref.util import shift_path_info, request_uri, FileWrapper
 
 from akara.util import multipart_post_handler, wsgibase, http_method_handler
 
@@ -120,11 +120,11 @@ def get_file(environ, start_response):
     print >> sys.stderr, 'Getting the file at: ', resource_fname
     try:
         f = open(resource_path, 'rb')
-        #FIXME: do it chunk by chunk
-        rbody = f.read()
+        size = os.fstat(f.fileno()).st_size
         #FIXME: work out content type mappings (perhaps by file extension)
-        start_response(status_response(httplib.OK), [("Content-Type", "text/plain")])
-        return rbody
+        start_response(status_response(httplib.OK), [("Content-Type", "text/plain"),
+                                                     ("Content-Length", str(size))])
+        return environ.get('wsgi.file_wrapper', FileWrapper)(f)
     except IOError:
         rbody = four_oh_four.substitute(fronturl=request_uri(environ), backurl=resource_fname)
         start_response(status_response(httplib.NOT_FOUND), [("Content-Type", "text/html")])
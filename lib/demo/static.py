@@ -7,6 +7,8 @@ class static:
     akara_module = "akara.demo.static"
     paths = {"images": "/path/to/image/directory",
              "~me": "/home/directory/public_files"}
+    # Optional: gzip text files for clients which accept it
+    compress = True
 
 '''
 
@@ -14,12 +16,16 @@ import os
 import stat
 import mimetypes
 from email.utils import formatdate
+from wsgiref.util import FileWrapper
 import warnings
 
-from akara import registry
+from akara import registry, compression
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/static'
 
+# Read files in blocks of this size when they can't be sent directly
+BLOCK_SIZE = 64 * 1024
+
 class MediaHandler(object):
 
     __name__ = 'MediaHandler'
@@ -58,18 +64,22 @@ class MediaHandler(object):
         # the Last-Modified header. It makes media files a bit speedier
         # because the files are only read off disk for the first request
         # (assuming the browser/client supports conditional GET).
-        mtime = formatdate(os.stat(filename).st_mtime, usegmt=True)
+        st = os.fstat(fp.fileno())
+        mtime = formatdate(st.st_mtime, usegmt=True)
         headers = [('Last-Modified', mtime)]
         if environ.get('HTTP_IF_MODIFIED_SINCE', None) == mtime:
             status = '304 Not Modified'
             output = ()
+            fp.close()
         else:
             status = '200 OK'
             mime_type = mimetypes.guess_type(filename)[0]
             if mime_type:
                 headers.append(('Content-Type', mime_type))
-            output = [fp.read()]
-            fp.close()
+            headers.append(('Content-Length', str(st.st_size)))
+            # Akara's server sends the file with sendfile(), when it can
+            file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+            output = file_wrapper(fp, BLOCK_SIZE)
         start_response(status, headers)
         return output
 
@@ -79,7 +89,10 @@ if not akara.module_config():
     akara.logger.warn("No configuration section found for %r" % (__name__,))
     
 paths = akara.module_config().get("paths", {})
+compress = akara.module_config().get("compress", False)
 
 for path, root in paths.items():
     handler = MediaHandler(root)
+    if compress:
+        handler = compression.compress(handler)
     registry.register_service(SERVICE_ID, path, handler)
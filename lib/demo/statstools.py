@@ -73,7 +73,7 @@ R_FILE_CMD = akara.module_config(__name__).get('r_command', 'r')
 POR_REQUIRED = _("The 'POR' POST parameter is mandatory.")
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/spss.json'
-@simple_service('POST', SERVICE_ID, 'spss.json', 'application/json')
+@simple_service('POST', SERVICE_ID, 'spss.json', 'application/json', compress=True)
 def spss2json(body, ctype, **params):
     '''
     Uses GNU R to convert SPSS to JSON
@@ -107,7 +107,7 @@ def bot_check(match_info):
 
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/wwwlog.json'
-@simple_service('POST', SERVICE_ID, 'akara.wwwlog.json', 'application/json')
+@simple_service('POST', SERVICE_ID, 'akara.wwwlog.json', 'application/json', compress=True)
 def wwwlog2json(body, ctype, maxrecords=None, nobots=False):
     '''
     Convert Apache log info to Exhibit JSON
@@ -0,0 +1,639 @@
+"""Non-blocking support for I/O-bound Akara services
+
+An @async_service handler (see akara.services) is a generator. When it
+needs something from another HTTP server it yields an HTTP request and
+gets the response back as the value of the yield:
+
+    from akara.services import async_service
+    from akara.eventloop import http_request, Return
+
+    @async_service("GET", "http://example.com/proxy")
+    def proxy(url):
+        response = yield http_request(url)
+        if response.status != 200:
+            raise Return("Upstream error %d" % response.status)
+        raise Return(response.body)
+
+Yield a list of requests to send them in parallel; the value is then
+the list of responses, in the same order. Python 2 generators can't
+"return" a value, so raise Return(value) instead.
+
+How the requests are made depends on the server worker (the "Worker"
+setting). With the default "sync" worker they are made one at a time,
+with httplib, while the handler waits. With the "event" worker each
+server process runs an EventLoop and many connections and upstream
+requests share it; a handler which is waiting on a response costs
+almost nothing.
+
+Everything in a handler between two yields runs inside the event loop
+and holds up every other request in that process, so don't do blocking
+I/O there. (Host name lookups for upstream requests are still done
+with the blocking getaddrinfo(), and "https" requests are made with
+httplib, blocking.)
+
+"""
+import errno
+import heapq
+import httplib
+import select
+import socket
+import sys
+import time
+import urlparse
+
+from akara import logger
+
+__all__ = ("http_request", "Return", "UpstreamError", "HTTPResponse")
+
+# Used when an http_request() has no timeout
+DEFAULT_TIMEOUT = 60.0
+
+class Return(Exception):
+    "Raise this in an @async_service generator to return a value"
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class UpstreamError(Exception):
+    "Raised into the handler when an http_request() could not be completed"
+    def __init__(self, url, message):
+        Exception.__init__(self, "%s: %s" % (url, message))
+        self.url = url
+        self.message = message
+
+
+class HTTPRequest(object):
+    "An upstream HTTP request. Use http_request() to make one."
+    def __init__(self, url, method, headers, body, timeout):
+        self.url = url
+        self.method = method
+        self.headers = headers
+        self.body = body
+        self.timeout = timeout
+
+def http_request(url, method="GET", headers=None, body=None, timeout=None):
+    """Describe an HTTP request for an @async_service handler to yield
+
+      url - an "http" or "https" URL
+      method - the HTTP method
+      headers - a list of (name, value) pairs, or a dictionary
+      body - the request body, as a string
+      timeout - give up (with an UpstreamError) after this many seconds
+    """
+    if headers is None:
+        headers = []
+    elif isinstance(headers, dict):
+        headers = headers.items()
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    return HTTPRequest(url, method, list(headers), body, timeout)
+
+
+class HTTPResponse(object):
+    "The response to an http_request()"
+    def __init__(self, status, reason, headers, body):
+        self.status = status      # an integer, like 200
+        self.reason = reason
+        self.headers = headers    # a list of (name, value) pairs
+        self.body = body
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def __repr__(self):
+        return "<HTTPResponse %d %s (%d bytes)>" % (self.status, self.reason, len(self.body))
+
+
+def _split_url(url):
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if scheme not in ("http", "https"):
+        raise UpstreamError(url, "only 'http' and 'https' URLs are supported")
+    if "@" in netloc:
+        raise UpstreamError(url, "user names and passwords in URLs are not supported")
+    if ":" in netloc:
+        host, port_s = netloc.rsplit(":", 1)
+        try:
+            port = int(port_s)
+        except ValueError:
+            raise UpstreamError(url, "bad port number %r" % (port_s,))
+    else:
+        host = netloc
+        port = {"http": 80, "https": 443}[scheme]
+    if not host:
+        raise UpstreamError(url, "missing host name")
+    selector = path or "/"
+    if query:
+        selector += "?" + query
+    return scheme, host, port, selector
+
+def _add_default_headers(request, host, port):
+    names = set(k.lower() for (k, v) in request.headers)
+    headers = list(request.headers)
+    if "host" not in names:
+        if port in (80, 443):
+            headers.append( ("Host", host) )
+        else:
+            headers.append( ("Host", "%s:%d" % (host, port)) )
+    if request.body is not None and "content-length" not in names:
+        headers.append( ("Content-Length", str(len(request.body))) )
+    return headers
+
+
+######  Blocking requests, for the "sync" worker
+
+def fetch_blocking(request):
+    "Make the HTTP request with httplib and return an HTTPResponse"
+    scheme, host, port, selector = _split_url(request.url)
+    if scheme == "https":
+        conn = httplib.HTTPSConnection(host, port, timeout=request.timeout)
+    else:
+        conn = httplib.HTTPConnection(host, port, timeout=request.timeout)
+    try:
+        try:
+            conn.putrequest(request.method, selector, skip_host=True,
+                            skip_accept_encoding=True)
+            for k, v in _add_default_headers(request, host, port):
+                conn.putheader(k, v)
+            conn.endheaders()
+            if request.body is not None:
+                conn.send(request.body)
+            response = conn.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException), err:
+            raise UpstreamError(request.url, str(err) or err.__class__.__name__)
+    finally:
+        conn.close()
+    return HTTPResponse(response.status, response.reason,
+                        response.getheaders(), body)
+
+def _check_yielded(value):
+    if isinstance(value, HTTPRequest):
+        return
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            if not isinstance(item, HTTPRequest):
+                break
+        else:
+            return
+    raise TypeError("An @async_service handler must yield an http_request() "
+                    "or a list of them, not %r" % (value,))
+
+def run_blocking(gen):
+    "Run an @async_service generator to the end, making each request in turn"
+    value = exc_info = None
+    while True:
+        try:
+            if exc_info is not None:
+                try:
+                    request = gen.throw(*exc_info)
+                finally:
+                    exc_info = None
+            else:
+                request = gen.send(value)
+        except Return, result:
+            return result.value
+        except StopIteration:
+            return None
+        value = None
+        try:
+            _check_yielded(request)
+            if isinstance(request, HTTPRequest):
+                value = fetch_blocking(request)
+            else:
+                value = [fetch_blocking(x) for x in request]
+        except (TypeError, UpstreamError):
+            exc_info = sys.exc_info()
+
+
+######  The event loop, for the "event" worker
+
+class _Timer(object):
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+    def __cmp__(self, other):
+        return cmp(self.when, other.when)
+    def cancel(self):
+        self.cancelled = True
+
+READ = 1
+WRITE = 2
+
+class _SelectPoller(object):
+    def __init__(self):
+        self._events = {}
+    def register(self, fd, events):
+        self._events[fd] = events
+    def modify(self, fd, events):
+        self._events[fd] = events
+    def unregister(self, fd):
+        del self._events[fd]
+    def poll(self, timeout):
+        r = [fd for (fd, events) in self._events.items() if events & READ]
+        w = [fd for (fd, events) in self._events.items() if events & WRITE]
+        try:
+            r, w, e = select.select(r, w, [], timeout)
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                return []
+            raise
+        result = [(fd, READ) for fd in r]
+        result.extend((fd, WRITE) for fd in w)
+        return result
+    def close(self):
+        pass
+
+class _EpollPoller(object):
+    def __init__(self):
+        self._epoll = select.epoll()
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+    def register(self, fd, events):
+        self._epoll.register(fd, self._mask(events))
+    def modify(self, fd, events):
+        self._epoll.modify(fd, self._mask(events))
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            items = self._epoll.poll(timeout)
+        except IOError, err:
+            if err.errno == errno.EINTR:
+                return []
+            raise
+        result = []
+        for fd, mask in items:
+            # Errors and hang-ups are seen by whoever reads or writes next
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                result.append( (fd, READ) )
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                result.append( (fd, WRITE) )
+        return result
+    def close(self):
+        self._epoll.close()
+
+if hasattr(select, "epoll"):
+    _DefaultPoller = _EpollPoller
+else:
+    _DefaultPoller = _SelectPoller
+
+
+class EventLoop(object):
+    """A single-threaded select/epoll loop with timers
+
+    Callbacks are called with no arguments. Register at most one
+    reader and one writer per file descriptor.
+    """
+    def __init__(self):
+        self._poller = _DefaultPoller()
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+
+    def _update(self, fd):
+        events = 0
+        if fd in self._readers:
+            events |= READ
+        if fd in self._writers:
+            events |= WRITE
+        return events
+
+    def _set(self, table, fd, callback):
+        had_events = self._update(fd)
+        table[fd] = callback
+        if had_events:
+            self._poller.modify(fd, self._update(fd))
+        else:
+            self._poller.register(fd, self._update(fd))
+
+    def _clear(self, table, fd):
+        if fd not in table:
+            return
+        del table[fd]
+        events = self._update(fd)
+        if events:
+            self._poller.modify(fd, events)
+        else:
+            self._poller.unregister(fd)
+
+    def add_reader(self, fd, callback):
+        self._set(self._readers, fd, callback)
+    def remove_reader(self, fd):
+        self._clear(self._readers, fd)
+    def add_writer(self, fd, callback):
+        self._set(self._writers, fd, callback)
+    def remove_writer(self, fd):
+        self._clear(self._writers, fd)
+
+    def call_later(self, delay, callback):
+        "Call callback() after 'delay' seconds. Returns an object with a cancel() method."
+        timer = _Timer(time.time() + delay, callback)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def run_once(self, timeout=None):
+        "Wait for and process one set of events, or until 'timeout' seconds"
+        timers = self._timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+        if timers:
+            delay = max(timers[0].when - time.time(), 0.0)
+            if timeout is None or delay < timeout:
+                timeout = delay
+
+        for fd, event in self._poller.poll(timeout):
+            if event == READ:
+                callback = self._readers.get(fd)
+            else:
+                callback = self._writers.get(fd)
+            # An earlier callback may have removed this one
+            if callback is not None:
+                self._run(callback)
+
+        now = time.time()
+        while timers and timers[0].when <= now:
+            timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                self._run(timer.callback)
+
+    def _run(self, callback):
+        try:
+            callback()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            logger.error("Uncaught exception in event loop callback %r" % (callback,),
+                         exc_info = True)
+
+    def close(self):
+        self._poller.close()
+
+
+class _Fetch(object):
+    """Make one HTTP request without blocking
+
+    Sends an HTTP/1.0 request, so the response body ends when the
+    server closes the connection and is never chunked.
+    """
+    def __init__(self, loop, request, callback):
+        self.loop = loop
+        self.request = request
+        self.callback = callback   # callback(response, exc_info)
+        self.sock = None
+        self._fd = None
+        self._timer = None
+        self._outgoing = ""
+        self._incoming = []
+
+    def start(self):
+        request = self.request
+        try:
+            scheme, host, port, selector = _split_url(request.url)
+            if scheme == "https":
+                # No non-blocking SSL here
+                self._done(fetch_blocking(request), None)
+                return
+            lines = ["%s %s HTTP/1.0" % (request.method, selector)]
+            for k, v in _add_default_headers(request, host, port):
+                lines.append("%s: %s" % (k, v))
+            self._outgoing = "\r\n".join(lines) + "\r\n\r\n" + (request.body or "")
+
+            family, socktype, proto, canonname, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.setblocking(0)
+            self._fd = self.sock.fileno()
+            err = self.sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(err, errno.errorcode.get(err, str(err)))
+        except (socket.error, UpstreamError), err:
+            self._fail(err)
+            return
+        self._timer = self.loop.call_later(request.timeout, self._timed_out)
+        self.loop.add_writer(self._fd, self._on_writable)
+
+    def _on_writable(self):
+        try:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, str(err)))
+            n = self.sock.send(self._outgoing)
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._fail(err)
+            return
+        self._outgoing = self._outgoing[n:]
+        if not self._outgoing:
+            self.loop.remove_writer(self._fd)
+            self.loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._fail(err)
+            return
+        if data:
+            self._incoming.append(data)
+            return
+        try:
+            response = _parse_response("".join(self._incoming), self.request.method)
+        except ValueError, err:
+            self._fail(err)
+            return
+        self._done(response, None)
+
+    def _timed_out(self):
+        self._timer = None
+        self._fail(socket.timeout("timed out"))
+
+    def _fail(self, err):
+        if not isinstance(err, UpstreamError):
+            err = UpstreamError(self.request.url, str(err) or err.__class__.__name__)
+        try:
+            raise err
+        except UpstreamError:
+            self._done(None, sys.exc_info())
+
+    def _done(self, response, exc_info):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.sock is not None:
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+            self.sock.close()
+            self.sock = None
+        callback, self.callback = self.callback, None
+        if callback is not None:
+            callback(response, exc_info)
+
+def _parse_response(data, method):
+    end = data.find("\r\n\r\n")
+    if end == -1:
+        raise ValueError("incomplete response headers")
+    lines = data[:end].split("\r\n")
+    body = data[end+4:]
+    try:
+        version, status, reason = (lines[0].split(None, 2) + [""])[:3]
+        status = int(status)
+    except ValueError:
+        raise ValueError("bad status line %r" % (lines[0],))
+    headers = []
+    for line in lines[1:]:
+        if line[:1] in (" ", "\t") and headers:
+            # Continuation line
+            k, v = headers[-1]
+            headers[-1] = (k, v + " " + line.strip())
+            continue
+        if ":" not in line:
+            raise ValueError("bad header line %r" % (line,))
+        k, v = line.split(":", 1)
+        headers.append( (k.strip(), v.strip()) )
+    response = HTTPResponse(status, reason.strip(), headers, body)
+    length = response.getheader("Content-Length")
+    if length is not None:
+        try:
+            length = int(length)
+        except ValueError:
+            raise ValueError("bad Content-Length %r" % (length,))
+        if method == "HEAD" or status in (204, 304):
+            response.body = ""
+        elif len(body) < length:
+            raise ValueError("connection closed after %d of %d bytes" % (len(body), length))
+        else:
+            response.body = body[:length]
+    return response
+
+
+class Task(object):
+    """An @async_service handler in progress, in the event worker
+
+    The service wrapper creates the Task with the handler's generator
+    and a 'finish' function which turns the handler's return value
+    into a WSGI response (and calls start_response). The server runs
+    it with start(). Functions added with add_callback() are called
+    in turn with (result, exc_info) and return a new (result, exc_info).
+
+    akara.request and akara.response are saved whenever the handler
+    yields and restored when it continues, since other requests use
+    them in the meanwhile.
+    """
+    def __init__(self, gen, finish):
+        self.gen = gen
+        self.finish = finish
+        self.callbacks = []
+        self.loop = None
+        self._done_callback = None
+        self._state = _save_request_state()
+
+    def add_callback(self, func):
+        self.callbacks.append(func)
+
+    def start(self, loop, done_callback):
+        "Run the handler in 'loop'. Calls done_callback(result, exc_info) at the end."
+        self.loop = loop
+        self._done_callback = done_callback
+        self._step(None, None)
+
+    def _step(self, value, exc_info):
+        _restore_request_state(self._state)
+        try:
+            try:
+                if exc_info is not None:
+                    request = self.gen.throw(*exc_info)
+                else:
+                    request = self.gen.send(value)
+            except Return, result:
+                self._finish(result.value, None)
+                return
+            except StopIteration:
+                self._finish(None, None)
+                return
+            except:
+                self._finish(None, sys.exc_info())
+                return
+        finally:
+            exc_info = None
+            self._state = _save_request_state()
+
+        try:
+            _check_yielded(request)
+        except TypeError:
+            self.loop.call_later(0, lambda exc_info=sys.exc_info(): self._step(None, exc_info))
+            return
+        if isinstance(request, HTTPRequest):
+            _Fetch(self.loop, request, self._resume).start()
+        else:
+            _FetchAll(self.loop, request, self._resume).start()
+
+    def _resume(self, response, exc_info):
+        self._step(response, exc_info)
+
+    def _finish(self, value, exc_info):
+        result = None
+        if exc_info is None:
+            try:
+                result = self.finish(value)
+            except:
+                exc_info = sys.exc_info()
+        for func in self.callbacks:
+            try:
+                result, exc_info = func(result, exc_info)
+            except:
+                result, exc_info = None, sys.exc_info()
+        done_callback, self._done_callback = self._done_callback, None
+        done_callback(result, exc_info)
+
+class _FetchAll(object):
+    "Make several requests at once; the result is the list of responses"
+    def __init__(self, loop, requests, callback):
+        self.loop = loop
+        self.requests = requests
+        self.callback = callback
+        self.responses = [None] * len(requests)
+        self.exc_info = None
+        self.remaining = len(requests)
+
+    def start(self):
+        if not self.requests:
+            self.loop.call_later(0, lambda: self.callback([], None))
+            return
+        for i, request in enumerate(self.requests):
+            _Fetch(self.loop, request,
+                   lambda response, exc_info, i=i: self._one_done(i, response, exc_info)).start()
+
+    def _one_done(self, i, response, exc_info):
+        self.responses[i] = response
+        if exc_info is not None and self.exc_info is None:
+            # Report the first failure, once everything is done
+            self.exc_info = exc_info
+        self.remaining -= 1
+        if not self.remaining:
+            self.callback(self.responses, self.exc_info)
+
+
+# akara.request and akara.response are per-thread, and every task in
+# the event loop runs in the same thread.
+def _save_request_state():
+    from akara import request, response
+    return (request.environ, response.code, response.headers)
+
+def _restore_request_state(state):
+    from akara import request, response
+    request.environ, response.code, response.headers = state
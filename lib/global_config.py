@@ -13,6 +13,15 @@ config_root            : Akara configuration root directory (e.g., ~/.local/lib/
 pid_file               : Location of the PID file
 error_log              : Filename of the Akara error log
 access_log             : Filename of the Akara access log
+log_flush_interval     : Max seconds the log writer holds on to a log record
+scoreboard_file        : Filename of the shared-memory server scoreboard
+stats_file             : Filename of the shared-memory request statistics
+trace_file             : Filename for the request traces (see akara.tracing)
+trace_sample_rate      : Fraction of the requests to trace
+trace_header           : Request header which asks for a trace (or None)
+profile_dir            : Directory for the request profiles (see akara.profiling)
+profile_mount_points   : Mount points where every request is profiled
+profile_secret         : Key for signed X-Akara-Profile headers (or None)
 module_dir             : Akara module directory
 module_cache           : Module cache directory
 log_level              : Logging level
@@ -20,6 +29,17 @@ max_servers            : Maximum number of servers
 min_spare_servers      : Min spare servers
 max_spare_servers      : Max spare servers
 max_requests_per_server: Max requests per server
+predictive_scaling     : Size the number of servers from the request rate (see akara.scaling)
+threads_per_server     : Concurrent connections per server, each in its own thread (0 for no threads)
+worker                 : How each server handles its connections, "sync" or "event"
+max_connections_per_server: Concurrent connections per server with the "event" worker
+pipeline_threads       : Threads per server for the branches of parallel pipeline stages
+keep_alive_timeout     : Seconds to wait for the next request on a persistent connection
+max_keep_alive_requests: Max requests per persistent connection (0 for no limit)
+output_buffer_size     : Bytes of response body to collect before sending them
+max_request_body_size  : Largest request body (Content-Length) a server accepts
+preload_modules        : Load the extension modules in the master process
+reuse_port             : Each server listens on its own SO_REUSEPORT socket
 
 The primary purpose of this module is to make configuration parameters
 available to various library modules that make up the Akara core. 
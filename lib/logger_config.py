@@ -139,3 +139,23 @@ def set_access_logfile(f):
     if _access_handler is not None:
         _access_logger.removeHandler(_access_handler)
     _access_handler = new_access_handler
+
+# The HTTP listener processes send their log records to the master's
+# log-writer process (see akara.logwriter) instead of writing the
+# files themselves
+def set_log_writer_handlers(error_handler, access_handler):
+    "Replace the error and access log file handlers"
+    global _current_handler, _access_handler
+    error_handler.setFormatter(_default_formatter)
+    _logger.addHandler(error_handler)
+    if _current_handler is not None:
+        _logger.removeHandler(_current_handler)
+        _current_handler.close()
+    _current_handler = error_handler
+
+    access_handler.setFormatter(_access_log_formatter)
+    _access_logger.addHandler(access_handler)
+    if _access_handler is not None:
+        _access_logger.removeHandler(_access_handler)
+        _access_handler.close()
+    _access_handler = access_handler
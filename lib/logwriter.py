@@ -0,0 +1,358 @@
+"""The log-writer process, which writes the error and access logs
+
+This is an internal module and should not be used by other libraries.
+
+Without it each HTTP listener process would open the log files itself
+and write (and flush) every record as it happens. Instead the master
+starts one log-writer process, and the listeners send their formatted
+records to it over a pipe. The writer collects them and writes each
+file in one go when it has LOG_BUFFER_SIZE bytes or when the oldest
+record is "LogFlushInterval" seconds old.
+
+Writes of up to PIPE_BUF bytes to a pipe are atomic, so the listeners
+can share one pipe without locking. Each write is one frame: a header
+with the record type, the sender's pid and thread, the frame's number
+in its record and the length, then up to MAX_FRAME_DATA bytes. A
+longer record (a traceback, say) is split over several frames, and the
+writer puts it back together using the pid and thread. (With
+ThreadsPerServer, the threads of one listener send at the same time.)
+If a listener gives up on a record partway, the writer drops what it
+has of it when the next record from that thread starts.
+
+The listeners never block on the writer for long. If the pipe is full
+a listener waits up to SEND_TIMEOUT seconds, then gives up on that
+record and reports the number it lost in the error log when the pipe
+has room again.
+
+The master also sends its instructions over the pipe: reopen the log
+files (after "akara rotate" or "akara restart") and exit. If the
+writer dies the master starts another one, which picks up where the
+pipe left off.
+
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import struct
+import thread
+import time
+
+from akara import logger
+
+# Write a log file once this much is waiting for it
+LOG_BUFFER_SIZE = 64 * 1024
+# Give up on a record if the pipe stays full this long
+SEND_TIMEOUT = 1.0
+# Ask for a larger pipe buffer than the default 64KB (Linux only)
+PIPE_SIZE = 1024 * 1024
+_F_SETPIPE_SZ = 1031
+
+# Record types. A frame for the start or middle of a long record uses
+# the upper-case letter.
+ERROR = "e"
+ACCESS = "a"
+_REOPEN = "o"
+_QUIT = "q"
+
+# type, pid, thread, frame number in the record, data length
+_FRAME_HEADER = struct.Struct("=ciqHH")
+PIPE_BUF = getattr(select, "PIPE_BUF", 512)
+MAX_FRAME_DATA = PIPE_BUF - _FRAME_HEADER.size
+
+
+def _frames(kind, data):
+    pid = os.getpid()
+    thread_id = thread.get_ident()
+    pack = _FRAME_HEADER.pack
+    last = len(data) - MAX_FRAME_DATA
+    start = 0
+    number = 0
+    while start < last:
+        yield (pack(kind.upper(), pid, thread_id, number, MAX_FRAME_DATA) +
+               data[start:start+MAX_FRAME_DATA])
+        start += MAX_FRAME_DATA
+        number += 1
+    chunk = data[start:]
+    yield pack(kind, pid, thread_id, number, len(chunk)) + chunk
+
+def _write_frame(fd, frame, timeout):
+    # The write end is non-blocking
+    deadline = None
+    while True:
+        try:
+            os.write(fd, frame)
+            return True
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno != errno.EAGAIN:
+                raise
+        now = time.time()
+        if deadline is None:
+            deadline = now + timeout
+        elif now >= deadline:
+            return False
+        try:
+            select.select([], [fd], [], deadline - now)
+        except select.error, err:
+            if err[0] != errno.EINTR:
+                raise
+
+
+class LogWriter(object):
+    "The master's handle on the log-writer process"
+    def __init__(self, error_log, access_log, flush_interval=1.0):
+        self.error_log = error_log
+        self.access_log = access_log
+        self.flush_interval = flush_interval
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL,
+                    fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            fcntl.fcntl(self.write_fd, _F_SETPIPE_SZ, PIPE_SIZE)
+        except IOError:
+            pass
+        self.pid = None
+
+    def start(self):
+        "Fork the writer process (in the master)"
+        # Open the files here so any problem is reported now
+        files = {ERROR: open(self.error_log, "a"),
+                 ACCESS: open(self.access_log, "a")}
+        master_pid = os.getpid()
+        pid = os.fork()
+        if pid:
+            self.pid = pid
+            for f in files.values():
+                f.close()
+            return
+        try:
+            try:
+                os.close(self.write_fd)
+                _Writer(self.read_fd, files, self.flush_interval, master_pid).run()
+            except:
+                logger.critical("Log writer failed", exc_info=True)
+        finally:
+            os._exit(0)
+
+    def check(self):
+        "Start a new writer if the old one died (in the master)"
+        # The master's main loop has already reaped it
+        try:
+            os.kill(self.pid, 0)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+            logger.error("The log writer (pid %d) exited. Starting a new one." %
+                         (self.pid,))
+            try:
+                self.start()
+            except (IOError, OSError), err:
+                # Try again next time around
+                logger.error("Cannot start the log writer: %s" % (err,))
+
+    def reopen(self, error_log, access_log, flush_interval=None):
+        "Tell the writer to (re)open the log files (in the master)"
+        self.error_log = error_log
+        self.access_log = access_log
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        message = "%s\0%s\0%r" % (error_log, access_log, self.flush_interval)
+        self._send_control(_REOPEN, message)
+
+    def stop(self, timeout=10):
+        "Tell the writer to finish up and wait for it (in the master)"
+        if self.pid is None:
+            return
+        self._send_control(_QUIT, "")
+        deadline = time.time() + timeout
+        while True:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno != errno.ECHILD:
+                    raise
+                break   # Already reaped
+            if pid or time.time() > deadline:
+                break
+            time.sleep(0.05)
+        self.pid = None
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def _send_control(self, kind, message):
+        for frame in _frames(kind, message):
+            if not _write_frame(self.write_fd, frame, SEND_TIMEOUT * 5):
+                logger.error("Could not send a message to the log writer")
+                return
+
+    def child_handlers(self):
+        """Return (error handler, access handler) for a listener process
+
+        Also closes the listener's copy of the pipe's read end.
+        """
+        os.close(self.read_fd)
+        return (LogWriterHandler(self.write_fd, ERROR),
+                LogWriterHandler(self.write_fd, ACCESS))
+
+
+class LogWriterHandler(logging.Handler):
+    "Send formatted records to the log writer"
+    def __init__(self, fd, kind):
+        logging.Handler.__init__(self)
+        self.fd = fd
+        self.kind = kind
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            data = self.format(record) + "\n"
+            if isinstance(data, unicode):
+                data = data.encode("utf-8")
+            if self.dropped and self._send(ERROR, self._dropped_message()):
+                self.dropped = 0
+            if not self._send(self.kind, data):
+                self.dropped += 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def _dropped_message(self):
+        return "%s akara[%d]: [WARNING] The log writer is behind. Lost %d %s log record(s)\n" % (
+            time.strftime("%b %d %H:%M:%S"), os.getpid(), self.dropped,
+            {ERROR: "error", ACCESS: "access"}[self.kind])
+
+    def _send(self, kind, data):
+        for frame in _frames(kind, data):
+            if not _write_frame(self.fd, frame, SEND_TIMEOUT):
+                return False
+        return True
+
+
+class _Writer(object):
+    # The main loop of the log-writer process
+    def __init__(self, fd, files, flush_interval, master_pid):
+        self.fd = fd
+        self.flush_interval = flush_interval
+        self.master_pid = master_pid
+        self.files = files
+        self.pending = {ERROR: [], ACCESS: []}
+        self.pending_size = 0
+        self.first_pending = None
+        self.partial = {}   # (pid, thread) -> chunks of a record in pieces
+        self.quit = False
+
+    def _open(self, error_log, access_log):
+        for kind, filename in ((ERROR, error_log), (ACCESS, access_log)):
+            try:
+                f = open(filename, "a")
+            except IOError, err:
+                # Keep writing to the old file
+                logger.error("Log writer cannot open %r: %s" % (filename, err))
+                continue
+            old = self.files.get(kind)
+            if old is not None:
+                old.close()
+            self.files[kind] = f
+
+    def run(self):
+        # Shutting down is up to the master, which sends _QUIT once
+        # the listeners are gone, so ignore the signals meant for it.
+        os.setpgid(0, 0)
+        for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        buf = ""
+        while not self.quit:
+            if self.first_pending is None:
+                timeout = 1.0
+            else:
+                timeout = max(self.first_pending + self.flush_interval - time.time(), 0)
+            try:
+                r, w, e = select.select([self.fd], [], [], timeout)
+            except select.error, err:
+                if err[0] != errno.EINTR:
+                    raise
+                r = []
+            if r:
+                data = os.read(self.fd, 256 * 1024)
+                if not data:
+                    break
+                buf = self._read_frames(buf + data)
+            if self.pending_size and (
+                self.pending_size >= LOG_BUFFER_SIZE or
+                time.time() >= self.first_pending + self.flush_interval):
+                self._flush()
+            if os.getppid() != self.master_pid:
+                # The master is gone
+                break
+        self._flush()
+        for f in self.files.values():
+            f.close()
+
+    def _read_frames(self, buf):
+        # Returns the left-over part of a frame
+        header_size = _FRAME_HEADER.size
+        unpack = _FRAME_HEADER.unpack_from
+        start = 0
+        end = len(buf)
+        while end - start >= header_size:
+            kind, pid, thread_id, number, length = unpack(buf, start)
+            if end - start < header_size + length:
+                break
+            start += header_size
+            data = buf[start:start+length]
+            start += length
+            key = (pid, thread_id)
+            # Whatever is left of a record the sender gave up on
+            chunks = self.partial.pop(key, None)
+            if number:
+                if chunks is None or len(chunks) != number:
+                    # The rest of a record whose start was lost
+                    continue
+                chunks.append(data)
+            else:
+                chunks = [data]
+            if kind.isupper():
+                self.partial[key] = chunks
+                continue
+            self._handle(kind, "".join(chunks))
+        return buf[start:]
+
+    def _handle(self, kind, data):
+        if kind in self.pending:
+            self.pending[kind].append(data)
+            self.pending_size += len(data)
+            if self.first_pending is None:
+                self.first_pending = time.time()
+        elif kind == _REOPEN:
+            self._flush()
+            error_log, access_log, flush_interval = data.split("\0")
+            self.flush_interval = float(flush_interval)
+            self._open(error_log, access_log)
+        elif kind == _QUIT:
+            self.quit = True
+
+    def _flush(self):
+        for kind, records in self.pending.items():
+            if not records:
+                continue
+            f = self.files.get(kind)
+            if f is not None:
+                try:
+                    f.write("".join(records))
+                    f.flush()
+                except IOError, err:
+                    logger.error("Log writer cannot write to %r: %s" % (f.name, err))
+            del records[:]
+        self.pending_size = 0
+        self.first_pending = None
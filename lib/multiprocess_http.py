@@ -18,8 +18,11 @@ number of processes down to a min. See the flup code for details.
 When an HTTP request comes in, the flup-based AkaraPreforkServer in
 the subprocess passes that off to and AkaraJob to handle the HTTP
 connection. AkaraJob is a small adapter to ask paste to handle the
-HTTP request. Paste knows how to convert the request into a WSGI
-request, and then call AkaraWSGIDispatcher.wsgi_application.
+HTTP requests on that connection. Paste knows how to convert each
+request into a WSGI request, and then call
+AkaraWSGIDispatcher.wsgi_application. An HTTP/1.1 connection may be
+kept open for more requests, subject to the KeepAliveTimeout and
+MaxKeepAliveRequests settings.
 
 AkaraWSGIDispatcher uses the registry to look up a WSGI handler for
 the requested mount-point (the /first/word/in/the/path) and call it,
@@ -33,8 +36,14 @@ each HTTP listener subprocesses, which is also when module resource
 registration occurs.
 
 """
-import datetime
+import calendar
+import errno
+import gc
 import os
+import re
+import select
+import signal
+import socket
 import string
 import sys
 import time
@@ -46,8 +55,17 @@ import logging
 from wsgiref.util import shift_path_info
 from wsgiref.simple_server import WSGIRequestHandler
 
-from akara import logger
+import akara
+from akara import logger, logger_config
+from akara import logwriter
 from akara import registry
+from akara import scoreboard
+from akara import stats
+from akara import tracing
+from akara import profiling
+from akara import pipeline
+from akara import scaling
+from akara import eventloop
 
 from akara.thirdparty import preforkserver, httpserver
 
@@ -83,19 +101,434 @@ access_logger = logging.getLogger("akara.access")
 # method that I can use to sneak in my exec before letting flup's
 # child mainloop run.
 
+# The cost of waiting is that every child re-imports everything, which
+# slows down spawning under a burst of load, and every child has its
+# own private copy of the modules. The "PreloadModules" setting trades
+# the isolation for speed and memory: the master imports the modules
+# once and the children share those pages copy-on-write. Functions
+# registered with akara.register_post_fork() run in each child either
+# way, after the modules are loaded.
+
+# The master also creates the shared-memory scoreboard (see
+# akara.scoreboard) and gives each child a slot in it. The slot is
+# picked before the fork so the child knows which one is its own.
+# With "PredictiveScaling" the master reads the request totals from
+# the scoreboard and lets an akara.scaling.Scaler decide how many
+# children to run, instead of flup's spare-server rule. Next to the
+# scoreboard is the per-mount-point request statistics table (see
+# akara.stats), where each child uses the region for its slot.
+
+# Flup's child handles one connection at a time. That's a lot of
+# processes when the services spend most of their time waiting on
+# other servers. With "ThreadsPerServer" set, the child instead hands
+# each connection to a bounded pool of threads (paste's ThreadPool)
+# and only tells the master it is busy when every thread is in use.
+# akara.request and akara.response are thread-local (see
+# akara.threadlocal) so the services don't step on each other.
+
+# The master also starts the log-writer process (see akara.logwriter).
+# The children send it their error and access log records instead of
+# writing to the files themselves. "akara rotate" renames the files and
+# sends the master a SIGUSR2, and the master tells the writer to reopen
+# them.
+
+# The "event" worker ("Worker = 'event'") goes further. Each child
+# runs a single akara.eventloop.EventLoop which reads requests and
+# writes responses for all of its connections without blocking. An
+# @async_service handler yields while it waits on other servers so
+# the loop can get on with everything else. See _EventWorker below.
+
+# A SIGHUP ("akara restart") rereads the configuration file. Most
+# settings, and the extension modules, only matter in the children,
+# so the master keeps listening and does a rolling restart: it spawns
+# a new generation of children with the new configuration and
+# retires the old children as the new ones report in. A retired child
+# finishes the request it's working on and then exits. If the new
+# configuration can't be read the old children keep running. A
+# change to a setting the master itself depends on (see
+# _RESTART_SETTINGS) still stops every child and starts over.
+
+# These can't change without a full restart
+_RESTART_SETTINGS = ("server_address", "scoreboard_file", "stats_file", "profile_dir",
+                     "max_servers", "preload_modules", "reuse_port")
+
+# Normally every child waits on the one listening socket, so each new
+# connection wakes up all of the idle children and all but one of
+# them get EAGAIN from accept(). With "ReusePort" the master only
+# binds the address, and each child listens on its own socket with
+# SO_REUSEPORT. The kernel picks the child for each connection, and
+# queues it there. When a child exits, whatever is in its queue would
+# be reset, so it handles those connections first.
+
 class AkaraPreforkServer(preforkserver.PreforkServer):
     def __init__(self, settings, config,
                  minSpare=1, maxSpare=5, maxChildren=50,
-                 maxRequests=0):
+                 maxRequests=0, reload_config=None):
         preforkserver.PreforkServer.__init__(self,
                                              minSpare=minSpare, maxSpare=maxSpare,
                                              maxChildren=maxChildren, maxRequests=maxRequests,
                                              jobClass=AkaraJob,
                                              jobArgs=(settings, config))
+        # Called on SIGHUP to reread the configuration. It returns the
+        # new (settings, config) or raises an exception.
+        self.reload_config = reload_config
+        self._set_config(settings, config)
+        self.scoreboard = scoreboard.Scoreboard.create(
+            settings["scoreboard_file"], self._maxChildren)
+        scoreboard.current = self.scoreboard
+        self.stats = stats.Stats.create(settings["stats_file"], self._maxChildren)
+        stats.current = self.stats
+        profile_dir = settings["profile_dir"]
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        self.profile_control = profiling.Control.create(
+            os.path.join(profile_dir, profiling.CONTROL_FILE))
+        profiling.control = self.profile_control
+        self._child_slot = None
+        self.scaler = None
+        self._update_scaler(settings)
+        self.preload_modules = settings.get("preload_modules", False)
+        self.reuse_port = settings.get("reuse_port", False)
+        self.log_writer = logwriter.LogWriter(settings["error_log"], settings["access_log"],
+                                              settings.get("log_flush_interval", 1.0))
+        self._reopen_logs_requested = False
+        if self.preload_modules:
+            logger.info("Preloading extension modules in the master process")
+            _init_modules(config)
+            # Clean up now rather than in each child, where the
+            # collector would touch (and so copy) the shared pages.
+            gc.collect()
+
+    def _set_config(self, settings, config):
+        # The per-child settings. New children get these.
+        self.settings = settings
         self.config = config
+        self._jobArgs = (settings, config)
+        # The registry's Last-Modified in the children. Each one
+        # registers its services at a different time.
+        self._config_time = time.time()
+        self.threads_per_server = settings.get("threads_per_server", 0)
+        self.worker = settings.get("worker", "sync")
+        self.max_connections_per_server = settings.get("max_connections_per_server", 1000)
+        tracing.configure(settings)
+        pipeline.configure(settings)
+
+    def _reload(self):
+        # Called in the master's main loop after a SIGHUP
+        if self.reload_config is None:
+            preforkserver.PreforkServer._reload(self)
+            return
+        logger.info("Rereading the configuration file")
+        try:
+            settings, config = self.reload_config()
+        except Exception, err:
+            logger.error("Cannot reload the configuration: %s\n"
+                         "The current servers will keep running." % (err,))
+            return
+        changed = [name for name in _RESTART_SETTINGS
+                   if settings.get(name) != self.settings.get(name)]
+        if changed:
+            logger.info("Changed setting(s) %s need a full restart" %
+                        (", ".join(changed),))
+            preforkserver.PreforkServer._reload(self)
+            return
+
+        self._set_config(settings, config)
+        # reload_config() reopened the master's own log files
+        self.log_writer.reopen(settings["error_log"], settings["access_log"],
+                               settings.get("log_flush_interval", 1.0))
+        self._minSpare = settings["min_spare_servers"]
+        self._maxSpare = max(settings["max_spare_servers"], self._minSpare)
+        self._maxRequests = settings["max_requests_per_server"]
+        self._update_scaler(settings)
+        if self.preload_modules:
+            # Picks up newly listed modules. Already loaded ones are
+            # not reloaded.
+            _init_modules(config)
+            gc.collect()
+        self._newGeneration()
+        logger.info("Replacing %d server(s) with ones using the new configuration" %
+                    (self._rollTarget,))
+
+    def _update_scaler(self, settings):
+        if not settings.get("predictive_scaling"):
+            self.scaler = None
+            self.scoreboard.set_scaling({})
+            return
+        if self.worker == "event":
+            capacity = self.max_connections_per_server
+        else:
+            capacity = self.threads_per_server or 1
+        if self.scaler is None:
+            self.scaler = scaling.Scaler(self._minSpare, self._maxSpare,
+                                         self._maxChildren, capacity)
+            self._next_scaling_update = 0.0
+        else:
+            # Keep the averages
+            self.scaler.set_limits(self._minSpare, self._maxSpare,
+                                   self._maxChildren, capacity)
+
+    def _pollTimeout(self, timeout):
+        if self.scaler is None:
+            return timeout
+        # Wake up in time for the next update
+        wait = max(self._next_scaling_update - time.time(), 0.0)
+        if timeout is None:
+            return wait
+        return min(timeout, wait)
+
+    def _reopen_logs(self):
+        # After a SIGUSR2
+        logger.info("Reopening the log files")
+        try:
+            logger_config.set_logfile(self.settings["error_log"])
+            logger_config.set_access_logfile(self.settings["access_log"])
+        except IOError, err:
+            logger.error("Cannot reopen the log files: %s" % (err,))
+        self.log_writer.reopen(self.settings["error_log"], self.settings["access_log"])
+
+    def _usr2Handler(self, signum, frame):
+        self._reopen_logs_requested = True
+
+    def _installSignalHandlers(self):
+        preforkserver.PreforkServer._installSignalHandlers(self)
+        self._oldSIGs.append((signal.SIGUSR2, signal.getsignal(signal.SIGUSR2)))
+        signal.signal(signal.SIGUSR2, self._usr2Handler)
+
+    def _adjustChildren(self, sock):
+        # Called once each time around the master's main loop
+        if self._reopen_logs_requested:
+            self._reopen_logs_requested = False
+            self._reopen_logs()
+        self.log_writer.check()
+
+        scaler = self.scaler
+        if scaler is None:
+            preforkserver.PreforkServer._adjustChildren(self, sock)
+            return
+        now = time.time()
+        if now >= self._next_scaling_update:
+            requests, busy_time = self.scoreboard.totals()
+            scaler.update(now, requests, busy_time)
+            self._next_scaling_update = now + scaling.INTERVAL
+
+        current = [pid for (pid, d) in self._children.items()
+                   if d['generation'] == self._generation]
+        idle = [pid for pid in current if self._children[pid]['avail']]
+        n = scaler.decide(now, len(current), len(idle), scaling.listen_backlog(sock))
+        if n > 0:
+            started = 0
+            while started < n and len(self._children) < self._maxChildren:
+                if not self._spawnChild(sock):
+                    break
+                started += 1
+            if started:
+                scaler.spawned += started
+                logger.debug("Started %d server(s): %.1f requests/s, %.3fs/request, "
+                             "backlog %d, target %d servers" %
+                             (started, scaler.arrival_rate, scaler.service_time,
+                              scaler.backlog, scaler.target))
+        elif n < 0:
+            idle.sort()
+            self._closeChild(idle[-1])
+            scaler.stopped += 1
+            logger.debug("Stopped an idle server: %d servers, keeping at most %d" %
+                         (len(current), scaler.high_target))
+        self.scoreboard.set_scaling(scaler.counters())
+
+    def run(self, sock):
+        master_pid = os.getpid()
+        self.log_writer.start()
+        try:
+            return preforkserver.PreforkServer.run(self, sock)
+        finally:
+            # Children also get here, via SystemExit, but they don't
+            # own the scoreboard or the log writer.
+            if os.getpid() == master_pid:
+                # The children are gone, so everything they logged is
+                # already in the pipe
+                self.log_writer.stop()
+                self.scoreboard.close()
+                self.stats.close()
+                self.profile_control.close()
+
+    def _spawnChild(self, sock):
+        self._child_slot = self.scoreboard.reserve_slot()
+        if self._child_slot is None:
+            # Shouldn't happen; there's a slot for every possible child
+            logger.error("No free scoreboard slot. Not spawning a new server.")
+            return False
+        if not preforkserver.PreforkServer._spawnChild(self, sock):
+            self.scoreboard.release_slot(self._child_slot)
+            return False
+        return True
+
+    def _childSpawned(self, pid):
+        self.scoreboard.assign_slot(self._child_slot, pid)
+
+    def _childExited(self, pid):
+        self.scoreboard.release_pid(pid)
+
     def _child(self, sock, parent):
-        _init_modules(self.config)
-        preforkserver.PreforkServer._child(self, sock, parent)
+        global _parent_socket
+        _parent_socket = parent
+        logger_config.set_log_writer_handlers(*self.log_writer.child_handlers())
+        shared = self.worker == "event" or bool(self.threads_per_server)
+        scoreboard.attach_child(self._child_slot, shared=shared)
+        stats.attach_child(self._child_slot, shared=shared)
+        profiling.attach_child(self.settings)
+        if not self.preload_modules:
+            _init_modules(self.config)
+        _run_post_fork_hooks()
+        registry.set_last_modified(self._config_time)
+        scoreboard.current_slot.idle()
+        if self.reuse_port:
+            sock = _reuse_port_listener(sock)
+        # Tell the master this child is ready. During a rolling
+        # restart that's when it retires one of the old children.
+        if not self._notifyParent(parent, '\xff'):
+            return
+        if self.worker == "event":
+            _EventWorker(self, sock, parent).run()
+        elif self.threads_per_server:
+            self._threaded_child(sock, parent)
+        else:
+            preforkserver.PreforkServer._child(self, sock, parent)
+        if self.reuse_port:
+            self._drain_listener(sock)
+
+    def _drain_listener(self, sock):
+        # Handle the connections still queued on this child's own
+        # listening socket, then close it
+        while True:
+            try:
+                client_sock, addr = sock.accept()
+            except socket.error:
+                break
+            preforkserver.setCloseOnExec(client_sock)
+            try:
+                self._jobClass(client_sock, addr, *self._jobArgs).run()
+            except:
+                logger.error("Uncaught exception handling connection from %r" % (addr,),
+                             exc_info = True)
+        sock.close()
+
+    def _threaded_child(self, sock, parent):
+        # Like PreforkServer._child but each connection is run in the
+        # thread pool. The child is "available" to the master as long
+        # as it has a free thread.
+        num_threads = self.threads_per_server
+        # No extra threads past the limit; this is what keeps the
+        # pool bounded. (Hung threads can only be killed if
+        # paste.util.killthread is installed.)
+        pool = httpserver.ThreadPool(num_threads, name="Akara server threads",
+                                     daemon=True, max_requests=0, spawn_if_under=0,
+                                     logger=logger)
+
+        # Each job sends a byte on this socket pair when it's done,
+        # which wakes up the select() below.
+        done_r, done_w = socket.socketpair()
+        preforkserver.setCloseOnExec(done_r)
+        preforkserver.setCloseOnExec(done_w)
+
+        def run_job(client_sock, addr):
+            try:
+                try:
+                    self._jobClass(client_sock, addr, *self._jobArgs).run()
+                except:
+                    logger.error("Uncaught exception handling connection from %r" % (addr,),
+                                 exc_info = True)
+            finally:
+                done_w.send("x")
+
+        active = 0
+        connection_count = 0
+        accepting = True
+        available = True
+        parent_gone = False
+        while accepting or active:
+            fds = [done_r]
+            if not parent_gone:
+                fds.append(parent)
+            if accepting and active < num_threads:
+                fds.append(sock)
+            try:
+                r, w, e = select.select(fds, [], [])
+            except select.error, err:
+                if err[0] == errno.EINTR:
+                    continue
+                raise
+
+            if done_r in r:
+                active -= len(done_r.recv(64))
+
+            if parent in r:
+                # The parent wants us to exit, or has died. Stop
+                # accepting and finish the connections we have.
+                parent_gone = True
+                accepting = False
+                continue
+
+            if sock in r:
+                try:
+                    client_sock, addr = sock.accept()
+                except socket.error, err:
+                    if err[0] == errno.EAGAIN:
+                        # Another child got it
+                        continue
+                    raise
+                preforkserver.setCloseOnExec(client_sock)
+                if not self._isClientAllowed(addr):
+                    client_sock.close()
+                    continue
+                active += 1
+                pool.add_task(lambda client_sock=client_sock, addr=addr:
+                                  run_job(client_sock, addr))
+
+                connection_count += 1
+                if self._maxRequests > 0 and connection_count >= self._maxRequests:
+                    # Finish what we have, then exit
+                    accepting = False
+
+            # Let the master know when we fill up or have room again
+            now_available = accepting and active < num_threads
+            if now_available != available and not parent_gone:
+                available = now_available
+                if not self._notifyParent(parent, available and '\xff' or '\x00'):
+                    parent_gone = True
+                    accepting = False
+
+        done_r.close()
+        done_w.close()
+
+
+def _reuse_port_listener(sock):
+    # Called in the child. 'sock' is the master's socket, which is
+    # bound but not listening.
+    listener = socket.socket(sock.family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind(sock.getsockname())
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(0)
+    preforkserver.setCloseOnExec(listener)
+    sock.close()
+    return listener
+
+# The socket to the master, in a child process. The master closes it
+# to tell the child to exit.
+_parent_socket = None
+
+def _is_retiring():
+    "Return True if this child has been told to exit"
+    if _parent_socket is None:
+        return False
+    try:
+        r, w, e = select.select([_parent_socket], [], [], 0)
+    except (select.error, socket.error):
+        return True
+    return bool(r)
 
 
 # Once the flup PreforkServer has a request, it starts up an AkaraJob.
@@ -115,23 +548,832 @@ class AkaraJob(object):
         self._sock.setblocking(1)
         logger.debug("Start request from address %r, local socket %r" %
                      (self._addr, self._sock.getsockname()))
+        scoreboard.current_slot.reading()
         handler = AkaraWSGIDispatcher(self.settings, self.config)
-        self.handler = AkaraWSGIHandler(self._sock, self._addr, handler)
+        try:
+            self.handler = AkaraWSGIHandler(self._sock, self._addr, handler)
+        finally:
+            scoreboard.current_slot.idle()
         logger.debug("End request from address %r, local socket %r" %
                      (self._addr, self._sock.getsockname()))
         self._sock.close()
 
 
 # Override a few of the default settings
+
+# AkaraWSGIHandler also implements persistent (keep-alive)
+# connections. BaseHTTPRequestHandler.handle() already loops over
+# handle_one_request() until close_connection is set, and since the
+# rfile is buffered, pipelined requests are read from the buffer. What
+# it doesn't do is limit how long an idle connection can tie up this
+# child, or how many requests it can make, and an unread request body
+# would be parsed as the start of the next request. Those are added
+# here, using the KeepAliveTimeout and MaxKeepAliveRequests settings.
+# A response without a Content-Length (say, from a service which
+# returns an iterator) is sent with chunked encoding to HTTP/1.1
+# clients, so it doesn't end the connection either.
+
+# Don't bother reading more than this much of an unread request body
+# just to keep the connection alive. Close the connection instead.
+MAX_KEEP_ALIVE_DRAIN = 64 * 1024
+
+# AkaraWSGIHandler.parse_request replaces BaseHTTPRequestHandler's,
+# which builds a mimetools.Message from the headers. That does a lot
+# of work per line, and wsgi_setup then makes another pass over the
+# headers to build the HTTP_* environ entries. Instead the header
+# lines are read from the (buffered) rfile and split in one pass,
+# which builds a _RequestHeaders and the HTTP_* entries together.
+
+# Refuse requests with a longer request line, or larger or more
+# headers, than these
+MAX_REQUEST_LINE = 64 * 1024
+MAX_REQUEST_HEADER_SIZE = 64 * 1024
+MAX_REQUEST_HEADERS = 100
+
+class _RequestHeaders(object):
+    """The request headers
+
+    Implements the parts of the mimetools.Message interface that
+    paste and BaseHTTPServer use. Names are case-insensitive. Like
+    mimetools.Message, get() returns the last value of a repeated
+    header and getheaders() returns all of them.
+    """
+    def __init__(self, fields):
+        # lower-case name -> list of values
+        self._fields = fields
+
+    def get(self, name, default=None):
+        values = self._fields.get(name.lower())
+        if not values:
+            return default
+        return values[-1]
+    getheader = get
+
+    def getheaders(self, name):
+        return list(self._fields.get(name.lower(), ()))
+
+    def __getitem__(self, name):
+        return self._fields[name.lower()][-1]
+
+    def __contains__(self, name):
+        return name.lower() in self._fields
+    has_key = __contains__
+
+    def keys(self):
+        return self._fields.keys()
+
+    def items(self):
+        return [(name, values[-1]) for (name, values) in self._fields.items()]
+
+class _HeaderError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+def _read_headers(rfile):
+    """Read the request headers, up to and including the blank line
+
+    Returns a _RequestHeaders and a dictionary of the HTTP_* environ
+    entries. Raises a _HeaderError if the headers are malformed or
+    too large.
+    """
+    fields = {}
+    environ = {}
+    values = None
+    size = 0
+    count = 0
+    while True:
+        line = rfile.readline(MAX_REQUEST_HEADER_SIZE - size + 1)
+        size += len(line)
+        if size > MAX_REQUEST_HEADER_SIZE:
+            raise _HeaderError(400, "Request headers too large")
+        if line in ("\r\n", "\n", ""):
+            break
+        if line[0] in " \t":
+            # A continuation of the previous header
+            if values is None:
+                raise _HeaderError(400, "Bad header continuation line")
+            values[-1] += " " + line.strip()
+            continue
+        name, colon, value = line.partition(":")
+        if not colon or not name or name != name.strip():
+            raise _HeaderError(400, "Bad header line (%r)" % (line.rstrip("\r\n"),))
+        count += 1
+        if count > MAX_REQUEST_HEADERS:
+            raise _HeaderError(400, "Too many request headers")
+        name = name.lower()
+        values = fields.get(name)
+        if values is None:
+            values = fields[name] = []
+        values.append(value.strip())
+
+    for name, values in fields.iteritems():
+        key = "HTTP_" + name.replace("-", "_").upper()
+        if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+            continue
+        environ[key] = ",".join(values)
+    return _RequestHeaders(fields), environ
+
+# BaseHTTPRequestHandler's wfile is unbuffered, so the status line,
+# each header and each piece of the body were separate send() calls,
+# and a small response went out as several TCP packets. Instead the
+# output goes through a _ResponseWriter. The headers are sent with
+# the first piece of the body, and after that the body is sent in
+# pieces of at least OutputBufferSize bytes. Whatever is left is sent
+# at the end of the response. (Python 2 has no sendmsg(), so the
+# buffer is joined into one string for sendall().)
+
+class _ResponseWriter(object):
+    closed = False
+    trace = None   # the current request's tracing.Trace, if any
+
+    def __init__(self, sock, buffer_size):
+        self._sock = sock
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_len = 0
+
+    def write(self, data):
+        if data:
+            self._buffer.append(data)
+            self._buffer_len += len(data)
+
+    def flush_if_full(self):
+        "Send the buffer if it has at least buffer_size bytes"
+        if self._buffer_len >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if len(self._buffer) == 1:
+            data = self._buffer[0]
+        else:
+            data = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_len = 0
+        if self.trace is None:
+            self._sock.sendall(data)
+        else:
+            with self.trace.span("socket write", bytes=len(data)):
+                self._sock.sendall(data)
+
+    def close(self):
+        # StreamRequestHandler.finish() flushes first
+        self.closed = True
+        self._buffer = []
+        self._buffer_len = 0
+
 class AkaraWSGIHandler(httpserver.WSGIHandler):
     sys_version = None  # Disable including the Python version number
     server_version = "Akara/2.0"  # Declare that we are an Akara server
     protocol_version = "HTTP/1.1" # Support (for the most part) HTTP/1.1 semantics
+    request_bytes = 0  # Body bytes sent for the current request
+    trace = None       # The current request's tracing.Trace, if any
+
+    def setup(self):
+        httpserver.WSGIHandler.setup(self)
+        self.request_count = 0
+        self.connection_start = time.time()
+        self.wfile = _ResponseWriter(self.connection, self.server.output_buffer_size)
+
+    def handle_one_request(self):
+        # Based on paste's WSGIHandler.handle_one_request
+        keep_alive_timeout = self.server.keep_alive_timeout
+        if self.request_count:
+            if _is_retiring():
+                # Don't keep an old server around (for example after
+                # a rolling restart) for the rest of the connection
+                self.close_connection = 1
+                return
+            # Wait for the next request on a persistent connection,
+            # but not forever. Include the headers in the timeout.
+            scoreboard.current_slot.keep_alive()
+            self.connection.settimeout(keep_alive_timeout)
+        try:
+            try:
+                self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+                if not self.raw_requestline:
+                    self.close_connection = 1
+                    return
+                request_start = time.time()
+                if not self.parse_request(): # An error code has been sent, just exit
+                    return
+            except socket.timeout:
+                logger.debug("Keep-alive connection from %r timed out after %d request(s)" %
+                             (self.client_address, self.request_count))
+                self.close_connection = 1
+                return
+        finally:
+            if self.request_count:
+                self.connection.settimeout(None)
+
+        self.request_count += 1
+        max_requests = self.server.max_keep_alive_requests
+        if (not keep_alive_timeout or
+            (max_requests and self.request_count >= max_requests)):
+            self.close_connection = 1
+
+        self._start_trace(request_start)
+        self.wfile.trace = self.trace
+        slot = scoreboard.current_slot
+        start = slot.begin_request(self.command, self.client_address[0])
+        try:
+            self.wsgi_execute()
+        finally:
+            slot.end_request(start)
+            self._record_stats(start)
+        # Send the rest of the response before waiting for the next request
+        try:
+            try:
+                self.wfile.flush()
+            except socket.error, exce:
+                self.wsgi_connection_drop(exce)
+                self.close_connection = 1
+                return
+        finally:
+            self._finish_trace()
+
+        if not self.close_connection:
+            self._drain_request_body()
+
+    def wsgi_write_chunk(self, chunk):
+        # The first call also writes the headers
+        httpserver.WSGIHandler.wsgi_write_chunk(self, chunk)
+        self.wfile.flush_if_full()
+        scoreboard.current_slot.add_bytes(len(chunk))
+        self.request_bytes += len(chunk)
+
+    def wsgi_sendfile(self, fd, offset, length):
+        if self.trace is None:
+            sent = httpserver.WSGIHandler.wsgi_sendfile(self, fd, offset, length)
+        else:
+            with self.trace.span("sendfile", bytes=length):
+                sent = httpserver.WSGIHandler.wsgi_sendfile(self, fd, offset, length)
+        scoreboard.current_slot.add_bytes(sent)
+        self.request_bytes += sent
+        return sent
+
+    def _start_trace(self, request_start):
+        # Called once the headers are parsed, which is when it's
+        # known whether to trace this request
+        self.trace = trace = tracing.start(self.headers, request_start)
+        if trace is None:
+            return
+        if self.request_count == 1:
+            # The time from accept() to the start of the request
+            trace.add("wait for request", self.connection_start, request_start)
+        trace.add("parse request", request_start, time.time())
+
+    def _finish_trace(self):
+        trace = self.trace
+        if trace is None:
+            return
+        self.trace = None
+        status = None
+        if self.wsgi_curr_headers:
+            status = self.wsgi_curr_headers[0]
+        trace.finish("%s %s" % (self.command, self.path), status=status,
+                     bytes=self.request_bytes)
+
+    def _record_stats(self, start):
+        # Add the finished request to the per-mount-point statistics.
+        # The dispatcher says which service it went to.
+        environ = getattr(self, "wsgi_environ", None)
+        if environ is None:
+            return
+        mount_point, ident = environ.get("akara.stats_key", (None, None))
+        status = 0
+        if self.wsgi_curr_headers:
+            try:
+                status = int(self.wsgi_curr_headers[0][:3])
+            except ValueError:
+                pass
+        stats.current_writer.record(mount_point, ident, status, self.request_bytes,
+                                    time.time() - start)
+
+    def parse_request(self):
+        # Based on BaseHTTPRequestHandler.parse_request. Sends an
+        # error response and returns False if the request is bad.
+        self.command = None
+        self.request_version = version = self.default_request_version
+        self.close_connection = 1
+        requestline = self.raw_requestline
+        if len(requestline) > MAX_REQUEST_LINE:
+            self.requestline = ""
+            self.send_error(414)
+            return False
+        requestline = requestline.rstrip("\r\n")
+        self.requestline = requestline
+        words = requestline.split()
+        if len(words) == 3:
+            command, path, version = words
+            if version[:5] != "HTTP/":
+                self.send_error(400, "Bad request version (%r)" % version)
+                return False
+            try:
+                major, minor = version[5:].split(".")
+                version_number = int(major), int(minor)
+            except ValueError:
+                self.send_error(400, "Bad request version (%r)" % version)
+                return False
+            if version_number >= (2, 0):
+                self.send_error(505, "Invalid HTTP Version (%s)" % version[5:])
+                return False
+            if version_number >= (1, 1):
+                self.close_connection = 0
+        elif len(words) == 2:
+            # HTTP/0.9 has no headers
+            command, path = words
+            if command != "GET":
+                self.send_error(400, "Bad HTTP/0.9 request type (%r)" % command)
+                return False
+            self.command, self.path, self.request_version = command, path, version
+            self.headers = _RequestHeaders({})
+            self._header_environ = {}
+            return True
+        elif not words:
+            return False
+        else:
+            self.send_error(400, "Bad request syntax (%r)" % requestline)
+            return False
+        self.command, self.path, self.request_version = command, path, version
+
+        try:
+            self.headers, self._header_environ = _read_headers(self.rfile)
+        except _HeaderError, err:
+            self.send_error(err.code, err.message)
+            return False
+
+        # A request body needs a Content-Length. Anything else could
+        # be read as the next request on the connection.
+        transfer_encoding = ",".join(self.headers.getheaders("Transfer-Encoding")).strip().lower()
+        if transfer_encoding not in ("", "identity"):
+            if "chunked" in transfer_encoding:
+                self.send_error(411, "Chunked request bodies are not supported")
+            else:
+                self.send_error(501, "Unsupported Transfer-Encoding (%r)" % transfer_encoding)
+            return False
+        content_lengths = set(self.headers.getheaders("Content-Length"))
+        if content_lengths:
+            content_length = content_lengths.pop()
+            if content_lengths or not content_length.isdigit():
+                self.send_error(400, "Bad Content-Length")
+                return False
+            if int(content_length) > self.server.max_request_body_size:
+                self.send_error(413)
+                return False
+
+        conntype = self.headers.get("Connection", "").lower()
+        if conntype == "close":
+            self.close_connection = 1
+        elif conntype == "keep-alive":
+            self.close_connection = 0
+        return True
+
+    def wsgi_header_environ(self):
+        return self._header_environ
+
+    def wsgi_setup(self, environ=None):
+        httpserver.WSGIHandler.wsgi_setup(self, environ)
+        self.request_bytes = 0
+        if self.trace is not None:
+            self.wsgi_environ["akara.trace"] = self.trace
+        # Services are free to replace environ["wsgi.input"].
+        # Keep the original so any unread body can be drained.
+        self._request_body = self.wsgi_environ["wsgi.input"]
+
+    def _drain_request_body(self):
+        # Whatever is left of this request's body comes before the
+        # next request on the connection. Skip it, or give up.
+        body = self._request_body
+        self._request_body = None
+        if not isinstance(body, httpserver.LimitedLengthFile):
+            # Probably an 'Expect: 100-continue' request. There's no
+            # telling how much of the body the client sent.
+            if self.headers.get("Content-Length", "0") not in ("", "0"):
+                self.close_connection = 1
+            return
+        remaining = body.length - body._consumed
+        if body.length < 0 or remaining > MAX_KEEP_ALIVE_DRAIN:
+            self.close_connection = 1
+            return
+        while remaining > 0:
+            data = body.read(min(remaining, 8192))
+            if not data:
+                self.close_connection = 1
+                return
+            remaining -= len(data)
 
     # Suppress access log reporting from BaseHTTPServer.py
     def log_request(self, code='-', size='-'):
         pass
 
+###### The event-driven worker
+
+# Give up on a connection which hasn't sent a complete request after
+# this many seconds. (Between requests, KeepAliveTimeout applies.)
+EVENT_REQUEST_TIMEOUT = 60
+
+_end_of_headers_pat = re.compile(r"\r?\n\r?\n")
+_content_length_pat = re.compile(r"^content-length:[ \t]*(\d+)[ \t]*\r?$", re.I | re.M)
+_expect_continue_pat = re.compile(r"^expect:[ \t]*100-continue[ \t]*\r?\n", re.I | re.M)
+_transfer_encoding_pat = re.compile(r"^transfer-encoding:(?![ \t]*identity[ \t]*\r?$)",
+                                    re.I | re.M)
+
+class _EventWorker(object):
+    """The main loop for a child with Worker = 'event'
+
+    Like PreforkServer._child, except that each connection is an
+    _EventConnection in this child's event loop. The child tells the
+    master it's busy only when it has MaxConnectionsPerServer
+    connections.
+    """
+    def __init__(self, server, sock, parent):
+        self.server = server
+        self.sock = sock
+        self.parent = parent
+        self.loop = eventloop.EventLoop()
+        settings, config = server._jobArgs
+        self.dispatcher = AkaraWSGIDispatcher(settings, config)
+        self.max_connections = server.max_connections_per_server
+        self.connections = set()
+        self.connection_count = 0
+        self.accepting = True
+        self.listening = False
+        self.available = True
+        self.parent_gone = False
+
+    def run(self):
+        self.loop.add_reader(self.parent.fileno(), self._on_parent)
+        self._update()
+        while self.accepting or self.connections:
+            self.loop.run_once()
+        self.loop.close()
+
+    def _on_parent(self):
+        # The parent wants us to exit, or has died. Finish the
+        # requests we have, without accepting new connections.
+        self.loop.remove_reader(self.parent.fileno())
+        self.parent_gone = True
+        self.accepting = False
+        for connection in list(self.connections):
+            connection.retire()
+        self._update()
+
+    def _on_accept(self):
+        try:
+            client_sock, addr = self.sock.accept()
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Another child got it
+                return
+            raise
+        preforkserver.setCloseOnExec(client_sock)
+        if not self.server._isClientAllowed(addr):
+            client_sock.close()
+            return
+        self.connections.add(_EventConnection(self, client_sock, addr))
+        self.connection_count += 1
+        max_requests = self.server._maxRequests
+        if max_requests > 0 and self.connection_count >= max_requests:
+            self.accepting = False
+        self._update()
+
+    def connection_closed(self, connection):
+        self.connections.discard(connection)
+        self._update()
+
+    def _update(self):
+        # Only listen for new connections when there's room for them,
+        # and let the master know when that changes.
+        listen = self.accepting and len(self.connections) < self.max_connections
+        if listen != self.listening:
+            self.listening = listen
+            if listen:
+                self.loop.add_reader(self.sock.fileno(), self._on_accept)
+            else:
+                self.loop.remove_reader(self.sock.fileno())
+        if listen != self.available and not self.parent_gone:
+            self.available = listen
+            if not self.server._notifyParent(self.parent, listen and '\xff' or '\x00'):
+                self.parent_gone = True
+                self.accepting = False
+                self._update()
+
+
+class _EventConnection(object):
+    """One client connection in the event worker
+
+    Reads until there's a complete request (headers and body), hands
+    it to an _EventWSGIHandler, and queues the response. Requests on
+    the same connection are handled one after the other.
+    """
+    def __init__(self, worker, sock, addr):
+        self.worker = worker
+        self.loop = worker.loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.closed = False
+        self.closing = False        # close once the output is sent
+        self.retiring = False       # close after the current request
+        self.request_count = 0
+        self._input = ""
+        self._output = []
+        self._sent_continue = False
+        self._timer = None
+        self._reading = False
+        self._writing = False
+        sock.setblocking(0)
+        scoreboard.current_slot.reading()
+        self._wait_for_request(EVENT_REQUEST_TIMEOUT)
+
+    ## Input
+
+    def _wait_for_request(self, timeout):
+        if not self._reading:
+            self.loop.add_reader(self.fd, self._on_readable)
+            self._reading = True
+        self._timer = self.loop.call_later(timeout, self._timed_out)
+        if self._input:
+            # A pipelined request
+            self._check_request()
+
+    def _stop_reading(self):
+        if self._reading:
+            self.loop.remove_reader(self.fd)
+            self._reading = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _timed_out(self):
+        self._timer = None
+        logger.debug("Connection from %r timed out after %d request(s)" %
+                     (self.addr, self.request_count))
+        self.close()
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self._input += data
+        self._check_request()
+
+    def _check_request(self):
+        data = self._input
+        m = _end_of_headers_pat.search(data)
+        if m is None:
+            if len(data) > MAX_REQUEST_HEADER_SIZE:
+                self.close()
+            return
+        headers = data[:m.end()]
+        m2 = _content_length_pat.search(headers)
+        if m2 is None:
+            content_length = 0
+        else:
+            content_length = int(m2.group(1))
+        if (content_length > self.worker.dispatcher.max_request_body_size or
+            _transfer_encoding_pat.search(headers)):
+            # parse_request() answers with an error and closes the
+            # connection, so don't wait for (or keep) the body
+            self._input = ""
+            self._stop_reading()
+            self._handle(headers)
+            return
+        request_length = len(headers) + content_length
+        if len(data) < request_length:
+            if not self._sent_continue and _expect_continue_pat.search(headers):
+                # Handle this here instead of in paste; it would only
+                # be able to send it once the whole body was read.
+                self._sent_continue = True
+                self.write("HTTP/1.1 100 Continue\r\n\r\n")
+                self._flush()
+            return
+        body = data[len(headers):request_length]
+        self._input = data[request_length:]
+        self._sent_continue = False
+        self._stop_reading()
+        self._handle(_expect_continue_pat.sub("", headers) + body)
+
+    def _handle(self, request_bytes):
+        self.request_count += 1
+        try:
+            handler = _EventWSGIHandler(self, request_bytes)
+        except:
+            logger.error("Uncaught exception handling request from %r" % (self.addr,),
+                         exc_info = True)
+            self.closing = True
+            self._flush()
+            return
+        if handler.task is not None:
+            handler.task.start(self.loop, handler.finish_task)
+        else:
+            self.request_done(handler)
+
+    def retire(self):
+        # Close once the current request (if any) is done
+        if self.request_count and self._reading and not self._input:
+            # Waiting for the next request on a persistent connection
+            self.close()
+        else:
+            self.retiring = True
+
+    def request_done(self, handler):
+        if self.closed:
+            return
+        if handler.close_connection or self.retiring:
+            self.closing = True
+        self._flush()
+        if not self.closing:
+            scoreboard.current_slot.keep_alive()
+            self._wait_for_request(self.worker.dispatcher.keep_alive_timeout)
+
+    ## Output
+
+    def write(self, data):
+        if not self.closed and data:
+            self._output.append(data)
+
+    def _flush(self):
+        if self._output:
+            data = "".join(self._output)
+            self._output = []
+            try:
+                n = self.sock.send(data)
+            except socket.error, err:
+                if err[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close()
+                    return
+                n = 0
+            if n < len(data):
+                self._output.append(data[n:])
+                if not self._writing:
+                    self.loop.add_writer(self.fd, self._flush)
+                    self._writing = True
+                return
+        if self._writing:
+            self.loop.remove_writer(self.fd)
+            self._writing = False
+        if self.closing:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._stop_reading()
+        if self._writing:
+            self.loop.remove_writer(self.fd)
+            self._writing = False
+        self._output = []
+        try:
+            self.sock.close()
+        finally:
+            scoreboard.current_slot.idle()
+            self.worker.connection_closed(self)
+
+
+class _RequestSocket(object):
+    # Stands in for the socket as far as the paste handler is
+    # concerned. It reads from the already-buffered request and
+    # writes to the connection's output buffer.
+    def __init__(self, connection, request_bytes):
+        self._connection = connection
+        self._request_bytes = request_bytes
+    def makefile(self, mode="r", bufsize=-1):
+        if "r" in mode:
+            return StringIO(self._request_bytes)
+        return _ConnectionWriter(self._connection)
+
+class _ConnectionWriter(object):
+    # The connection sends its whole output buffer at once, so this
+    # doesn't need a _ResponseWriter
+    closed = False
+    def __init__(self, connection):
+        self._connection = connection
+    def write(self, data):
+        self._connection.write(data)
+    def flush(self):
+        pass
+    def flush_if_full(self):
+        pass
+    def close(self):
+        # The handler closes this when it returns, which may be
+        # before an @async_service task has written the response
+        pass
+
+class _EventWSGIHandler(AkaraWSGIHandler):
+    "Handle one buffered request for an _EventConnection"
+    def __init__(self, connection, request_bytes):
+        self.event_connection = connection
+        self.task = None
+        AkaraWSGIHandler.__init__(self, _RequestSocket(connection, request_bytes),
+                                  connection.addr, connection.worker.dispatcher)
+
+    def setup(self):
+        # Keep the _ConnectionWriter from _RequestSocket.makefile()
+        httpserver.WSGIHandler.setup(self)
+        self.request_count = 0
+
+    def handle(self):
+        conn = self.event_connection
+        self.close_connection = 1
+        self.raw_requestline = self.rfile.readline()
+        request_start = time.time()
+        if not self.parse_request(): # An error code has been sent
+            return
+        max_requests = self.server.max_keep_alive_requests
+        if (not self.server.keep_alive_timeout or
+            (max_requests and conn.request_count >= max_requests)):
+            self.close_connection = 1
+
+        # The connection has already read the whole request, so there
+        # is no "wait for request" span
+        self.trace = tracing.start(self.headers, request_start)
+        if self.trace is not None:
+            self.trace.add("parse request", request_start, time.time())
+        self._request_start = scoreboard.current_slot.begin_request(
+            self.command, self.client_address[0])
+        try:
+            self.wsgi_execute({"akara.event_loop": conn.loop})
+        finally:
+            if self.task is None:
+                scoreboard.current_slot.end_request(self._request_start)
+                self._record_stats(self._request_start)
+                self._finish_trace()
+
+    def wsgi_execute(self, environ=None):
+        # paste's wsgi_execute, split so an @async_service task can
+        # write its response later
+        self.wsgi_setup(environ)
+        try:
+            result = self.server.wsgi_application(self.wsgi_environ,
+                                                  self.wsgi_start_response)
+        except:
+            self._send_internal_error()
+            raise
+        if isinstance(result, eventloop.Task):
+            self.task = result
+            return
+        self._write_result(result)
+
+    def _write_result(self, result):
+        try:
+            try:
+                for chunk in result:
+                    self.wsgi_write_chunk(chunk)
+                if not self.wsgi_headers_sent:
+                    self.wsgi_write_chunk('')
+                self.wsgi_write_end()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except:
+            self._send_internal_error()
+            raise
+
+    def _send_internal_error(self):
+        if not self.wsgi_headers_sent:
+            error_msg = "Internal Server Error\n"
+            self.wsgi_curr_headers = (
+                '500 Internal Server Error',
+                [('Content-type', 'text/plain'),
+                 ('Content-length', str(len(error_msg)))])
+            self.wsgi_write_chunk(error_msg)
+        else:
+            # Too late to tell the client; close the connection
+            self.close_connection = 1
+
+    def finish_task(self, result, exc_info):
+        # Called by the task when the @async_service is done
+        try:
+            try:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self._write_result(result)
+            except:
+                logger.error("Uncaught exception finishing request from %r" %
+                             (self.client_address,), exc_info = True)
+                self._send_internal_error()
+                self.close_connection = 1
+        finally:
+            exc_info = None
+            scoreboard.current_slot.end_request(self._request_start)
+            self._record_stats(self._request_start)
+            self._finish_trace()
+            self.event_connection.request_done(self)
+
+
 # This is the the top-level WSGI dispatcher between paste.httpserver
 # and Akara proper. It only understand how to get the first part of
 # the path (called the "mount_point") and get the associated handler
@@ -180,24 +1422,25 @@ ACCESS_LOG_MESSAGE = (
 # across the change of timezones and I didn't want to use the '%b'
 # time formatter because it is locale dependant.
 
-def timetuple_to_datetime(t):
-    return datetime.datetime(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
-
+# The string only changes once a second, so keep the last one
 _months = "XXX Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+_last_time = (None, None)
 def _get_time():
-    now = time.localtime()
-    utc_time = time.gmtime()
-
-    tz_seconds = (timetuple_to_datetime(now) - timetuple_to_datetime(utc_time)).seconds
-    # Round to the nearest minute
-    tz_minutes = (tz_seconds + 30)//60
-    tz_hour, tz_minute = divmod(tz_minutes, 60)
-
-    # I've got the timezone component. The rest is easy
-    return "%02d/%s/%d:%02d:%02d:%02d %+03d%02d" % (
-        now.tm_year, _months[now.tm_mon], now.tm_mday,
-        now.tm_hour, now.tm_min, now.tm_sec,
-        tz_hour, tz_minute)
+    global _last_time
+    now = int(time.time())
+    t, s = _last_time
+    if t == now:
+        return s
+    local = time.localtime(now)
+    tz_minutes = (calendar.timegm(local) - now) // 60
+    sign = "-" if tz_minutes < 0 else "+"
+    tz_hour, tz_minute = divmod(abs(tz_minutes), 60)
+    s = "%02d/%s/%d:%02d:%02d:%02d %s%02d%02d" % (
+        local.tm_mday, _months[local.tm_mon], local.tm_year,
+        local.tm_hour, local.tm_min, local.tm_sec,
+        sign, tz_hour, tz_minute)
+    _last_time = (now, s)
+    return s
 
 # Filter out empty fields, control characters, and space characters
 _illegal = ("".join(chr(i) for i in range(33)) +   # control characters up to space (=ASCII 32)
@@ -216,6 +1459,11 @@ def _clean(s):
 class AkaraWSGIDispatcher(object):
     def __init__(self, settings, config):
         self.server_address = settings["server_address"]
+        # Used by AkaraWSGIHandler, which sees this as its "server"
+        self.keep_alive_timeout = settings.get("keep_alive_timeout", 0)
+        self.max_keep_alive_requests = settings.get("max_keep_alive_requests", 0)
+        self.output_buffer_size = settings.get("output_buffer_size", 8192)
+        self.max_request_body_size = settings.get("max_request_body_size", 16*1024*1024)
 
     def wsgi_application(self, environ, start_response):
         # There's some sort of problem if the application
@@ -286,17 +1534,53 @@ class AkaraWSGIDispatcher(object):
             # This happens with very ill-formed queries
             # Like when you use httplib directly and forget the leading '/'.
             return _send_error(start_response, 400)
-        mount_point = shift_path_info(environ)
+        with tracing.span(environ, "registry lookup"):
+            route = registry.match(environ.get("PATH_INFO", "/"))
+        if route is None:
+            service = None
+            mount_point = shift_path_info(environ)
+        else:
+            # Move the path segments the service was registered
+            # under over to SCRIPT_NAME
+            service, num_segments, route_args = route
+            mount_point = service.path
+            for i in range(num_segments):
+                shift_path_info(environ)
+            if route_args:
+                environ["wsgiorg.routing_args"] = ((), route_args)
+        scoreboard.current_slot.set_mount_point(mount_point)
 
         # Call the handler, deal with any errors, do access logging
+        log_now = True
         try:
-            try:
-                service = registry.get_service(mount_point)
-            except KeyError:
+            if service is None:
                 # Not found. Report something semi-nice to the user
                 return _send_error(start_response_, 404)
+            # For the request statistics
+            environ["akara.stats_key"] = (mount_point, service.ident)
             try:
-                result = service.handler(environ, start_response_)
+                # An iterator result does its work as the server reads
+                # it, which shows up as "socket write" spans
+                with tracing.span(environ, "handler /" + mount_point, ident=service.ident):
+                    result = profiling.current.call(mount_point, service.handler,
+                                                    environ, start_response_)
+                if isinstance(result, eventloop.Task):
+                    # An @async_service under the event worker. It
+                    # hasn't run yet, so finish up when it's done.
+                    def finish_task(result, exc_info):
+                        try:
+                            if exc_info is not None:
+                                result = self._internal_error(
+                                    mount_point, service, start_response_, exc_info)
+                            elif is_head_request:
+                                result = []
+                            return result, None
+                        finally:
+                            exc_info = None
+                            self.save_to_access_log(environ, access_data)
+                    result.add_callback(finish_task)
+                    log_now = False
+                    return result
                 if is_head_request:
                     # successful HEAD requests MUST return an empty message-body
                     return []
@@ -304,15 +1588,19 @@ class AkaraWSGIDispatcher(object):
             except Exception, err:
                 exc_info = sys.exc_info()
                 try:
-                    f = StringIO()
-                    traceback.print_exc(file=f)
-                    logger.error("Uncaught exception from %r (%r)\n%s" %
-                                 (mount_point, service.ident, f.getvalue()))
-                    return _send_error(start_response_, 500, exc_info=exc_info)
+                    return self._internal_error(mount_point, service, start_response_, exc_info)
                 finally:
                     del exc_info
         finally:
-            self.save_to_access_log(environ, access_data)
+            if log_now:
+                self.save_to_access_log(environ, access_data)
+
+    def _internal_error(self, mount_point, service, start_response, exc_info):
+        f = StringIO()
+        traceback.print_exception(exc_info[0], exc_info[1], exc_info[2], file=f)
+        logger.error("Uncaught exception from %r (%r)\n%s" %
+                     (mount_point, service.ident, f.getvalue()))
+        return _send_error(start_response, 500, exc_info=exc_info)
 
 
             
@@ -340,7 +1628,8 @@ class AkaraWSGIDispatcher(object):
 # The master HTTP process uses this module to import the modules and
 # convert them into byte code with the correct globals(). It does not
 # exec the byte code. That's the job for the spawned-off HTTP listener
-# classes.
+# classes. (Unless "PreloadModules" is set, in which case the master
+# imports the modules once and each listener gets them through fork.)
 
 def _init_modules(config):
     try:
@@ -358,3 +1647,11 @@ def _init_modules(config):
 "Unable to initialize module %r - skipping rest of module" % (module_name,),
                          exc_info = True)
     
+
+def _run_post_fork_hooks():
+    # Called in each HTTP listener, after the modules are loaded
+    for func in akara._post_fork_hooks:
+        try:
+            func()
+        except:
+            logger.error("Error in post-fork function %r" % (func,), exc_info = True)
@@ -8,15 +8,51 @@ output from the last stage produces the HTTP response. All of the
 stages follow the WSGI specification. The pipeline knows how to
 convert the WSGI response into the successive WSGI query.
 
+A stage's output is read by the next stage as it is made, through a
+file-like wsgi.input which holds one chunk at a time. The output is
+only collected into a buffer first when the next stage needs to seek
+in its input (see seekable_input()), or when the stage did not give a
+Content-Length and the next stage may need CONTENT_LENGTH. Services
+made with simple_service and async_service read their input to the
+end and don't need it. A file sent with wsgi.file_wrapper becomes the
+next stage's input as it is. So does an Amara tree, for a stage which
+says it takes one (see tree_input()); it's only written out as XML
+where something reads it.
+
+A Parallel stage sends its input to several services at once and
+merges their outputs into one, for services which don't depend on
+each other.
+
+A Stage can have a StageCache, to skip calling its service when it
+gets the same input as before.
+
+A pipeline looks up its stages' services and works out the changes
+to each stage's environ on its first request, and again only after a
+service is registered (see Pipeline.compile).
+
 """
 
-__all__ = ["Pipeline", "Stage", "register_pipeline"]
+__all__ = ["Pipeline", "Stage", "Parallel", "StageCache", "register_pipeline",
+           "seekable_input", "tree_input"]
 
+import Queue
+import hashlib
+import re
+import threading
+import time
 import urllib
+from collections import OrderedDict
 from cStringIO import StringIO
+from xml.sax.saxutils import escape as xml_escape, quoteattr
+
+from amara.thirdparty import json
 
+from akara import compression
 from akara import logger
 from akara import registry
+from akara import stats
+from akara import tracing
+from akara.thirdparty import httpserver
 
 # Helper function to figure out which stage is the first and/or last stage
 #  [X] -> [ (1,1,X])
@@ -27,13 +63,226 @@ def _flag_position(data):
     last_flags = first_flags[::-1]
     return zip(range(len(data)), first_flags, last_flags, data)
 
-def _find_header(search_term, headers):
-    search_term = search_term.lower()
+def _content_headers(headers):
+    # Returns the Content-Type and Content-Length (or None) headers
+    content_type = content_length = None
     for (name, value) in headers:
-        if name.lower() == search_term:
-            return value
-    raise AssertionError("Could not find %r in the headers" % search_term)
+        name = name.lower()
+        if name == "content-type":
+            content_type = value
+        elif name == "content-length":
+            content_length = str(value).strip()
+    if content_type is None:
+        raise AssertionError("Could not find 'content-type' in the headers")
+    return content_type, content_length
+
+
+
+# How a stage's service takes the previous stage's output. A handler
+# can say with its "pipeline_input" attribute (see seekable_input()).
+STREAM = "stream"       # reads wsgi.input to the end; needs no CONTENT_LENGTH
+SEEKABLE = "seekable"   # needs seek() or tell(); always gets a buffered copy
+TREE = "tree"           # like STREAM, and takes an Amara tree (see tree_input())
+
+# Set in the environ of a stage whose next stage takes a tree, and of
+# the stage which gets it
+TREE_OUTPUT_KEY = "akara.pipeline_tree_output"
+TREE_INPUT_KEY = "akara.pipeline_tree"
+
+def seekable_input(handler):
+    """Mark a service handler as needing a seekable wsgi.input in a pipeline
+
+    Use it on the registered handler, outside of the service decorator:
+
+      @pipeline.seekable_input
+      @simple_service("POST", "http://example.com/needs_seek")
+      def needs_seek(body, ctype):
+          ...
+    """
+    handler.pipeline_input = SEEKABLE
+    return handler
+
+def tree_input(handler):
+    """Mark a service handler as taking an Amara tree in a pipeline
+
+    When the stage before it returns an Amara tree, the tree is passed
+    on as it is, instead of being written out as XML and parsed again.
+    A simple_service or async_service function then gets the tree
+    instead of the body bytes. It still gets bytes when called some
+    other way, or after a stage which returned something else:
+
+      @pipeline.tree_input
+      @simple_service("POST", "http://example.com/count_items")
+      def count_items(body, ctype):
+          if not isinstance(body, tree.entity):
+              body = amara.parse(body)
+          ...
+
+    The tree isn't copied, so the stage before must not change it
+    after it's returned. Other handlers find it in
+    environ[TREE_INPUT_KEY]; their wsgi.input is the XML, which is
+    only made if they read it.
+    """
+    handler.pipeline_input = TREE
+    return handler
+
+
+class TreeOutput(object):
+    """A stage's output which is an Amara tree, for a stage which takes one
+
+    Made by the service decorators when the environ has TREE_OUTPUT_KEY.
+    'serialize' is called to get the XML if anything reads the output.
+    """
+    def __init__(self, tree, serialize):
+        self.tree = tree
+        self._serialize = serialize
+    def __iter__(self):
+        yield self._serialize()
+
+
+class _StagePipe(object):
+    """The output of one pipeline stage as the wsgi.input of the next
+
+    Chunks are taken from the stage's result as they are read, so
+    only the current chunk is held in memory, and the next stage can
+    start before the previous one has finished. This is not seekable.
+    """
+    def __init__(self, result):
+        self._result = result
+        self._chunks = iter(result)
+        self._buffer = ""
+        self.closed = False
+
+    def _fill(self):
+        # Get the next non-empty chunk. Returns False at the end.
+        if self.closed:
+            return False
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += chunk
+                return True
+        self.close()
+        return False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer]
+            if not self.closed:
+                parts.extend(self._chunks)
+                self.close()
+            self._buffer = ""
+            return "".join(parts)
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while True:
+            i = self._buffer.find("\n")
+            if i >= 0:
+                end = i + 1
+                break
+            if 0 <= size <= len(self._buffer) or not self._fill():
+                end = len(self._buffer)
+                break
+        if size is not None and 0 <= size < end:
+            end = size
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end:]
+        return line
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # Part of the WSGI spec
+            if hasattr(self._result, "close"):
+                self._result.close()
+
+
+class _Started(object):
+    # A stage result whose first chunk has been read, to get the stage
+    # to call start_response()
+    def __init__(self, result):
+        self._result = result
+        self._chunks = iter(result)
+        self._first = []
+        for chunk in self._chunks:
+            self._first = [chunk]
+            break
+    def __iter__(self):
+        first, self._first = self._first, []
+        for chunk in first:
+            yield chunk
+        for chunk in self._chunks:
+            yield chunk
+    def close(self):
+        if hasattr(self._result, "close"):
+            self._result.close()
+
+class _ClosingResult(object):
+    # The last stage's result, which may still be reading from the
+    # earlier stages. Close them when the server closes this.
+    def __init__(self, result, pipes):
+        self._result = result
+        self._pipes = pipes
+    def __iter__(self):
+        return iter(self._result)
+    def close(self):
+        try:
+            if hasattr(self._result, "close"):
+                self._result.close()
+        finally:
+            for pipe in self._pipes:
+                pipe.close()
 
+def _finish(result, pipes):
+    # Return the pipeline's result, making sure the pipes get closed
+    if not pipes:
+        return result
+    if (isinstance(result, (list, tuple, basestring, httpserver.FileWrapper)) or
+        not hasattr(result, "__iter__")):
+        # It's done with its input (or it's an @async_service task,
+        # which read its input before it started)
+        for pipe in pipes:
+            pipe.close()
+        return result
+    return _ClosingResult(result, pipes)
+
+def _file_input(result):
+    # The file behind a wsgi.file_wrapper of the rest of a file, or None
+    if (isinstance(result, httpserver.FileWrapper) and result.offset is None and
+        result.length is None and result.fileno() is not None):
+        return result.filelike
+    return None
+
+
+class _Step(object):
+    # One stage of a compiled pipeline
+    __slots__ = ("index", "stage", "handler", "environ", "query_string",
+                 "next_input", "span_name")
+    def __init__(self, index, stage, handler, environ, query_string, span_name):
+        self.index = index
+        self.stage = stage
+        self.handler = handler
+        # What to change in the stage's copy of the environ
+        self.environ = environ
+        # For the first stage, added to the HTTP query string
+        self.query_string = query_string
+        # The next stage's "pipeline_input" (see seekable_input())
+        self.next_input = None
+        self.span_name = span_name
 
 class Pipeline(object):
     def __init__(self, ident, path, stages, doc):
@@ -43,16 +292,69 @@ class Pipeline(object):
         self.path = path
         self.stages = stages
         self.doc = doc
+        # (registry generation, list of _Steps or the missing ident)
+        self._plan = (None, None)
+
+    def compile(self):
+        """Look up the stages' services and work out what each stage gets
+
+        Returns a list of _Steps, or the ident of a service which
+        isn't registered. This is done again whenever a service is
+        registered, since it might replace one of the stages.
+        """
+        steps = []
+        for stage_index, is_first, is_last, stage in _flag_position(self.stages):
+            found = _find_handler(stage)
+            if found is None:
+                return stage.ident
+            handler, handler_path = found
+            # Construct the changes to the environ for each stage in
+            # the pipeline.
+            stage_environ = {}
+            if handler_path is not None:
+                stage_environ["SCRIPT_NAME"] = handler_path
+            #stage_environ["PATH_INFO"] = ... # I think  this is best left unchanged. XXX
+            query_string = None
+            if is_first:
+                # Augment the QUERY_STRING string with any pipeline-defined query string
+                # (You probably shouldn't be doing this. Remove this feature? XXX)
+                query_string = stage.query_string or None
+            else:
+                # The first stage gets the HTTP request method
+                # Everything else gets a POST.
+                stage_environ["REQUEST_METHOD"] = "POST"
+                # The other stages get nothing about the HTTP query string
+                # but may get a pipeline-defined query string
+                stage_environ["QUERY_STRING"] = stage.query_string or ""
+            steps.append(_Step(stage_index, stage, handler, stage_environ.items(),
+                               query_string, "stage " + stage.ident))
+        for step, next_step in zip(steps, steps[1:]):
+            step.next_input = getattr(next_step.handler, "pipeline_input", None)
+        return steps
+
+    def _get_plan(self):
+        generation = registry.generation()
+        plan_generation, steps = self._plan
+        if plan_generation != generation:
+            steps = self.compile()
+            self._plan = (generation, steps)
+        return steps
 
     def __call__(self, environ, start_response):
         # The WSGI entry point for the pipeline
         
         logger.debug("Started the %s (%s) pipeline", self.ident, self.path)
 
+        steps = self._get_plan()
+        if isinstance(steps, basestring):
+            logger.error("Pipeline %r(%r) could not find a %r service",
+                          self.ident, self.path, steps)
+            start_response("500 Internal server error", [("Content-Type", "text/plain")])
+            return ["Broken internal pipeline.\n"]
+
         # Help capture the response of a WSGI request,
         # so I can forward it as input to the next request.
         captured_response = [None, None, None]
-        captured_body_length = None
         def capture_start_response(status, headers, exc_info=None):
             if exc_info is None:
                 captured_response[:] = [status, headers, False]
@@ -61,102 +363,267 @@ class Pipeline(object):
                 # Forward this to the real start_response
                 return start_response(status, headers, exc_info)
 
-        num_stages = len(self.stages)
-        for stage_index, is_first, is_last, stage in _flag_position(self.stages):
-            service = registry.get_a_service_by_id(stage.ident)
-            if service is None:
-                logger.error("Pipeline %r(%r) could not find a %r service",
-                              self.ident, self.path, stage.ident)
-                start_response("500 Internal server error", [("Content-Type", "text/plain")])
-                return ["Broken internal pipeline.\n"]
+        # The _StagePipes between the stages, to close at the end
+        pipes = []
+        num_stages = len(steps)
+        last_step = steps[-1]
+        for step in steps:
+            stage = step.stage
 
             # Construct a new environ for each stage in the pipeline.
             # We have to make a new one since a stage is free to
             # do whatever it wants to the environ. (It does not have
             # free reign over all the contents of the environ.)
             stage_environ = environ.copy()
-            if not is_first:
-                # The first stage gets the HTTP request method
-                # Everything else gets a POST.
-                stage_environ["REQUEST_METHOD"] = "POST"
-            assert service.path is not None # Can some services/pipelines not be mounted?
-            stage_environ["SCRIPT_NAME"] = service.path
-            #stage_environ["PATH_INFO"] = ... # I think  this is best left unchanged. XXX
-
-            if is_first:
-                # Augment the QUERY_STRING string with any pipeline-defined query string
-                # (You probably shouldn't be doing this. Remove this feature? XXX)
-                if stage.query_string:
-                    if stage_environ["QUERY_STRING"]:
-                        stage_environ["QUERY_STRING"] += ("&" + stage.query_string)
-                    else:
-                        stage_environ["QUERY_STRING"] = stage.query_string
-            else:
-                # The other stages get nothing about the HTTP query string
-                # but may get a pipeline-defined query string
-                if stage.query_string:
-                    stage_environ["QUERY_STRING"] = stage.query_string
+            stage_environ.update(step.environ)
+            stage_environ.pop(TREE_INPUT_KEY, None)
+            # The values from the pipeline's own path aren't the stage's
+            stage_environ.pop("wsgiorg.routing_args", None)
+            if step is not last_step:
+                if step.next_input == TREE:
+                    stage_environ[TREE_OUTPUT_KEY] = True
                 else:
-                    stage_environ["QUERY_STRING"] = ""
+                    stage_environ.pop(TREE_OUTPUT_KEY, None)
+            if step.query_string is not None:
+                if stage_environ["QUERY_STRING"]:
+                    stage_environ["QUERY_STRING"] += ("&" + step.query_string)
+                else:
+                    stage_environ["QUERY_STRING"] = step.query_string
 
-            if not is_first:
+            if step.index:
                 # Forward information from the previous stage
-                stage_environ["CONTENT_TYPE"] = _find_header("content-type",
-                                                             captured_response[1])
+                stage_environ["CONTENT_TYPE"] = captured_content_type
                 stage_environ["CONTENT_LENGTH"] = captured_body_length
                 stage_environ["wsgi.input"] = captured_body
 
                 # Make the previous response headers available to the next stage
                 stage_environ["akara.pipeline_headers"] = captured_response[1]
+                if captured_tree is not None:
+                    stage_environ[TREE_INPUT_KEY] = captured_tree
 
             logger.debug("Pipeline %r(%r) at stage %r (%d/%d)",
-                         self.ident, self.path, stage.ident, stage_index+1, num_stages)
-            if is_last:
+                         self.ident, self.path, stage.ident, step.index+1, num_stages)
+            if step is last_step:
                 # End of the pipeline. Let someone else deal with the response
-                return service.handler(stage_environ, start_response)
-            else:
-                # Intermediate stage output. Collect to forward to the next stage
-                captured_body = StringIO()
-                result = service.handler(stage_environ, capture_start_response)
-
-                # Did start_response get an exc_info term? (It might not
-                # have been thrown when forwarded to the real start_response.)
-                if captured_response[2]:
-                    # It didn't raise an exception. Assume the response contains
-                    # the error message. Forward it and stop the pipeline.
-                    logger.debug(
-                        "Pipeline %r(%r) start_response received exc_info from stage %r. Stopping.",
-                        self.ident, self.path, stage.ident)
-                    return result
-
-                # Was there some sort of HTTP error?
-                status = captured_response[0].split(None, 1)[0]
-                # XXX What counts as an error?
-                if status not in ("200", "201"):
-                    logger.debug(
-                        "Pipeline %r(%r) start_response received status %r from stage %r. Stopping.",
-                        self.ident, self.path, status, stage.ident)
-                    start_response(captured_response[0], captured_response[1])
-                    # This should contain error information
-                    return result
+                with tracing.span(environ, step.span_name, index=step.index):
+                    result = self._call_stage(stage, step.handler, stage_environ,
+                                              start_response)
+                return _finish(result, pipes)
+
+            # Only the last stage can hand an @async_service task
+            # back to the event worker. The others must finish now.
+            stage_environ.pop("akara.event_loop", None)
+            # Only the client's response can be compressed. The next
+            # stage wants the bytes (or the tree) as they are.
+            stage_environ.pop("HTTP_ACCEPT_ENCODING", None)
 
+            # Intermediate stage output. Forward it to the next stage.
+            captured_response[:] = [None, None, None]
+            with tracing.span(environ, step.span_name, index=step.index):
+                result = self._call_stage(stage, step.handler, stage_environ,
+                                          capture_start_response)
+                if captured_response[0] is None:
+                    # A generator doesn't call start_response() until
+                    # it's started
+                    result = _Started(result)
+            if captured_response[0] is None:
+                logger.error("Pipeline %r(%r) stage %r did not call start_response",
+                             self.ident, self.path, stage.ident)
+                if hasattr(result, "close"):
+                    result.close()
+                start_response("500 Internal server error", [("Content-Type", "text/plain")])
+                return _finish(["Broken internal pipeline.\n"], pipes)
+
+            # Did start_response get an exc_info term? (It might not
+            # have been thrown when forwarded to the real start_response.)
+            if captured_response[2]:
+                # It didn't raise an exception. Assume the response contains
+                # the error message. Forward it and stop the pipeline.
+                logger.debug(
+                    "Pipeline %r(%r) start_response received exc_info from stage %r. Stopping.",
+                    self.ident, self.path, stage.ident)
+                return _finish(result, pipes)
+
+            # Was there some sort of HTTP error?
+            status = captured_response[0].split(None, 1)[0]
+            # XXX What counts as an error?
+            if status not in ("200", "201"):
+                logger.debug(
+                    "Pipeline %r(%r) start_response received status %r from stage %r. Stopping.",
+                    self.ident, self.path, status, stage.ident)
+                start_response(captured_response[0], captured_response[1])
+                # This should contain error information
+                return _finish(result, pipes)
+
+            # Pass the output on without copying it when possible. An
+            # Amara tree goes as it is to a stage which takes one, and
+            # a file from wsgi.file_wrapper goes as it is. Otherwise
+            # the next stage reads the output through a _StagePipe as
+            # it's made, unless it needs to seek, or it may need the
+            # CONTENT_LENGTH and the stage didn't give one.
+            captured_content_type, content_length = _content_headers(captured_response[1])
+            captured_tree = None
+            next_input = step.next_input
+            f = _file_input(result)
+            if next_input == TREE and isinstance(result, TreeOutput):
+                captured_tree = result.tree
+                # The XML is only made if the stage reads it
+                captured_body = _StagePipe(result)
+                captured_body_length = ""
+            elif f is not None:
+                captured_body = f
+                captured_body_length = str(result.size())
+            elif next_input != SEEKABLE and (content_length is not None or
+                                             next_input in (STREAM, TREE)):
+                captured_body = _StagePipe(result)
+                pipes.append(captured_body)
+                captured_body_length = content_length or ""
+            else:
                 # Save the response to the cStringIO
+                captured_body = StringIO()
                 try:
-                    # We might be able to get some better performance using
-                    # a wsgi.file_wrapper. If the chunks come from a file-like
-                    # object then we can reach in and get that file-like object
-                    # instead of copying it to a new one
-                    for chunk in result:
-                        captured_body.write(chunk)
+                    with tracing.span(environ, "collect output", index=step.index):
+                        for chunk in result:
+                            captured_body.write(chunk)
                 finally:
                     # Part of the WSGI spec
                     if hasattr(result, "close"):
                         result.close()
-                captured_body_length = captured_body.tell()
+                captured_body_length = str(captured_body.tell())
                 captured_body.seek(0)
 
         raise AssertionErorr("should never get here")
 
+    def _call_stage(self, stage, handler, stage_environ, start_response):
+        # Call the stage's handler, or get its output from the stage's cache
+        cache = getattr(stage, "cache", None)
+        if cache is None:
+            return handler(stage_environ, start_response)
+        key = _cache_key(stage, stage_environ)
+        response = cache.get(key)
+        stats.current_writer.record_cache(self.path, stage.ident, response is not None)
+        if response is not None:
+            status, headers, output = response
+            start_response(status, list(headers))
+            return [output]
+
+        captured_response = []
+        def cache_start_response(status, headers, exc_info=None):
+            captured_response[:] = [status, headers, exc_info]
+            return start_response(status, headers, exc_info)
+        result = handler(stage_environ, cache_start_response)
+        if not hasattr(result, "__iter__"):
+            # An @async_service task. It's sent when it's done.
+            return result
+        try:
+            output = "".join(result)
+        finally:
+            # Part of the WSGI spec
+            if hasattr(result, "close"):
+                result.close()
+        if (captured_response and captured_response[2] is None and
+            captured_response[0].split(None, 1)[0] in ("200", "201")):
+            cache.put(key, captured_response[0], list(captured_response[1]), output)
+        return [output]
+
+
+def _cache_key(stage, environ):
+    # Read the stage's input so it can be part of the key, and give
+    # the stage a copy to read instead
+    content_length = environ.get("CONTENT_LENGTH")
+    f = environ["wsgi.input"]
+    if content_length and content_length.isdigit():
+        body = f.read(int(content_length))
+    elif "akara.pipeline_headers" in environ:
+        # Streamed from the stage before, which didn't give a length
+        body = f.read()
+    else:
+        body = ""
+    if body or content_length == "":
+        environ["wsgi.input"] = StringIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+    # A compress=True last stage gives a different response for each
+    # encoding the client accepts
+    encoding = compression.choose_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+    digest = hashlib.sha1()
+    for value in (stage.ident, environ.get("REQUEST_METHOD") or "",
+                  environ.get("QUERY_STRING") or "", environ.get("CONTENT_TYPE") or "",
+                  encoding or ""):
+        digest.update(value.encode("utf-8") if isinstance(value, unicode) else value)
+        digest.update("\0")
+    digest.update(body)
+    return digest.digest()
+
+
+class StageCache(object):
+    """Keeps the output of a pipeline stage, to reuse for the same input
+
+    Use it for a stage whose output depends only on its input: the
+    service, the request method, its QUERY_STRING, and its input
+    bytes and their content-type. (The first stage gets the HTTP
+    request's method, query string and body.) The content-coding the
+    client accepts is part of the key too, for a compressed last stage. On a hit the stage's
+    service isn't called, and the stage's output goes to the next
+    stage as if it had been.
+
+      max_entries - the most outputs to keep
+      max_bytes - the most output bytes to keep, all together
+      ttl - the number of seconds to keep an output, or None to keep
+          it until it's pushed out by newer ones
+
+    The least recently used outputs are dropped first. Only 200 and
+    201 responses are kept, and the whole output is read before it
+    is passed on. Each server process has its own cache. The hits and
+    misses of each stage are in the server statistics (see the
+    akara.stats service).
+    """
+    def __init__(self, max_entries=128, max_bytes=8*1024*1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires, status, headers, output)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        "Return the (status, headers, output) saved for 'key', or None"
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.time():
+                self._size -= len(entry[3])
+                return None
+            # Now the most recently used
+            self._entries[key] = entry
+            return entry[1:]
+
+    def put(self, key, status, headers, output):
+        if len(output) > self.max_bytes:
+            return
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[3])
+            self._entries[key] = (expires, status, headers, output)
+            self._size += len(output)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                old_key, old = self._entries.popitem(last=False)
+                self._size -= len(old[3])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
 
 # The dictionary values may be strings for single-valued arguments, or
 # list/tuples for multiple-valued arguments. That is
@@ -224,9 +691,19 @@ class Stage(object):
     The first stage gets the HTTP request QUERY_STRING plus
     the query string defined for the stage. The other stages
     only get the query string defined for the stage.
+
+    'cache' is a StageCache to reuse the stage's output when it gets
+    the same input again, or True for a StageCache with the default
+    sizes. (So "cache" can't be a keyword query argument; use
+    query_args for that.)
     """
-    def __init__(self, ident, query_args=None, query_string=None, **kwargs):
+    def __init__(self, ident, query_args=None, query_string=None, cache=None, **kwargs):
         self.ident = ident
+        if cache is True:
+            cache = StageCache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
         if query_string is not None:
             if query_args is not None:
                 raise TypeError("Cannot specify both 'query_string' and 'query_args'")
@@ -237,6 +714,325 @@ class Stage(object):
             self.query_string = _build_query_string(query_args, kwargs)
 
 
+def _find_handler(stage):
+    # The stage's (WSGI handler, SCRIPT_NAME), or None if its service
+    # isn't registered
+    if isinstance(stage, Parallel):
+        return (stage, None)
+    service = registry.get_a_service_by_id(stage.ident)
+    if service is None:
+        return None
+    assert service.path is not None # Can some services/pipelines not be mounted?
+    return (service.handler, service.path)
+
+
+class Parallel(object):
+    """A pipeline stage which sends the same input to several services at once
+
+    'branches' is a list of Stage objects or service identifiers, or
+    (name, stage) pairs to pick the names used in the merged output.
+    The default name is the service identifier. Each branch gets the
+    stage's input, the request method and the QUERY_STRING this stage
+    would get, plus the branch's own query string.
+
+    The branches run in a pool of threads in the server process (see
+    the "PipelineThreads" setting), so this takes about as long as the
+    slowest branch instead of all of them added up. Their outputs are
+    merged with one of these, in the order of 'branches':
+
+      merge="concat" - the outputs one after the other, with the
+          content-type of the first one
+      merge="xml" - each output as a <result stage="name"> element
+          in a <results> element (or the 'envelope' element). XML
+          outputs are included as XML, without the XML declaration;
+          anything else as text.
+      merge="json" - a JSON object with each output under its name.
+          JSON outputs are included as JSON; anything else as a string.
+
+    'timeout' is the number of seconds to wait for each branch, or None
+    to wait as long as it takes. 'timeouts' is a dictionary with
+    the timeouts of branches which need a different one, by name.
+
+    A Parallel stage in a branch of another one (for example in a
+    pipeline used as a branch) runs its branches one after the other
+    in that branch's thread, without its timeouts. Waiting for more
+    pool threads there could wait forever, with every thread taken by
+    a branch which is waiting too.
+
+    A branch which times out, raises an exception, or returns an HTTP
+    error is left out of a "concat" merge. With "xml" it has an
+    "error" attribute and no content, and with "json" its value is
+    null. If every branch fails the stage returns a 502 error. A branch
+    which timed out keeps running in its thread until it finishes.
+
+    Example:
+
+      register_pipeline("http://example.com/enrich", "enrich", stages=[
+          "http://example.com/parse",
+          Parallel([("geo", "http://example.com/geocode"),
+                    ("people", Stage("http://example.com/names", lang="en"))],
+                   merge="json", timeout=5),
+          ])
+    """
+    # Reads all of its input, and needs no CONTENT_LENGTH
+    pipeline_input = STREAM
+    # The QUERY_STRING is left for the branches
+    query_string = None
+    cache = None
+
+    def __init__(self, branches, merge="concat", timeout=None, timeouts=None,
+                 envelope="results"):
+        if not branches:
+            raise TypeError("No branches defined for the parallel stage")
+        if merge not in _MERGES:
+            raise ValueError("merge must be one of %s, not %r" %
+                             (", ".join(sorted(_MERGES)), merge))
+        self.branches = []
+        for branch in branches:
+            if isinstance(branch, tuple):
+                name, stage = branch
+                stage = _normalize_stage(stage)
+            else:
+                stage = _normalize_stage(branch)
+                name = stage.ident
+            self.branches.append((name, stage))
+        names = [name for (name, stage) in self.branches]
+        if len(set(names)) != len(names):
+            raise ValueError("Parallel branch names must be unique: %r" % (names,))
+        self.merge = merge
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        for name in self.timeouts:
+            if name not in names:
+                raise ValueError("No parallel branch named %r" % (name,))
+        self.envelope = envelope
+        self.ident = "parallel(%s)" % (", ".join(names),)
+        # (registry generation, list of (handler, SCRIPT_NAME) or None)
+        self._handlers = (None, None)
+
+    def _get_handlers(self):
+        generation = registry.generation()
+        handlers_generation, handlers = self._handlers
+        if handlers_generation != generation:
+            handlers = [_find_handler(stage) for (name, stage) in self.branches]
+            self._handlers = (generation, handlers)
+        return handlers
+
+    def __call__(self, environ, start_response):
+        content_length = environ.get("CONTENT_LENGTH")
+        if content_length:
+            body = environ["wsgi.input"].read(int(content_length))
+        elif environ.get("REQUEST_METHOD") == "POST":
+            body = environ["wsgi.input"].read()
+        else:
+            body = ""
+
+        results = Queue.Queue()
+        now = time.time()
+        deadlines = {}
+        handlers = self._get_handlers()
+        for index, (name, stage) in enumerate(self.branches):
+            handler = handlers[index]
+            if handler is None:
+                logger.error("Parallel stage %r could not find a %r service",
+                             self.ident, stage.ident)
+                start_response("500 Internal server error", [("Content-Type", "text/plain")])
+                return ["Broken internal pipeline.\n"]
+            timeout = self.timeouts.get(name, self.timeout)
+            if timeout is not None:
+                deadlines[index] = now + timeout
+            branch_environ = _branch_environ(environ, stage, handler[1], body)
+            task = _BranchTask(index, name, handler[0], branch_environ, results)
+            if getattr(_branch_thread, "active", False):
+                # Already in a pool thread (see above)
+                task()
+            else:
+                _get_pool().add_task(task)
+
+        # Each is None, or (status, headers, body) or ("error", reason)
+        responses = [None] * len(self.branches)
+        waiting = len(self.branches)
+        while waiting:
+            pending = [deadline for (index, deadline) in deadlines.items()
+                       if responses[index] is None]
+            try:
+                if pending:
+                    index, response = results.get(timeout=max(min(pending) - time.time(), 0))
+                else:
+                    index, response = results.get()
+            except Queue.Empty:
+                now = time.time()
+                for index, deadline in deadlines.items():
+                    if responses[index] is None and deadline <= now:
+                        logger.warn("Parallel stage %r: %r timed out" %
+                                    (self.ident, self.branches[index][0]))
+                        responses[index] = ("error", "timeout")
+                        waiting -= 1
+                continue
+            if responses[index] is None:
+                responses[index] = response
+                waiting -= 1
+
+        if not [response for response in responses if response[0] != "error"]:
+            start_response("502 Bad Gateway", [("Content-Type", "text/plain")])
+            return ["All of the parallel services failed.\n"]
+        content_type, output = _MERGES[self.merge](self, responses)
+        start_response("200 OK", [("Content-Type", content_type),
+                                  ("Content-Length", str(len(output)))])
+        return [output]
+
+
+def _branch_environ(environ, stage, path, body):
+    branch_environ = environ.copy()
+    # The branch runs in another thread
+    branch_environ.pop("akara.event_loop", None)
+    # The outputs are merged, so they can't be compressed
+    branch_environ.pop("HTTP_ACCEPT_ENCODING", None)
+    branch_environ.pop("wsgiorg.routing_args", None)
+    if path is not None:
+        branch_environ["SCRIPT_NAME"] = path
+    if stage.query_string:
+        if branch_environ.get("QUERY_STRING"):
+            branch_environ["QUERY_STRING"] += ("&" + stage.query_string)
+        else:
+            branch_environ["QUERY_STRING"] = stage.query_string
+    branch_environ["wsgi.input"] = StringIO(body)
+    branch_environ["CONTENT_LENGTH"] = str(len(body))
+    return branch_environ
+
+class _BranchTask(object):
+    # Runs one branch in a pool thread and puts (index, response) on
+    # the results queue. The response is (status, headers, body) or,
+    # if it failed, ("error", reason).
+    def __init__(self, index, name, handler, environ, results):
+        self.index = index
+        self.name = name
+        self.handler = handler
+        self.environ = environ
+        self.results = results
+
+    def __call__(self):
+        outer = getattr(_branch_thread, "active", False)
+        _branch_thread.active = True
+        try:
+            self.results.put((self.index, self._run()))
+        except:
+            logger.error("Parallel branch %r failed" % (self.name,), exc_info=True)
+            self.results.put((self.index, ("error", "exception")))
+        finally:
+            _branch_thread.active = outer
+
+    def _run(self):
+        environ = self.environ
+        captured_response = [None, None]
+        def start_response(status, headers, exc_info=None):
+            captured_response[:] = [status, headers]
+        with tracing.span(environ, "branch " + self.name):
+            result = self.handler(environ, start_response)
+            try:
+                # This also gets a generator to call start_response()
+                body = "".join(result)
+            finally:
+                # Part of the WSGI spec
+                if hasattr(result, "close"):
+                    result.close()
+        status, headers = captured_response
+        if status is None:
+            return ("error", "no response")
+        code = status.split(None, 1)[0]
+        if not code.startswith("2"):
+            logger.warn("Parallel branch %r returned %r" % (self.name, status))
+            return ("error", code)
+        return (status, headers, body)
+
+
+def _content_type(headers):
+    for (name, value) in headers:
+        if name.lower() == "content-type":
+            return value
+    return None
+
+def _is_type(content_type, subtype):
+    # Is it "application/<subtype>", "text/<subtype>" or "*/*+<subtype>"?
+    if not content_type:
+        return False
+    mimetype = content_type.split(";", 1)[0].strip().lower()
+    return mimetype.endswith("/" + subtype) or mimetype.endswith("+" + subtype)
+
+def _merge_concat(parallel, responses):
+    content_type = None
+    outputs = []
+    for response in responses:
+        if response[0] == "error":
+            continue
+        if content_type is None:
+            content_type = _content_type(response[1])
+        outputs.append(response[2])
+    return (content_type or "application/octet-stream", "".join(outputs))
+
+_xml_declaration = re.compile(r"^\s*<\?xml[^>]*\?>")
+
+def _merge_xml(parallel, responses):
+    outputs = ["<%s>" % (parallel.envelope,)]
+    for (name, stage), response in zip(parallel.branches, responses):
+        if response[0] == "error":
+            outputs.append("<result stage=%s error=%s/>" %
+                           (quoteattr(name), quoteattr(response[1])))
+            continue
+        body = response[2]
+        if _is_type(_content_type(response[1]), "xml"):
+            body = _xml_declaration.sub("", body, 1)
+        else:
+            body = xml_escape(body)
+        outputs.append("<result stage=%s>%s</result>" % (quoteattr(name), body))
+    outputs.append("</%s>" % (parallel.envelope,))
+    return ("application/xml", "".join(outputs))
+
+def _merge_json(parallel, responses):
+    result = {}
+    for (name, stage), response in zip(parallel.branches, responses):
+        if response[0] == "error":
+            result[name] = None
+            continue
+        body = response[2]
+        if _is_type(_content_type(response[1]), "json"):
+            try:
+                result[name] = json.loads(body)
+                continue
+            except ValueError:
+                logger.warn("Parallel branch %r returned bad JSON" % (name,))
+        result[name] = body.decode("utf-8", "replace")
+    return ("application/json", json.dumps(result))
+
+_MERGES = {"concat": _merge_concat, "xml": _merge_xml, "json": _merge_json}
+
+
+# The threads for the parallel branches. Each server process makes
+# its own the first time it needs it.
+_pool_size = 4
+_pool = None
+_pool_lock = threading.Lock()
+# Set while a thread runs a branch
+_branch_thread = threading.local()
+
+def configure(settings):
+    "Set up the parallel stages from the server settings"
+    global _pool_size
+    _pool_size = settings.get("pipeline_threads", 4)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Like the ThreadsPerServer pool: no extra threads past
+                # the limit, and a branch waits for a free thread
+                _pool = httpserver.ThreadPool(_pool_size, name="Akara pipeline threads",
+                                              daemon=True, max_requests=0,
+                                              spawn_if_under=0, logger=logger)
+    return _pool
+
+
 def _normalize_stage(stage):
     if isinstance(stage, basestring):
         return Stage(stage)
@@ -0,0 +1,372 @@
+"""Profile requests to a mount point in the running server
+
+This is an internal module and should not be used by other libraries.
+
+A request is run under cProfile when one of these says so:
+
+  - its mount point is listed in the "ProfileMountPoints" setting,
+    in which case every request to it is profiled;
+  - "akara profile <mount point> <count>" asked for the next <count>
+    requests to that mount point, whichever server processes get them;
+  - it has an X-Akara-Profile header signed with "ProfileSecret"
+    (get one from "akara profile --header <mount point>").
+
+Profiling includes reading the whole response, since a service which
+returns an iterator does most of its work then. An @async_service
+under the event worker is only profiled until it starts to wait.
+
+Each server process adds up its own profile for each mount point and
+writes it to ProfileDir as "<mount point>.<run>.<pid>.prof" after
+every profiled request. Each "akara profile" starts a new run. The
+akara.profile service, and "akara profile --save", merge the latest
+run's files from all of the processes into one pstats file.
+
+The counts asked for by "akara profile" are in a small memory-mapped
+file, ProfileDir/control, which the master creates before it forks
+any children. A child only takes its lock when there is something to
+claim.
+
+"""
+import cProfile
+import errno
+import fcntl
+import hashlib
+import hmac
+import marshal
+import mmap
+import os
+import pstats
+import struct
+import threading
+import time
+import urllib
+
+from akara import logger
+
+MAGIC = "AKPR"
+VERSION = 1
+MAX_ENTRIES = 32
+CONTROL_FILE = "control"
+HEADER_ENVIRON_KEY = "HTTP_X_AKARA_PROFILE"
+# How long "akara profile --header" makes a header valid for
+HEADER_LIFETIME = 3600
+
+_HEADER = struct.Struct("=4sIII")   # magic, version, active entries, last run
+_ENTRY = struct.Struct("=64sII")    # mount point, run, requests remaining
+_ENTRIES_OFFSET = _HEADER.size
+_SIZE = _ENTRIES_OFFSET + _ENTRY.size * MAX_ENTRIES
+_ACTIVE_OFFSET = 8
+_LAST_RUN_OFFSET = 12
+_I = struct.Struct("=I")
+
+class Error(Exception):
+    pass
+
+class Control(object):
+    """The requests to profile, in a memory-mapped file
+
+    Use Control.create() in the master and Control.open() from
+    "akara profile".
+    """
+    def __init__(self, filename, f, mm):
+        self.filename = filename
+        self._file = f
+        self._mm = mm
+
+    @classmethod
+    def create(cls, filename):
+        # Keep the runs from the last time, so new profile files
+        # don't get mixed up with old ones
+        last_run = 0
+        try:
+            old = cls.open(filename)
+        except (IOError, Error):
+            pass
+        else:
+            last_run = old.last_run
+            old.close()
+        tmp_filename = "%s.%d" % (filename, os.getpid())
+        f = open(tmp_filename, "w+b")
+        try:
+            f.truncate(_SIZE)
+            mm = mmap.mmap(f.fileno(), _SIZE)
+        except:
+            f.close()
+            raise
+        _HEADER.pack_into(mm, 0, MAGIC, VERSION, 0, last_run)
+        os.rename(tmp_filename, filename)
+        return cls(filename, f, mm)
+
+    @classmethod
+    def open(cls, filename):
+        f = open(filename, "r+b")
+        try:
+            mm = mmap.mmap(f.fileno(), 0)
+        except (mmap.error, ValueError), err:
+            f.close()
+            raise Error("Cannot map profile control file %r: %s" % (filename, err))
+        if len(mm) < _SIZE:
+            mm.close()
+            f.close()
+            raise Error("Profile control file %r is too small" % (filename,))
+        magic, version, active, last_run = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            mm.close()
+            f.close()
+            raise Error("File %r is not a version %d Akara profile control file" %
+                        (filename, VERSION))
+        return cls(filename, f, mm)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    @property
+    def last_run(self):
+        return _I.unpack_from(self._mm, _LAST_RUN_OFFSET)[0]
+
+    def _entry(self, i):
+        mount_point, run, remaining = _ENTRY.unpack_from(
+            self._mm, _ENTRIES_OFFSET + _ENTRY.size * i)
+        return mount_point.rstrip("\0"), run, remaining
+
+    def _find(self, mount_point):
+        for i in range(MAX_ENTRIES):
+            entry = self._entry(i)
+            if entry[0] == mount_point and entry[1]:
+                return i, entry
+        return None, None
+
+    def _set(self, i, mount_point, run, remaining):
+        _ENTRY.pack_into(self._mm, _ENTRIES_OFFSET + _ENTRY.size * i,
+                         mount_point, run, remaining)
+        active = sum(1 for j in range(MAX_ENTRIES) if self._entry(j)[2])
+        _I.pack_into(self._mm, _ACTIVE_OFFSET, active)
+
+    def entries(self):
+        "Return a list of (mount point, run, requests remaining)"
+        return [entry for entry in map(self._entry, range(MAX_ENTRIES)) if entry[1]]
+
+    def run_for(self, mount_point):
+        "The current run for a mount point, or 0 if it never had one"
+        i, entry = self._find(mount_point)
+        if entry is None:
+            return 0
+        return entry[1]
+
+    def request(self, mount_point, count):
+        "Profile the next 'count' requests to 'mount_point'. Returns the run."
+        mount_point = mount_point[:64]
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            i, entry = self._find(mount_point)
+            if entry is None:
+                # Use an empty entry, or else reuse a finished one
+                entries = [self._entry(j) for j in range(MAX_ENTRIES)]
+                for j, entry in enumerate(entries):
+                    if not entry[1]:
+                        i = j
+                        break
+                else:
+                    finished = [(entry[1], j) for (j, entry) in enumerate(entries)
+                                if not entry[2]]
+                    if not finished:
+                        raise Error("Already profiling %d mount points" % (MAX_ENTRIES,))
+                    i = min(finished)[1]
+            run = self.last_run + 1
+            _I.pack_into(self._mm, _LAST_RUN_OFFSET, run)
+            self._set(i, mount_point, run, count)
+            return run
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def claim(self, mount_point):
+        "Take one of the requests asked for. Returns the run, or None."
+        if not _I.unpack_from(self._mm, _ACTIVE_OFFSET)[0]:
+            return None
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            i, entry = self._find(mount_point[:64])
+            if entry is None or not entry[2]:
+                return None
+            self._set(i, entry[0], entry[1], entry[2] - 1)
+            return entry[1]
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+
+def signature(secret, mount_point, expires):
+    "The X-Akara-Profile header value for a mount point"
+    digest = hmac.new(secret, "%s:%d" % (mount_point, expires), hashlib.sha256).hexdigest()
+    return "%d:%s" % (expires, digest)
+
+def _check_signature(secret, mount_point, value, now=None):
+    expires, _, digest = value.strip().partition(":")
+    try:
+        expires = int(expires)
+    except ValueError:
+        return False
+    if now is None:
+        now = time.time()
+    if expires < now:
+        return False
+    expected = signature(secret, mount_point, expires)
+    # Compare without giving away how much matched
+    if len(expected) != len(value.strip()):
+        return False
+    result = 0
+    for a, b in zip(expected, value.strip()):
+        result |= ord(a) ^ ord(b)
+    return result == 0
+
+
+def _profile_filename(profile_dir, mount_point, run, pid):
+    return os.path.join(profile_dir, "%s.%d.%d.prof" % (
+        urllib.quote(mount_point, safe=""), run, pid))
+
+def _scan(profile_dir):
+    # Returns {mount point: {run: [filename, ...]}}
+    profiles = {}
+    try:
+        names = os.listdir(profile_dir)
+    except OSError:
+        return profiles
+    for name in names:
+        parts = name.rsplit(".", 3)
+        if (len(parts) != 4 or parts[3] != "prof" or
+            not (parts[1].isdigit() and parts[2].isdigit())):
+            continue
+        runs = profiles.setdefault(urllib.unquote(parts[0]), {})
+        runs.setdefault(int(parts[1]), []).append(os.path.join(profile_dir, name))
+    return profiles
+
+def list_profiles(profile_dir):
+    "Return {mount point: (latest run, number of profile files)}"
+    result = {}
+    for mount_point, runs in _scan(profile_dir).items():
+        run = max(runs)
+        result[mount_point] = (run, len(runs[run]))
+    return result
+
+def profile_files(profile_dir, mount_point):
+    "Return the latest run and its profile files for a mount point"
+    runs = _scan(profile_dir).get(mount_point)
+    if not runs:
+        return None, []
+    run = max(runs)
+    return run, sorted(runs[run])
+
+def merged_profile(profile_dir, mount_point):
+    "Return the latest run's profiles merged into a pstats file, or None"
+    run, filenames = profile_files(profile_dir, mount_point)
+    stats = None
+    for filename in filenames:
+        try:
+            if stats is None:
+                stats = pstats.Stats(filename)
+            else:
+                stats.add(filename)
+        except (IOError, EOFError, ValueError, TypeError), err:
+            # Being replaced, or left half-written by a dead process
+            logger.warn("Cannot read profile %r: %s" % (filename, err))
+    if stats is None:
+        return None
+    # The format pstats.Stats.dump_stats() writes
+    return marshal.dumps(stats.stats)
+
+def remove_old_runs(profile_dir, mount_point, run):
+    "Remove the profile files from runs before 'run'"
+    for old_run, filenames in _scan(profile_dir).get(mount_point, {}).items():
+        if old_run >= run:
+            continue
+        for filename in filenames:
+            try:
+                os.unlink(filename)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+
+class Profiler(object):
+    "Profiles requests in a server process"
+    def __init__(self, settings, control):
+        self.profile_dir = settings["profile_dir"]
+        self.mount_points = frozenset(settings.get("profile_mount_points", ()))
+        self.secret = settings.get("profile_secret")
+        self.control = control
+        self._profiles = {}   # mount point -> (run, cProfile.Profile)
+        # cProfile only sees the thread which enabled it, so profile
+        # one request at a time
+        self._busy = threading.Lock()
+
+    def _run(self, mount_point, environ):
+        # The run to add this request to, or None to not profile it
+        if mount_point in self.mount_points:
+            return self._current_run(mount_point)
+        if self.secret:
+            value = environ.get(HEADER_ENVIRON_KEY)
+            if value is not None and _check_signature(self.secret, mount_point, value):
+                return self._current_run(mount_point)
+        if self.control is not None:
+            return self.control.claim(mount_point)
+        return None
+
+    def _current_run(self, mount_point):
+        if self.control is None:
+            return 0
+        return self.control.run_for(mount_point[:64])
+
+    def call(self, mount_point, app, environ, start_response):
+        """Call a WSGI application, maybe under the profiler
+
+        A profiled response is read before this returns.
+        """
+        if not self._busy.acquire(False):
+            return app(environ, start_response)
+        try:
+            run = self._run(mount_point, environ)
+            if run is None:
+                return app(environ, start_response)
+            old_run, profile = self._profiles.get(mount_point, (None, None))
+            if old_run != run:
+                profile = cProfile.Profile()
+                self._profiles[mount_point] = (run, profile)
+            profile.enable()
+            try:
+                result = app(environ, start_response)
+                if isinstance(result, (list, tuple)) or not hasattr(result, "__iter__"):
+                    return result
+                try:
+                    return list(result)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            finally:
+                profile.disable()
+                self._save(mount_point, run, profile)
+        finally:
+            self._busy.release()
+
+    def _save(self, mount_point, run, profile):
+        filename = _profile_filename(self.profile_dir, mount_point, run, os.getpid())
+        tmp_filename = filename + ".tmp"
+        try:
+            profile.dump_stats(tmp_filename)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError), err:
+            logger.error("Cannot save the profile for %r: %s" % (mount_point, err))
+
+
+class _NullProfiler(object):
+    "Used when there's no profiling (e.g., outside of the server)"
+    def call(self, mount_point, app, environ, start_response):
+        return app(environ, start_response)
+
+# The master sets 'control' and each child makes its own 'current'
+control = None
+current = _NullProfiler()
+
+def attach_child(settings):
+    "Called in a newly forked child"
+    global current
+    current = Profiler(settings, control)
@@ -23,11 +23,33 @@ class AkaraDefault:
     MaxSpareServers = 10
     MaxServers = 150
     MaxRequestsPerServer = 10000
+    PredictiveScaling = 0
+    ThreadsPerServer = 0
+    Worker = "sync"
+    MaxConnectionsPerServer = 1000
+    PipelineThreads = 4
+
+    KeepAliveTimeout = 5
+    MaxKeepAliveRequests = 100
+    OutputBufferSize = 8192
+    MaxRequestBodySize = 16777216
+
+    PreloadModules = 0
+    ReusePort = 0
 
     ModuleDir = 'modules'
     ModuleCache = 'caches'
     ErrorLog = 'logs/error.log'
     AccessLog = 'logs/access.log'
+    LogFlushInterval = 1
+    ScoreboardFile = 'logs/akara.scoreboard'
+    StatsFile = 'logs/akara.stats'
+    TraceFile = 'logs/trace.json'
+    TraceSampleRate = 0
+    TraceHeader = ''
+    ProfileDir = 'logs/profiles'
+    ProfileMountPoints = []
+    ProfileSecret = ''
     LogLevel = 'INFO'
 
 
@@ -122,6 +144,23 @@ def _extract_settings(config):
                 (key, value))
         return value
 
+    # The configuration is exec'ed without builtins, so there is no
+    # True or False. Flags are 0 or 1.
+    def getflag(key):
+        value = get(key)
+        if value not in (0, 1):
+            raise Error("'Akara' configuration %r must be 0 or 1, not %r" %
+                        (key, value))
+        return bool(value)
+
+    def getnumber(key):
+        value = get(key)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise Error("'Akara' configuration %r must be a number, not %r" %
+                        (key, value))
+
     def getnonnegative(key):
         value = getint(key)
         if value <= 0:
@@ -192,6 +231,42 @@ def _extract_settings(config):
     access_log = getstring('AccessLog')
     settings["access_log"] = os.path.join(config_root, access_log)
 
+    log_flush_interval = getnumber('LogFlushInterval')
+    if log_flush_interval < 0:
+        raise Error("'Akara' configuration 'LogFlushInterval' must not be negative, not %r" %
+                    (log_flush_interval,))
+    settings["log_flush_interval"] = log_flush_interval
+
+    scoreboard_file = getstring('ScoreboardFile')
+    settings["scoreboard_file"] = os.path.join(config_root, scoreboard_file)
+
+    stats_file = getstring('StatsFile')
+    settings["stats_file"] = os.path.join(config_root, stats_file)
+
+    trace_file = getstring('TraceFile')
+    settings["trace_file"] = os.path.join(config_root, trace_file)
+
+    trace_sample_rate = getnumber('TraceSampleRate')
+    if not (0 <= trace_sample_rate <= 1):
+        raise Error("'Akara' configuration 'TraceSampleRate' must be from 0 to 1, not %r" %
+                    (trace_sample_rate,))
+    settings["trace_sample_rate"] = trace_sample_rate
+
+    # An empty string means no header
+    settings["trace_header"] = getstring('TraceHeader') or None
+
+    profile_dir = getstring('ProfileDir')
+    settings["profile_dir"] = os.path.join(config_root, profile_dir)
+
+    profile_mount_points = get('ProfileMountPoints')
+    if (not isinstance(profile_mount_points, (list, tuple)) or
+        not all(isinstance(name, basestring) for name in profile_mount_points)):
+        raise Error("'Akara' configuration 'ProfileMountPoints' must be a list of strings, not %r" %
+                    (profile_mount_points,))
+    settings["profile_mount_points"] = list(profile_mount_points)
+
+    settings["profile_secret"] = getstring('ProfileSecret') or None
+
     module_dir = getstring("ModuleDir")
     settings["module_dir"] = os.path.join(config_root, module_dir)
     
@@ -218,5 +293,47 @@ def _extract_settings(config):
         raise Error("MaxSpareServers (%r) must be greater than MinSpareServers (%r)" %
                     (settings["max_spare_servers"], settings["min_spare_servers"]))
     settings["max_requests_per_server"] = getpositive("MaxRequestsPerServer")
+    settings["predictive_scaling"] = getflag("PredictiveScaling")
+
+    # 0 means each server handles one connection at a time, without threads
+    threads_per_server = getint("ThreadsPerServer")
+    if threads_per_server < 0:
+        raise Error("'Akara' configuration 'ThreadsPerServer' must not be negative, not %r" %
+                    (threads_per_server,))
+    settings["threads_per_server"] = threads_per_server
+
+    worker = getstring("Worker")
+    if worker not in ("sync", "event"):
+        raise Error("'Akara' configuration 'Worker' must be 'sync' or 'event', not %r" %
+                    (worker,))
+    if worker == "event" and threads_per_server:
+        raise Error("'Akara' configuration 'ThreadsPerServer' cannot be used with Worker = 'event'")
+    settings["worker"] = worker
+    settings["max_connections_per_server"] = getpositive("MaxConnectionsPerServer")
+    settings["pipeline_threads"] = getpositive("PipelineThreads")
+
+    # Persistent (keep-alive) HTTP/1.1 connections. A timeout of 0
+    # disables keep-alive. A request limit of 0 means "no limit".
+    keep_alive_timeout = getnumber("KeepAliveTimeout")
+    if keep_alive_timeout < 0:
+        raise Error("'Akara' configuration 'KeepAliveTimeout' must not be negative, not %r" %
+                    (keep_alive_timeout,))
+    settings["keep_alive_timeout"] = keep_alive_timeout
+
+    max_keep_alive_requests = getint("MaxKeepAliveRequests")
+    if max_keep_alive_requests < 0:
+        raise Error("'Akara' configuration 'MaxKeepAliveRequests' must not be negative, not %r" %
+                    (max_keep_alive_requests,))
+    settings["max_keep_alive_requests"] = max_keep_alive_requests
+
+    output_buffer_size = getint("OutputBufferSize")
+    if output_buffer_size < 0:
+        raise Error("'Akara' configuration 'OutputBufferSize' must not be negative, not %r" %
+                    (output_buffer_size,))
+    settings["output_buffer_size"] = output_buffer_size
+    settings["max_request_body_size"] = getpositive("MaxRequestBodySize")
+
+    settings["preload_modules"] = getflag("PreloadModules")
+    settings["reuse_port"] = getflag("ReusePort")
 
     return settings
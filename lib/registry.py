@@ -5,6 +5,8 @@ Add WSGI handlers to the Akara HTTP dispatch registry.
 """
 
 import inspect
+import re
+import time
 
 import amara
 from amara import tree
@@ -24,15 +26,20 @@ __all__ = ("register_service", "get_service")
 
 
 # We had some discussion about using the term 'path' or 'mount_point'?
-# Right now we don't really have '/' paths so there's no real difference
-# Therefore, you register mount_points, which must not have a "/" in them.
-# Incoming requests have a path, and the first segment (before the "/")
-# is used to find the mount point.
-
-# We're calling it a 'path' for future compatibility.  For more
-# complex paths we might want to use Routes or similar system, in
-# which case we'll also have pattern matching on the path segments.
-# You'll likely register a path pattern, still with the name 'path'.
+# A service is registered under a path of one or more "/"-separated
+# segments, like "echo" or "wiki/pages/{name}". A segment in braces
+# matches any one (non-empty) segment of the request path, and the
+# value goes to the service as a keyword argument, in the manner of
+# the wsgiorg.routing_args specification. The registered path, the
+# "mount point", is what the scoreboard and the statistics show.
+#
+# The paths are kept in a trie of segments, so finding the service
+# for a request takes one dictionary lookup per segment however many
+# services there are. A request goes to the service with the longest
+# registered path that is a prefix of the request path; the rest is
+# left in PATH_INFO for the service. At each segment a literal match
+# wins over a {name} segment, and the search doesn't back up, so with
+# "a/b" and "a/{x}/c" registered, "/a/b/c" goes to "a/b".
 
 class Service(object):
     "Internal class to store information about a given service resource"
@@ -81,32 +88,151 @@ class Service(object):
         return self._internal_template
     
 
+_name_pat = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def split_path(path):
+    """Return the segments of a registered path, or raise a ValueError
+
+    A {name} segment is returned as (name,).
+    """
+    if path.startswith("/") or path.endswith("/"):
+        raise ValueError("Registered path %r may not start or end with a '/'" % (path,))
+    segments = []
+    for segment in path.split("/"):
+        if segment.startswith("{") and segment.endswith("}"):
+            name = segment[1:-1]
+            if not _name_pat.match(name):
+                raise ValueError("Registered path %r has a bad template segment %r" %
+                                 (path, segment))
+            segments.append((name,))
+        elif "{" in segment or "}" in segment:
+            raise ValueError("Registered path %r: a template must be a whole segment, not %r" %
+                             (path, segment))
+        elif (not segment and segments) or segment == "." or segment == "..":
+            raise ValueError("Registered path %r has an empty or relative segment" % (path,))
+        else:
+            segments.append(segment)
+    names = [segment[0] for segment in segments if isinstance(segment, tuple)]
+    if len(set(names)) != len(names):
+        raise ValueError("Registered path %r uses a template name twice" % (path,))
+    return segments
+
+
+class _Node(object):
+    # A node in the trie of registered paths
+    __slots__ = ("children", "template", "service", "names")
+    def __init__(self):
+        self.children = {}    # literal segment -> _Node
+        self.template = None  # _Node for a {name} segment
+        self.service = None   # the Service registered here, if any
+        self.names = ()       # its template names, in order
+
+
 class Registry(object):
     "Internal class to handle resource registration information"
     def __init__(self):
-        self._registered_services = {}
+        self._registered_services = {}  # path -> Service
+        self._services_by_ident = {}    # ident -> Service
+        self._routes = _Node()
+        # Changes on every registration, so documents made from the
+        # registry can be cached
+        self.generation = 0
+        self.last_modified = time.time()
 
     def register_service(self, ident, path, handler, doc=None, query_template=None):
-        if "/" in path:
-            raise ValueError("Registered path %r may not contain a '/'" % (path,))
+        segments = split_path(path)
         if doc is None:
             doc = inspect.getdoc(handler) or ""
-        if ident in self._registered_services:
+        old = self._registered_services.get(path)
+        if old is not None:
             logger.warn("Replacing mount point %r (%r)" % (path, ident))
         else:
             logger.debug("Created new mount point %r (%r)" % (path, ident))
         serv = Service(handler, path, ident, doc, query_template)
         self._registered_services[path] = serv
+        self.generation += 1
+        self.last_modified = time.time()
+
+        node = self._routes
+        for segment in segments:
+            if isinstance(segment, tuple):
+                if node.template is None:
+                    node.template = _Node()
+                node = node.template
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _Node()
+                node = child
+        node.service = serv
+        node.names = tuple(segment[0] for segment in segments if isinstance(segment, tuple))
+
+        # The latest registration for an ident is the one to use
+        self._services_by_ident[ident] = serv
+        if (old is not None and old.ident != ident and
+            self._services_by_ident.get(old.ident) is old):
+            # Fall back to another path with the old ident, if any
+            del self._services_by_ident[old.ident]
+            for other in self._registered_services.itervalues():
+                if other.ident == old.ident:
+                    self._services_by_ident[old.ident] = other
+                    break
 
     def get_service(self, path):
         return self._registered_services[path]
 
+    def get_service_by_id(self, ident):
+        return self._services_by_ident.get(ident)
+
+    def match(self, path_info):
+        """Find the service for a request's PATH_INFO
+
+        Returns (service, the number of path segments it takes, the
+        template values), or None if nothing matches.
+        """
+        # This is on every request, so it's written out for speed.
+        # It takes the segments in the order wsgiref's
+        # shift_path_info() does, which skips empty and "." segments
+        # except for the last one.
+        parts = path_info.split("/")
+        last = len(parts) - 1
+        node = self._routes
+        values = None
+        found = None
+        num_segments = 0
+        for i in xrange(1, last + 1):
+            segment = parts[i]
+            if i < last and (not segment or segment == "."):
+                continue
+            num_segments += 1
+            child = node.children.get(segment)
+            if child is None:
+                child = node.template
+                if child is None or not segment or segment == ".":
+                    break
+                if values is None:
+                    values = [segment]
+                else:
+                    values.append(segment)
+            node = child
+            if node.service is not None:
+                found = node
+                found_segments = num_segments
+        if found is None:
+            return None
+        if found.names:
+            return found.service, found_segments, dict(zip(found.names, values))
+        return found.service, found_segments, {}
+
+    def _services(self, ident):
+        for path, service in sorted(self._registered_services.iteritems()):
+            if ident is None or service.ident == ident:
+                yield path, service
+
     def list_services(self, ident=None):
         document = tree.entity()
         services = document.xml_append(tree.element(None, 'services'))
-        for path, service in sorted(self._registered_services.iteritems()):
-            if ident is not None and service.ident != ident:
-                continue
+        for path, service in self._services(ident):
             service_node = services.xml_append(tree.element(None, 'service'))
             service_node.xml_attributes['ident'] = service.ident
             E = service_node.xml_append(tree.element(None, 'path'))
@@ -118,6 +244,17 @@ class Registry(object):
             E.xml_append(tree.text(service.doc))
         return document
 
+    def json_document(self, ident=None):
+        "The list_services() information as a JSON-compatible dictionary"
+        services = []
+        for path, service in self._services(ident):
+            template = service.template
+            if template is not None:
+                template = template.template
+            services.append(dict(ident=service.ident, path=path,
+                                 template=template, description=service.doc))
+        return {"services": services}
+
 _current_registry = Registry()
 
 
@@ -130,11 +267,26 @@ def get_service(mount_point):
 def list_services(ident=None):
     return _current_registry.list_services(ident)
 
+def json_document(ident=None):
+    return _current_registry.json_document(ident)
+
+def generation():
+    "Changes whenever a service is registered"
+    return _current_registry.generation
+
+def last_modified():
+    "The time of the last registration"
+    return _current_registry.last_modified
+
+def set_last_modified(when):
+    "Use the same time in every server process for the same registry"
+    _current_registry.last_modified = when
+
 def get_a_service_by_id(ident):
-    for path, service in _current_registry._registered_services.items():
-        if service.ident == ident:
-            return service
-    return None
+    return _current_registry.get_service_by_id(ident)
+
+def match(path_info):
+    return _current_registry.match(path_info)
 
 
 # ident -> template
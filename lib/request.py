@@ -11,6 +11,9 @@ The following are defined if the Akara handler comes from an extension module
 
 These should all be treated as read-only constants.
 
+'environ' is specific to the current thread, so it is safe to use
+when the server handles requests in several threads.
+
 """
 import os as _os
 
@@ -53,4 +56,8 @@ class _ModuleConfig(_DictMixin):
 module_config = _ModuleConfig()
 
 
+# Give each request-handling thread its own 'environ'.
+from akara import threadlocal as _threadlocal
+_threadlocal.install(__name__, dict(environ = lambda: None))
+
 # Eventually add cookie support?
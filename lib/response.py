@@ -3,6 +3,9 @@
   code - the HTTP response code (default is "200 Ok")
   headers - a list of key/value pairs used for the WSGI start_response
 
+Both are specific to the current thread, so they are safe to use when
+the server handles requests in several threads.
+
 """
 
 code = None
@@ -10,6 +13,12 @@ headers = []
 
 def add_header(key, value):
     """Helper function to append (key, value) to the list of response headers"""
-    headers.append( (key, value) )
+    # Use the thread-local 'headers', not this module's global
+    _this.headers.append( (key, value) )
+
+# Give each request-handling thread its own 'code' and 'headers'.
+from akara import threadlocal as _threadlocal
+_this = _threadlocal.install(__name__, dict(code = lambda: None,
+                                            headers = list))
 
 # Eventually add cookie support?
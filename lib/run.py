@@ -131,21 +131,38 @@ def set_global_config(settings):
     for name, value in settings.items():
         setattr(global_config, name, value)
 
+# Used for a rolling restart, where the master keeps running.
+# Raises an exception, and leaves the current configuration alone,
+# if there's a problem.
+def reload_config(config_filename, debug):
+    settings, config = read_config.read_config(config_filename)
+    # Reopen the log files (this is also how to rotate them)
+    logger_config.set_logfile(settings["error_log"])
+    logger_config.set_access_logfile(settings["access_log"])
+
+    akara.raw_config = config
+    set_global_config(settings)
+    if not debug:
+        logger.setLevel(settings["log_level"])
+    return settings, config
+
 def main(args):
     config_filename = args.config_filename
     debug = args.debug
     skip_pid_check = args.skip_pid_check
 
     first_time = True
-    old_server_address = None
+    old_listen_settings = None
     sock = None
     while 1:
         # This is the main loop for the flup server.
 
-        # Why is it a loop? A SIGHUP sent to the server
-        # will shut down flup then reread the configuration
-        # file, reload the extension modules, and start
-        # the flup server again.
+        # Why is it a loop? Usually a SIGHUP sent to the server
+        # rereads the configuration file and replaces the children
+        # without stopping (see AkaraPreforkServer._reload). If the
+        # listen address or a few other settings changed, flup shuts
+        # down instead, and this loop starts it again with the new
+        # configuration.
 
         try:
             settings, config = read_config.read_config(config_filename)
@@ -218,12 +235,21 @@ Does that directory exist and is it writeable?""" % err)
         # far as we can go, then tell the parent that we're ready.
         try:
             server_address = settings["server_address"]
-            if server_address != old_server_address:
+            reuse_port = settings["reuse_port"]
+            if (server_address, reuse_port) != old_listen_settings:
                 if sock is not None:
                     sock.close()
                 sock = socket.socket()
                 # XXX Should SO_REUSEADDR be a configuration setting?
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    if not hasattr(socket, "SO_REUSEPORT"):
+                        raise SystemExit("ReusePort is not supported on this platform")
+                    # Each child binds its own listening socket to the
+                    # same address. This one keeps the port reserved
+                    # (and reports problems now) but never listens, so
+                    # the kernel doesn't queue connections on it.
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 # Disable Nagle's algorithm, which causes problems with
                 # keep-alive. See:
                 #     http://stackoverflow.com/questions/1781766/
@@ -239,8 +265,9 @@ Does that directory exist and is it writeable?""" % err)
                     raise SystemExit("Can not bind to " + description)
                 logger.info("Listening to " + description)
                                       
-                sock.listen(socket.SOMAXCONN)
-                old_server_address = server_address
+                if not reuse_port:
+                    sock.listen(socket.SOMAXCONN)
+                old_listen_settings = (server_address, reuse_port)
 
             # NOTE: StartServers not currently supported and likely won't be.
             # Why? Because the old algorithm would add/cull the server count
@@ -254,6 +281,7 @@ Does that directory exist and is it writeable?""" % err)
                 maxRequests = settings["max_requests_per_server"],
                 settings = settings,
                 config = config,
+                reload_config = lambda: reload_config(config_filename, debug),
                 )
 
             # Everything is ready to go, except for saving the PID file
@@ -0,0 +1,167 @@
+"""Predictive scaling for the number of Akara server processes
+
+This is an internal module and should not be used by other libraries.
+
+flup's rule for the number of servers only looks at how many are idle
+right now. It starts new servers once the spares are used up, which
+is after they are already needed, and stops idle ones as soon as
+there are more than MaxSpareServers. With "PredictiveScaling" set,
+the master uses a Scaler instead.
+
+The Scaler keeps moving averages of the request arrival rate and the
+time spent handling each request, from the totals in the scoreboard.
+By Little's law their product is the number of servers kept busy. It
+adds the connections waiting in the listen queue (the backlog) and
+MinSpareServers on top of that to get the target. When there are
+fewer servers than that, it starts all of the missing ones at once.
+
+Shrinking is slower. The limit for shrinking uses a slower average
+and MaxSpareServers, and there have to be too many servers for
+SHRINK_DELAY seconds before the scaler stops one, then one per
+INTERVAL after that.
+
+The averages, the targets and the number of servers started and
+stopped are saved in the scoreboard for "akara status" and the
+akara.server-status service.
+
+"""
+import math
+import socket
+import struct
+
+# Time constants, in seconds, for the moving averages
+FAST_TIME_CONSTANT = 2.0
+SLOW_TIME_CONSTANT = 60.0
+# How often the master updates the averages
+INTERVAL = 1.0
+# How long there must be too many servers before stopping one
+SHRINK_DELAY = 10.0
+# The most servers to start at once
+MAX_BATCH = 32
+
+def _average(old, value, dt, time_constant):
+    # Exponentially weighted moving average for samples 'dt' apart
+    alpha = 1.0 - math.exp(-dt / time_constant)
+    return old + alpha * (value - old)
+
+class Scaler(object):
+    """Decide how many server processes to run
+
+    'capacity' is the number of connections each server handles at
+    once (ThreadsPerServer, or MaxConnectionsPerServer with the event
+    worker). The master calls update() every INTERVAL seconds with
+    the scoreboard totals and decide() each time through its loop.
+    """
+    def __init__(self, min_spare, max_spare, max_servers, capacity=1):
+        self.set_limits(min_spare, max_spare, max_servers, capacity)
+        self.arrival_rate = 0.0
+        self.arrival_rate_slow = 0.0
+        self.service_time = 0.0
+        self.backlog = 0
+        self.target = max_spare
+        self.high_target = max_spare
+        # Updated by the master, as it starts and stops servers
+        self.spawned = 0
+        self.stopped = 0
+        self._last_totals = None
+        self._too_many_since = None
+        self._next_stop = 0.0
+
+    def set_limits(self, min_spare, max_spare, max_servers, capacity=1):
+        self.min_spare = min_spare
+        self.max_spare = max_spare
+        self.max_servers = max_servers
+        self.capacity = max(capacity, 1)
+
+    def update(self, now, requests, busy_time):
+        """Update the averages
+
+        'requests' and 'busy_time' are the total number of requests
+        completed and the total time spent on them.
+        """
+        if self._last_totals is None:
+            self._last_totals = (now, requests, busy_time)
+            return
+        last_time, last_requests, last_busy_time = self._last_totals
+        dt = now - last_time
+        if dt <= 0:
+            return
+        self._last_totals = (now, requests, busy_time)
+        n = max(requests - last_requests, 0)
+        rate = n / dt
+        self.arrival_rate = _average(self.arrival_rate, rate, dt, FAST_TIME_CONSTANT)
+        self.arrival_rate_slow = _average(self.arrival_rate_slow, rate, dt,
+                                          SLOW_TIME_CONSTANT)
+        if n:
+            service_time = max(busy_time - last_busy_time, 0.0) / n
+            if self.service_time:
+                self.service_time = _average(self.service_time, service_time, dt,
+                                             FAST_TIME_CONSTANT)
+            else:
+                self.service_time = service_time
+
+    def _clip(self, n):
+        return min(max(int(math.ceil(n)), self.max_spare), self.max_servers)
+
+    def decide(self, now, servers, idle, backlog):
+        """Return the number of servers to start, or -1 to stop one
+
+        'servers' is the number of servers, 'idle' the number of those
+        which can take another connection, and 'backlog' the number of
+        connections waiting to be accepted.
+        """
+        self.backlog = backlog
+        capacity = float(self.capacity)
+        busy = servers - idle
+        expected = max(self.arrival_rate * self.service_time / capacity, busy)
+        expected_slow = max(self.arrival_rate_slow * self.service_time / capacity,
+                            expected)
+        queued = backlog / capacity
+        self.target = self._clip(expected + queued + self.min_spare)
+        self.high_target = max(self._clip(expected_slow + queued + self.max_spare),
+                               self.target)
+
+        if servers < self.target:
+            self._too_many_since = None
+            return min(self.target - servers, MAX_BATCH)
+
+        if servers > self.high_target and idle:
+            if self._too_many_since is None:
+                self._too_many_since = now
+            elif (now - self._too_many_since >= SHRINK_DELAY and
+                  now >= self._next_stop):
+                self._next_stop = now + INTERVAL
+                return -1
+        else:
+            self._too_many_since = None
+        return 0
+
+    def counters(self):
+        "The current state, for the scoreboard"
+        return dict(enabled = 1,
+                    backlog = self.backlog,
+                    target = self.target,
+                    high_target = self.high_target,
+                    spawned = self.spawned,
+                    stopped = self.stopped,
+                    arrival_rate = self.arrival_rate,
+                    arrival_rate_slow = self.arrival_rate_slow,
+                    service_time = self.service_time)
+
+
+# On Linux, TCP_INFO for a listening socket reports the number of
+# connections waiting to be accepted in tcpi_unacked.
+_TCP_INFO = getattr(socket, "TCP_INFO", None)
+_tcp_info_unacked = struct.Struct("=24xI")
+
+def listen_backlog(sock):
+    "Return the number of connections waiting on 'sock', or 0 if unknown"
+    if _TCP_INFO is None:
+        return 0
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, _TCP_INFO, 104)
+    except socket.error:
+        return 0
+    if len(info) < _tcp_info_unacked.size:
+        return 0
+    return _tcp_info_unacked.unpack_from(info)[0]
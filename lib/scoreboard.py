@@ -0,0 +1,397 @@
+"""Shared-memory scoreboard for the Akara server processes
+
+This is an internal module and should not be used by other libraries.
+
+Like Apache's scoreboard, this is a table with one slot for each
+possible HTTP listener process. The master process creates it, as a
+memory-mapped file (the "ScoreboardFile" setting), before it forks
+any children. Each child updates its own slot with plain memory
+writes; there are no messages to the master for any of this.
+
+The master assigns a slot before it forks a child and frees the slot
+when the child is reaped. Everything else is written by the child:
+its state, how many requests it handled, the bytes it sent, and the
+method, mount point, client and start time of the current request.
+
+The header also holds the master's scaling counters (see
+akara.scaling), when "PredictiveScaling" is on.
+
+Readers (the "akara.server-status" service and "akara status") take
+a snapshot of the table. There is no locking, so a snapshot may show
+a slot in the middle of an update. That's fine for monitoring.
+
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = "AKSB"
+VERSION = 2
+
+# The state codes follow Apache's mod_status where possible.
+OPEN = "."          # No process in this slot
+STARTING = "S"      # Forked, loading the extension modules
+IDLE = "_"          # Waiting for a connection
+READING = "R"       # Reading the request
+BUSY = "W"          # Handling the request and sending the reply
+KEEP_ALIVE = "K"    # Waiting for the next request on a persistent connection
+
+STATE_NAMES = {
+    OPEN: "open",
+    STARTING: "starting",
+    IDLE: "idle",
+    READING: "reading",
+    BUSY: "busy",
+    KEEP_ALIVE: "keep-alive",
+    }
+
+_HEADER = struct.Struct("=4sIIid")   # magic, version, num_slots, master pid, start time
+
+# The scaling counters, which follow the header
+_SCALING_FIELDS = [
+    ("enabled", "i"),
+    ("backlog", "i"),            # connections waiting to be accepted
+    ("target", "i"),             # grow to at least this many servers
+    ("high_target", "i"),        # shrink when there are more than this
+    ("spawned", "Q"),            # servers started by the scaler
+    ("stopped", "Q"),            # servers stopped by the scaler
+    ("arrival_rate", "d"),       # requests/second, fast moving average
+    ("arrival_rate_slow", "d"),  # requests/second, slow moving average
+    ("service_time", "d"),       # seconds/request, moving average
+    ]
+_SCALING = struct.Struct("=" + "".join(fmt for (name, fmt) in _SCALING_FIELDS))
+_SCALING_NAMES = [name for (name, fmt) in _SCALING_FIELDS]
+_SLOTS_OFFSET = _HEADER.size + _SCALING.size
+
+# (name, struct format) for each field in a slot
+_SLOT_FIELDS = [
+    ("pid", "i"),
+    ("state", "c"),
+    ("", "3x"),
+    ("requests", "Q"),       # requests completed by this process
+    ("bytes", "Q"),          # body bytes sent by this process
+    ("request_bytes", "Q"),  # body bytes sent for the current/last request
+    ("request_start", "d"),  # time.time() when the current/last request started
+    ("request_time", "d"),   # duration of the last request, or 0.0 if in progress
+    ("busy_time", "d"),      # total seconds spent handling requests
+    ("method", "8s"),
+    ("mount_point", "64s"),
+    ("client", "48s"),
+    ]
+_SLOT = struct.Struct("=" + "".join(fmt for (name, fmt) in _SLOT_FIELDS))
+_SLOT_NAMES = [name for (name, fmt) in _SLOT_FIELDS if name]
+
+# Byte offset and Struct for each named field, for single-field updates
+_FIELD = {}
+_offset = 0
+for _name, _fmt in _SLOT_FIELDS:
+    if _name:
+        _FIELD[_name] = (_offset, struct.Struct("=" + _fmt))
+    _offset += struct.calcsize("=" + _fmt)
+del _offset, _name, _fmt
+
+class Error(Exception):
+    pass
+
+class Scoreboard(object):
+    """A table of per-process status, in a memory-mapped file
+
+    Use Scoreboard.create() in the master and Scoreboard.open() to
+    read an existing scoreboard from another process.
+    """
+    def __init__(self, filename, mm, num_slots):
+        self.filename = filename
+        self._mm = mm
+        self.num_slots = num_slots
+        # Master-side bookkeeping
+        self._pid_to_slot = {}
+        # Totals from the slots which have been released, so
+        # totals() doesn't go down when a child exits
+        self._released_requests = 0
+        self._released_busy_time = 0.0
+
+    @classmethod
+    def create(cls, filename, num_slots):
+        # Build the new file to the side then rename it into place.
+        # Readers never see a partial file, and truncating a file
+        # which is still mapped (after a restart) would cause a SIGBUS.
+        size = _SLOTS_OFFSET + _SLOT.size * num_slots
+        tmp_filename = "%s.%d" % (filename, os.getpid())
+        f = open(tmp_filename, "w+b")
+        try:
+            f.write("\0" * size)
+            f.flush()
+            mm = mmap.mmap(f.fileno(), size)
+        finally:
+            f.close()
+        _HEADER.pack_into(mm, 0, MAGIC, VERSION, num_slots, os.getpid(), time.time())
+        _SCALING.pack_into(mm, _HEADER.size, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0)
+        self = cls(filename, mm, num_slots)
+        for i in range(num_slots):
+            self._clear(i)
+        os.rename(tmp_filename, filename)
+        return self
+
+    @classmethod
+    def open(cls, filename):
+        f = open(filename, "rb")
+        try:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), err:
+                raise Error("Cannot map scoreboard file %r: %s" % (filename, err))
+        finally:
+            f.close()
+        if len(mm) < _HEADER.size:
+            raise Error("Scoreboard file %r is too small" % (filename,))
+        magic, version, num_slots, master_pid, start_time = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Error("File %r is not a version %d Akara scoreboard" %
+                        (filename, VERSION))
+        if len(mm) < _SLOTS_OFFSET + _SLOT.size * num_slots:
+            raise Error("Scoreboard file %r is truncated" % (filename,))
+        return cls(filename, mm, num_slots)
+
+    def close(self):
+        self._mm.close()
+
+    @property
+    def master_pid(self):
+        return _HEADER.unpack_from(self._mm, 0)[3]
+
+    @property
+    def start_time(self):
+        return _HEADER.unpack_from(self._mm, 0)[4]
+
+    def _slot_offset(self, i):
+        return _SLOTS_OFFSET + _SLOT.size * i
+
+    def _clear(self, i):
+        _SLOT.pack_into(self._mm, self._slot_offset(i),
+                        0, OPEN, 0, 0, 0, 0.0, 0.0, 0.0, "", "", "")
+
+    def set_field(self, i, name, value):
+        offset, fmt = _FIELD[name]
+        fmt.pack_into(self._mm, self._slot_offset(i) + offset, value)
+
+    def get_field(self, i, name):
+        offset, fmt = _FIELD[name]
+        return fmt.unpack_from(self._mm, self._slot_offset(i) + offset)[0]
+
+    ## Used by the master
+
+    def reserve_slot(self):
+        "Find an open slot for a new child, or return None if there isn't one"
+        for i in range(self.num_slots):
+            if self.get_field(i, "state") == OPEN:
+                self._clear(i)
+                self.set_field(i, "state", STARTING)
+                return i
+        return None
+
+    def assign_slot(self, i, pid):
+        "Record that the child 'pid' uses the reserved slot"
+        self._pid_to_slot[pid] = i
+        self.set_field(i, "pid", pid)
+
+    def release_slot(self, i):
+        self._clear(i)
+
+    def release_pid(self, pid):
+        "Free the slot used by the (now dead) child 'pid'"
+        i = self._pid_to_slot.pop(pid, None)
+        if i is not None:
+            self._released_requests += self.get_field(i, "requests")
+            self._released_busy_time += self.get_field(i, "busy_time")
+            self._clear(i)
+
+    def totals(self):
+        "Return (requests, busy time) over every child this master started"
+        requests = self._released_requests
+        busy_time = self._released_busy_time
+        for i in self._pid_to_slot.itervalues():
+            requests += self.get_field(i, "requests")
+            busy_time += self.get_field(i, "busy_time")
+        return requests, busy_time
+
+    def set_scaling(self, counters):
+        "Save the scaler's counters (a dictionary) for the readers"
+        values = [counters.get(name, 0) for name in _SCALING_NAMES]
+        _SCALING.pack_into(self._mm, _HEADER.size, *values)
+
+    ## Used by readers
+
+    def scaling(self):
+        "Return the scaling counters as a dictionary"
+        values = _SCALING.unpack_from(self._mm, _HEADER.size)
+        return dict(zip(_SCALING_NAMES, values))
+
+    def slots(self):
+        "Return a snapshot of the slots in use, as a list of dictionaries"
+        result = []
+        for i in range(self.num_slots):
+            values = _SLOT.unpack_from(self._mm, self._slot_offset(i))
+            slot = dict(zip(_SLOT_NAMES, values))
+            if slot["state"] == OPEN:
+                continue
+            for name in ("method", "mount_point", "client"):
+                slot[name] = slot[name].rstrip("\0")
+            slot["slot"] = i
+            slot["state_name"] = STATE_NAMES.get(slot["state"], "unknown")
+            result.append(slot)
+        return result
+
+
+class SlotWriter(object):
+    "Used by a child process to update its own slot"
+    def __init__(self, scoreboard, index):
+        self.scoreboard = scoreboard
+        self.index = index
+
+    def _set(self, name, value):
+        self.scoreboard.set_field(self.index, name, value)
+
+    def starting(self):
+        self._set("pid", os.getpid())
+        self._set("state", STARTING)
+
+    def idle(self):
+        self._set("state", IDLE)
+
+    def reading(self):
+        self._set("state", READING)
+
+    def keep_alive(self):
+        self._set("state", KEEP_ALIVE)
+
+    def begin_request(self, method, client):
+        "Record the start of a request. Pass the return value to end_request()"
+        put = self._set
+        start = time.time()
+        put("request_start", start)
+        put("request_time", 0.0)
+        put("request_bytes", 0)
+        put("method", method[:8])
+        put("mount_point", "")
+        put("client", client[:48])
+        put("state", BUSY)
+        return start
+
+    def set_mount_point(self, mount_point):
+        self._set("mount_point", (mount_point or "")[:64])
+
+    def add_bytes(self, n):
+        get = self.scoreboard.get_field
+        self._set("request_bytes", get(self.index, "request_bytes") + n)
+        self._set("bytes", get(self.index, "bytes") + n)
+
+    def end_request(self, start=None):
+        get = self.scoreboard.get_field
+        if start is None:
+            start = get(self.index, "request_start")
+        request_time = max(time.time() - start, 1e-6)
+        self._set("request_time", request_time)
+        self._set("busy_time", get(self.index, "busy_time") + request_time)
+        self._set("requests", get(self.index, "requests") + 1)
+
+
+class SharedSlotWriter(SlotWriter):
+    """Used by a child process which handles several connections at once
+
+    The connections (in threads, or in the event worker's loop) share
+    the slot. The counters are updated under a lock, the state is
+    "busy" while any request is being handled, and the request fields
+    describe the most recently started request.
+    """
+    def __init__(self, scoreboard, index):
+        SlotWriter.__init__(self, scoreboard, index)
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._busy = 0
+
+    def idle(self):
+        # Called at start-up and at the end of each connection
+        self._lock.acquire()
+        try:
+            self._connections = max(self._connections - 1, 0)
+            if not self._connections:
+                self._set("state", IDLE)
+        finally:
+            self._lock.release()
+
+    def reading(self):
+        # Called at the start of each connection
+        self._lock.acquire()
+        try:
+            self._connections += 1
+            if not self._busy:
+                self._set("state", READING)
+        finally:
+            self._lock.release()
+
+    def keep_alive(self):
+        self._lock.acquire()
+        try:
+            if not self._busy:
+                self._set("state", KEEP_ALIVE)
+        finally:
+            self._lock.release()
+
+    def begin_request(self, method, client):
+        self._lock.acquire()
+        try:
+            self._busy += 1
+            return SlotWriter.begin_request(self, method, client)
+        finally:
+            self._lock.release()
+
+    def set_mount_point(self, mount_point):
+        self._lock.acquire()
+        try:
+            SlotWriter.set_mount_point(self, mount_point)
+        finally:
+            self._lock.release()
+
+    def add_bytes(self, n):
+        self._lock.acquire()
+        try:
+            SlotWriter.add_bytes(self, n)
+        finally:
+            self._lock.release()
+
+    def end_request(self, start=None):
+        # 'start' is needed to get the right duration when the
+        # requests overlap
+        self._lock.acquire()
+        try:
+            self._busy -= 1
+            SlotWriter.end_request(self, start)
+            if not self._busy:
+                self._set("state", KEEP_ALIVE)
+        finally:
+            self._lock.release()
+
+
+class _NullSlotWriter(object):
+    "Used when there is no scoreboard (e.g., outside of the server)"
+    def _ignore(self, *args):
+        pass
+    starting = idle = reading = keep_alive = _ignore
+    begin_request = set_mount_point = add_bytes = end_request = _ignore
+
+
+# The scoreboard for this server, and the slot for this process.
+# The master sets 'current' and each child gets it through fork().
+current = None
+current_slot = _NullSlotWriter()
+
+def attach_child(index, shared=False):
+    "Called in a newly forked child to use the given slot"
+    global current_slot
+    if shared:
+        current_slot = SharedSlotWriter(current, index)
+    else:
+        current_slot = SlotWriter(current, index)
+    current_slot.starting()
@@ -6,10 +6,13 @@ module.
 """
 
 import httplib
+import time
 import warnings
 import functools
 import cgi
+import hashlib
 import inspect
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from cStringIO import StringIO
 from xml.sax.saxutils import escape as xml_escape
 
@@ -18,10 +21,14 @@ http_responses = BaseHTTPRequestHandler.responses
 del BaseHTTPRequestHandler
 
 from amara import tree, writers
+from amara.thirdparty import json
 
-from akara import logger, registry
+from akara import logger, registry, scoreboard, stats, eventloop, compression, tracing
+from akara import profiling
+from akara import pipeline
+from akara.thirdparty import httpserver
 
-__all__ = ("service", "simple_service", "method_dispatcher")
+__all__ = ("service", "simple_service", "async_service", "method_dispatcher")
 
 ERROR_DOCUMENT_TEMPLATE = """<?xml version="1.0" encoding="ISO-8859-1"?>
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
@@ -68,13 +75,22 @@ class _HTTP405(_HTTPError):
 def _get_function_args(environ, allow_repeated_args):
     request_method = environ.get("REQUEST_METHOD")
     if request_method == "POST":
-        try:
-            request_length = int(environ["CONTENT_LENGTH"])
-        except (KeyError, ValueError):
-            raise _HTTPError(httplib.LENGTH_REQUIRED)
-        if request_length < 0:
-            raise _HTTPError(httplib.BAD_REQUEST)
-        request_bytes = environ["wsgi.input"].read(request_length)
+        if pipeline.TREE_INPUT_KEY in environ:
+            # An Amara tree from the pipeline stage before
+            request_bytes = environ[pipeline.TREE_INPUT_KEY]
+        elif (environ.get("CONTENT_LENGTH") == "" and
+            "akara.pipeline_headers" in environ):
+            # Streamed from an earlier pipeline stage which didn't
+            # know its length
+            request_bytes = environ["wsgi.input"].read()
+        else:
+            try:
+                request_length = int(environ["CONTENT_LENGTH"])
+            except (KeyError, ValueError):
+                raise _HTTPError(httplib.LENGTH_REQUIRED)
+            if request_length < 0:
+                raise _HTTPError(httplib.BAD_REQUEST)
+            request_bytes = environ["wsgi.input"].read(request_length)
         request_content_type = environ.get("CONTENT_TYPE", None)
         args = (request_bytes, request_content_type)
     else:
@@ -94,6 +110,16 @@ def _get_function_args(environ, allow_repeated_args):
                 else:
                     raise _HTTPError(400, 
    message="Using the %r query parameter multiple times is not supported" % (k,))
+
+    # Values from a registered path like "pages/{name}" win over the
+    # query string
+    routing_args = environ.get("wsgiorg.routing_args")
+    if routing_args is not None:
+        for k, v in routing_args[1].iteritems():
+            if allow_repeated_args:
+                kwargs[k] = [v]
+            else:
+                kwargs[k] = v
             
     return args, kwargs
 
@@ -137,13 +163,7 @@ def convert_body(body, content_type, encoding, writer):
         return [body], content_type, len(body)
 
     if isinstance(body, tree.entity):
-        # XXX have Amara tell me the content type (with encoding)
-        # This is trac #29
-        if content_type is None:
-            if "html" in writer.lower():
-                content_type = "text/html"
-            else:
-                content_type = "application/xml"
+        content_type = _tree_content_type(content_type, writer)
         w = writers.lookup(writer)
         body = body.xml_encode(w, encoding)
         return [body], content_type, len(body)
@@ -154,11 +174,36 @@ def convert_body(body, content_type, encoding, writer):
             content_type = "text/plain; charset=%s" % (encoding,)
         return [body], content_type, len(body)
 
-    # Probably one of the normal WSGI responses
     if content_type is None:
         content_type = "text/plain"
+
+    # From environ["wsgi.file_wrapper"]; the size of a file is known
+    if isinstance(body, httpserver.FileWrapper):
+        return body, content_type, body.size()
+
+    # Probably one of the normal WSGI responses
     return body, content_type, None
 
+def _tree_content_type(content_type, writer):
+    # XXX have Amara tell me the content type (with encoding)
+    # This is trac #29
+    if content_type is None:
+        if "html" in writer.lower():
+            content_type = "text/html"
+        else:
+            content_type = "application/xml"
+    return content_type
+
+def _convert_result(environ, result, content_type, encoding, writer):
+    # convert_body(), except that an Amara tree for a pipeline stage
+    # which takes one is passed on as it is (see pipeline.tree_input())
+    if isinstance(result, tree.entity) and environ.get(pipeline.TREE_OUTPUT_KEY):
+        def serialize():
+            return convert_body(result, content_type, encoding, writer)[0][0]
+        return (pipeline.TreeOutput(result, serialize),
+                _tree_content_type(content_type, writer), None)
+    return convert_body(result, content_type, encoding, writer)
+
 
 # The HTTP spec says a method can be and 1*CHAR, where CHAR is a
 # US-ASCII character excepting control characters and "punctuation".
@@ -171,10 +216,9 @@ def _check_is_valid_method(method):
         raise ValueError("HTTP method %r value is not valid. "
                          "It must contain only uppercase ASCII letters" % (method,))
 
-def _no_slashes(path):
-    if path is not None and "/" in path:
-        # Really these are more like mount points
-        raise ValueError("service paths may not contain a '/'")
+def _check_path(path):
+    if path is not None:
+        registry.split_path(path)
 
 def ignore_start_response(status, response_headers, exc_info=None):
     pass
@@ -206,10 +250,17 @@ def _handle_notify(environ, f, service_list):
         service = registry.get_a_service_by_id(service_id)
         service_environ = environ.copy()
         service_environ["PATH_INFO"] = service.path
+        # The result is ignored, so an @async_service must finish now
+        service_environ.pop("akara.event_loop", None)
+        # The values from the first service's path aren't this one's
+        service_environ.pop("wsgiorg.routing_args", None)
+        # Notified services read the bytes in f
+        service_environ.pop(pipeline.TREE_INPUT_KEY, None)
         f.seek(0)
         new_request(service_environ)
         try:
-            service.handler(service_environ, ignore_start_response)
+            with tracing.span(environ, "notify " + service_id):
+                service.handler(service_environ, ignore_start_response)
         except Exception:
             raise
             # XXX
@@ -254,8 +305,9 @@ def service(service_id, path=None,
             query_template = None,
             wsgi_wrapper=None,
             notify_before = None,
-            notify_after = None):
-    _no_slashes(path)
+            notify_after = None,
+            compress = False):
+    _check_path(path)
     def service_wrapper(func):
         @functools.wraps(func)
         def wrapper(environ, start_response):
@@ -266,10 +318,12 @@ def service(service_id, path=None,
             # of tools which might access 'environ' directly, and
             # I want to be consistent with the simple* interfaces.
             new_request(environ)
-            result = func(environ, start_response)
+            with tracing.span(environ, "call " + func.__name__):
+                result = func(environ, start_response)
 
             # You need to make sure you sent the correct content-type!
-            result, ctype, length = convert_body(result, None, encoding, writer)
+            with tracing.span(environ, "convert_body"):
+                result, ctype, length = convert_body(result, None, encoding, writer)
             result = _handle_notify_after(environ, result, notify_after)
             return result
 
@@ -277,6 +331,9 @@ def service(service_id, path=None,
         if pth is None:
             pth = func.__name__
 
+        if compress:
+            wrapper = compression.compress(wrapper)
+
         # If an outer WSGI wrapper was specified, place it around the service wrapper being created
         if wsgi_wrapper:
             wrapper = wsgi_wrapper(wrapper)
@@ -302,14 +359,16 @@ def simple_service(method, service_id, path=None,
                    allow_repeated_args=False,
                    query_template=None,
                    wsgi_wrapper=None,
-                   notify_before=None, notify_after=None):
+                   notify_before=None, notify_after=None,
+                   compress=False):
     """Add the function as an Akara resource
 
     These affect how the resource is registered in Akara
       method - the supported HTTP method (either "GET" or "POST")
       service_id - a string which identifies this service; should be a URL
-      path - the local URL path to the resource (must not at present
-           contain a '/') If None, use the function's name as the path.
+      path - the local URL path to the resource, such as "echo" or
+           "pages/{name}" (see akara.registry). If None, use the
+           function's name as the path.
       query_template - An Akara URL service template (based on OpenSource; see akara.opensource)
            Can be used to help consumers compose resources withing this service.  The same
            template is used for all HTTP methods
@@ -323,6 +382,8 @@ def simple_service(method, service_id, path=None,
           to the bytes used in the HTTP response
       writer - Used to serialize the Amara tree for the HTTP response.
           This must be a name which can be used as an Amara.writer.lookup.
+      compress - If True, gzip or deflate the response for clients which
+          accept it (see akara.compression)
 
     This affects how to convert the QUERY_STRING into function call parameters
       allow_repeated_args - The query string may have multiple items with the
@@ -389,7 +450,7 @@ def simple_service(method, service_id, path=None,
     See implementation notes in the code below.
 
 """
-    _no_slashes(path)
+    _check_path(path)
     _check_is_valid_method(method)
     if method not in ("GET", "POST"):
         raise ValueError(
@@ -404,19 +465,31 @@ def simple_service(method, service_id, path=None,
                         raise _HTTP405(["GET"])
                     else:
                         raise _HTTP405(["POST"])
-                args, kwargs = _get_function_args(environ, allow_repeated_args)
+                with tracing.span(environ, "get_function_args"):
+                    args, kwargs = _get_function_args(environ, allow_repeated_args)
             except _HTTPError, err:
                 return err.make_wsgi_response(environ, start_response)
-            if args:
+            if pipeline.TREE_INPUT_KEY in environ:
+                # The notify_before services need the bytes, and
+                # wsgi.input is the tree's XML
+                body = FROM_ENVIRON
+            elif args:
                 body = args[0]
             else:
                 body = ""
             _handle_notify_before(environ, body, notify_before)
 
             new_request(environ)
-            result = func(*args, **kwargs)
+            with tracing.span(environ, "call " + func.__name__):
+                result = func(*args, **kwargs)
 
-            result, ctype, clength = convert_body(result, content_type, encoding, writer)
+            with tracing.span(environ, "convert_body"):
+                if notify_after:
+                    # The notify_after services need the bytes
+                    result, ctype, clength = convert_body(result, content_type, encoding, writer)
+                else:
+                    result, ctype, clength = _convert_result(environ, result, content_type,
+                                                             encoding, writer)
             send_headers(start_response, ctype, clength)
             result = _handle_notify_after(environ, result, notify_after)
             return result
@@ -432,9 +505,16 @@ def simple_service(method, service_id, path=None,
         if qt is not None:
             qt = pth + qt
 
+        if compress:
+            wrapper = compression.compress(wrapper)
+
         # If an wsgi_wrapper was given, wrapper the service wrapper with it
         if wsgi_wrapper:
            wrapper = wsgi_wrapper(wrapper)
+        else:
+            # It reads all of a POST body, so a pipeline stage before
+            # it can stream into it (see akara.pipeline)
+            wrapper.pipeline_input = "stream"
 
         #For purposes of inspection (not a good idea to change these otherwise you'll lose sync with the values closed over)
         wrapper.content_type = content_type
@@ -445,6 +525,87 @@ def simple_service(method, service_id, path=None,
         return wrapper
     return service_wrapper
 
+## Guide to help in understanding
+# @async_service(*args) -> returns a service_wrapper
+#
+# @async_service(*args)
+# def func(): yield ...  -> returns a wrapper() which runs func
+
+def async_service(method, service_id, path=None,
+                  content_type=None, encoding="utf-8", writer="xml",
+                  allow_repeated_args=False,
+                  query_template=None):
+    """Add a generator function as an Akara resource which waits on other servers
+
+    This is like simple_service and takes the same parameters, except
+    for wsgi_wrapper, notify_before and notify_after. The decorated
+    function is a generator. It yields an akara.eventloop.http_request()
+    (or a list of them) whenever it needs data from another HTTP
+    server, gets the response back from the yield, and gives its
+    result with "raise Return(value)". See akara.eventloop.
+
+      @async_service("GET", "http://example.com/wiki_page")
+      def wiki_page(name):
+          response = yield http_request("http://wiki.example.com/" + name)
+          raise Return(response.body)
+
+    With the event-driven server worker ("Worker = 'event'") the
+    process handles other requests while this one waits. Otherwise
+    each request is made in turn and the process waits for it.
+    """
+    _check_path(path)
+    _check_is_valid_method(method)
+    if method not in ("GET", "POST"):
+        raise ValueError(
+            "async_service only supports GET and POST methods, not %s" % (method,))
+
+    def service_wrapper(func):
+        if not inspect.isgeneratorfunction(func):
+            raise TypeError("async_service %r must be a generator function" %
+                            (func.__name__,))
+        @functools.wraps(func)
+        def wrapper(environ, start_response):
+            try:
+                if environ.get("REQUEST_METHOD") != method:
+                    raise _HTTP405([method])
+                args, kwargs = _get_function_args(environ, allow_repeated_args)
+            except _HTTPError, err:
+                return err.make_wsgi_response(environ, start_response)
+
+            new_request(environ)
+            gen = func(*args, **kwargs)
+
+            def finish(result):
+                result, ctype, clength = _convert_result(environ, result, content_type,
+                                                         encoding, writer)
+                send_headers(start_response, ctype, clength)
+                return result
+
+            loop = environ.get("akara.event_loop")
+            if loop is None:
+                return finish(eventloop.run_blocking(gen))
+            # The event worker runs the task and sends the result
+            return eventloop.Task(gen, finish)
+
+        pth = path
+        if pth is None:
+            pth = func.__name__
+
+        qt = query_template
+        if qt is None and method == "GET" and not allow_repeated_args:
+            qt = _make_query_template(func)
+        if qt is not None:
+            qt = pth + qt
+
+        wrapper.content_type = content_type
+        wrapper.encoding = encoding
+        wrapper.writer = writer
+        wrapper.pipeline_input = "stream"
+
+        registry.register_service(service_id, pth, wrapper, query_template=qt)
+        return wrapper
+    return service_wrapper
+
 # XXX idea for the majority of services which deal with XML
 # @xml_service("http://example.com/cool_xml", "cool")
 # def cool(xml_tree, param1):
@@ -515,18 +676,22 @@ class service_method_dispatcher(object):
 # def method_func(): pass --> returns a method_wrapper which calls method_func
 
 # This is the top-level decorator
-def method_dispatcher(service_id, path=None, wsgi_wrapper=None, query_template=None):
+def method_dispatcher(service_id, path=None, wsgi_wrapper=None, query_template=None,
+                      compress=False):
     """Add an Akara resource which dispatches to other functions based on the HTTP method
     
     Used for resources which handle, say, both GET and POST requests.
 
       service_id - a string which identifies this service; should be a URL
-      path - the local URL path to the resource (must not at present
-           contain a '/') If None, use the function's name as the path.
+      path - the local URL path to the resource, such as "echo" or
+           "pages/{name}" (see akara.registry). If None, use the
+           function's name as the path.
       wsgi_wrapper - An outer WSGI component to be wrapped around the methods
       query_template - An Akara URL service template (based on OpenSource; see akara.opensource)
            Can be used to help consumers compose resources withing this service.  The same
            template is used for all HTTP methods
+      compress - If True, gzip or deflate the responses for clients which
+           accept it (see akara.compression)
 
     Example of use:
 
@@ -550,7 +715,7 @@ def method_dispatcher(service_id, path=None, wsgi_wrapper=None, query_template=N
         curl --data "" http://localhost:8880/something
 
     """
-    _no_slashes(path)
+    _check_path(path)
     def method_dispatcher_wrapper(func):
         # Have to handle a missing docstring here as otherwise
         # the registry will try to get it from the dispatcher.
@@ -559,7 +724,10 @@ def method_dispatcher(service_id, path=None, wsgi_wrapper=None, query_template=N
         if pth is None:
             pth = func.__name__
         dispatcher = service_method_dispatcher(pth, wsgi_wrapper)
-        registry.register_service(service_id, pth, dispatcher, doc)
+        handler = dispatcher
+        if compress:
+            handler = compression.compress(dispatcher)
+        registry.register_service(service_id, pth, handler, doc)
         return service_dispatcher_decorator(dispatcher)
     return method_dispatcher_wrapper
 
@@ -598,10 +766,12 @@ class service_dispatcher_decorator(object):
                 # of tools which might access 'environ' directly, and
                 # I want to be consistent with the simple* interfaces.
                 new_request(environ)
-                result = func(environ, start_response)
+                with tracing.span(environ, "call " + func.__name__):
+                    result = func(environ, start_response)
                 
                 # You need to make sure you sent the correct content-type!
-                result, ctype, clength = convert_body(result, None, encoding, writer)
+                with tracing.span(environ, "convert_body"):
+                    result, ctype, clength = convert_body(result, None, encoding, writer)
                 return result
 
             #For purposes of inspection (not a good idea to change these otherwise you'll lose sync with the values closed over)
@@ -625,13 +795,17 @@ class service_dispatcher_decorator(object):
             @functools.wraps(func)
             def simple_method_wrapper(environ, start_response):
                 try:
-                    args, kwargs = _get_function_args(environ, allow_repeated_args)
+                    with tracing.span(environ, "get_function_args"):
+                        args, kwargs = _get_function_args(environ, allow_repeated_args)
                 except _HTTPError, err:
                     return err.make_wsgi_response(environ, start_response)
                 new_request(environ)
-                result = func(*args, **kwargs)
+                with tracing.span(environ, "call " + func.__name__):
+                    result = func(*args, **kwargs)
 
-                result, ctype, clength = convert_body(result, content_type, encoding, writer)
+                with tracing.span(environ, "convert_body"):
+                    result, ctype, clength = _convert_result(environ, result, content_type,
+                                                             encoding, writer)
                 send_headers(start_response, ctype, clength)
                 return result
 
@@ -649,8 +823,189 @@ class service_dispatcher_decorator(object):
     # ...
 
 # Install some built-in services
-@simple_service("GET", "http://purl.org/xml3k/akara/services/registry", "",
-                allow_repeated_args=False)
-def list_services(service=None):
-    return registry.list_services(ident=service) # XXX 'ident' or 'service' ?
 
+# The serialized registry documents in this process, which clients
+# and other Akara servers (see registry.register_services) poll.
+# (format, ident) -> (registry generation, body, ETag)
+_registry_documents = {}
+_MAX_REGISTRY_DOCUMENTS = 64
+
+def _registry_document(format, ident):
+    generation = registry.generation()
+    key = (format, ident)
+    cached = _registry_documents.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached
+    if format == "json":
+        body = json.dumps(registry.json_document(ident))
+    else:
+        body = registry.list_services(ident=ident).xml_encode(writers.lookup("xml"), "utf-8")
+    # A strong validator from the content, so every server process
+    # with the same services gives the same ETag
+    etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+    if len(_registry_documents) >= _MAX_REGISTRY_DOCUMENTS:
+        _registry_documents.clear()
+    cached = _registry_documents[key] = (generation, body, etag)
+    return cached
+
+def _not_modified(environ, etag, last_modified):
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        # This takes precedence over If-Modified-Since
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since is not None:
+        date = parsedate_tz(if_modified_since.split(";")[0])
+        if date is not None:
+            return int(last_modified) <= mktime_tz(date)
+    return False
+
+@service("http://purl.org/xml3k/akara/services/registry", "",
+         query_template="?service={service?}&format={format?}")
+def list_services(environ, start_response):
+    """List the registered services, or the ones with ident=service
+
+    Use format=json, or "Accept: application/json", for JSON. The
+    response has an ETag and a Last-Modified so clients can poll with
+    a conditional GET.
+    """
+    if environ.get("REQUEST_METHOD") != "GET":
+        return _HTTP405(["GET"]).make_wsgi_response(environ, start_response)
+    query = cgi.parse_qs(environ.get("QUERY_STRING", ""))
+    ident = query.get("service", [None])[0] # XXX 'ident' or 'service' ?
+    format = query.get("format", [None])[0]
+    if format is None:
+        if environ.get("HTTP_ACCEPT", "").startswith("application/json"):
+            format = "json"
+        else:
+            format = "xml"
+    if format not in ("xml", "json"):
+        start_response("400 Bad Request", [("Content-Type", "text/plain")])
+        return ["format must be 'xml' or 'json', not %r\n" % (format,)]
+
+    generation, body, etag = _registry_document(format, ident)
+    last_modified = registry.last_modified()
+    headers = [("ETag", etag),
+               ("Last-Modified", formatdate(last_modified, usegmt=True)),
+               ("Vary", "Accept")]
+    if _not_modified(environ, etag, last_modified):
+        start_response("304 Not Modified", headers)
+        return []
+    if format == "json":
+        content_type = "application/json"
+    else:
+        content_type = "application/xml"
+    headers.extend([("Content-Type", content_type), ("Content-Length", str(len(body)))])
+    start_response("200 OK", headers)
+    return [body]
+
+def _scoreboard_document(board, now):
+    document = tree.entity()
+    status = document.xml_append(tree.element(None, 'server-status'))
+    status.xml_attributes['master-pid'] = unicode(board.master_pid)
+    status.xml_attributes['uptime'] = u"%.0f" % (now - board.start_time,)
+    scaling = board.scaling()
+    if scaling["enabled"]:
+        E = status.xml_append(tree.element(None, 'scaling'))
+        for name in ("backlog", "target", "high_target", "spawned", "stopped"):
+            E.xml_attributes[name.replace("_", "-")] = unicode(scaling[name])
+        for name in ("arrival_rate", "arrival_rate_slow", "service_time"):
+            E.xml_attributes[name.replace("_", "-")] = u"%.6f" % (scaling[name],)
+    counts = {}
+    for slot in board.slots():
+        counts[slot["state"]] = counts.get(slot["state"], 0) + 1
+        E = status.xml_append(tree.element(None, 'server'))
+        for name in ("slot", "pid", "requests", "bytes"):
+            E.xml_attributes[name] = unicode(slot[name])
+        E.xml_attributes['state'] = unicode(slot["state_name"])
+        if slot["request_start"]:
+            request = E.xml_append(tree.element(None, 'request'))
+            request.xml_attributes['method'] = unicode(slot["method"], "latin1")
+            request.xml_attributes['mount-point'] = unicode(slot["mount_point"], "latin1")
+            request.xml_attributes['client'] = unicode(slot["client"], "latin1")
+            request.xml_attributes['bytes'] = unicode(slot["request_bytes"])
+            if slot["request_time"]:
+                duration = slot["request_time"]
+            else:
+                # Still in progress
+                duration = now - slot["request_start"]
+            request.xml_attributes['seconds'] = u"%.6f" % (duration,)
+    status.xml_attributes['busy'] = unicode(counts.get(scoreboard.BUSY, 0) +
+                                            counts.get(scoreboard.READING, 0))
+    status.xml_attributes['idle'] = unicode(counts.get(scoreboard.IDLE, 0))
+    return document
+
+@simple_service("GET", "http://purl.org/xml3k/akara/services/server-status",
+                "akara.server-status")
+def server_status():
+    "Report the state of each Akara server process, from the shared scoreboard"
+    if scoreboard.current is None:
+        from akara import response
+        response.code = httplib.SERVICE_UNAVAILABLE
+        return "There is no server scoreboard\n"
+    return _scoreboard_document(scoreboard.current, time.time())
+
+@simple_service("GET", "http://purl.org/xml3k/akara/services/stats",
+                "akara.stats", "application/json")
+def server_stats(format="json"):
+    """Report request counts, bytes and latencies for each mount point
+
+    The totals are across all of the Akara server processes. Use
+    format=prometheus for the Prometheus text format instead of JSON.
+    """
+    from akara import response
+    if stats.current is None:
+        response.code = httplib.SERVICE_UNAVAILABLE
+        response.add_header("Content-Type", "text/plain")
+        return "There are no server statistics\n"
+    report = stats.current.report()
+    if format == "prometheus":
+        response.add_header("Content-Type", "text/plain; version=0.0.4")
+        return stats.prometheus_text(report)
+    if format != "json":
+        response.code = httplib.BAD_REQUEST
+        response.add_header("Content-Type", "text/plain")
+        return "format must be 'json' or 'prometheus', not %r\n" % (format,)
+    document = stats.json_document(report)
+    document["uptime"] = time.time() - stats.current.start_time
+    return json.dumps(document)
+
+
+@simple_service("GET", "http://purl.org/xml3k/akara/services/profile",
+                "akara.profile", "application/json")
+def server_profile(mount_point=None):
+    """Download the cProfile results for a mount point
+
+    The profiles from all of the Akara server processes are merged
+    into one file which pstats.Stats() can read. Without a mount_point,
+    list the profiles and how many requests are still to be profiled.
+    """
+    from akara import response
+    profiler = profiling.current
+    if not isinstance(profiler, profiling.Profiler):
+        response.code = httplib.SERVICE_UNAVAILABLE
+        response.add_header("Content-Type", "text/plain")
+        return "Profiling is not available\n"
+    profile_dir = profiler.profile_dir
+    if mount_point is None:
+        remaining = {}
+        if profiler.control is not None:
+            for name, run, count in profiler.control.entries():
+                remaining[name] = count
+        found = profiling.list_profiles(profile_dir)
+        profiles = []
+        for name in sorted(set(remaining) | set(found) | profiler.mount_points):
+            run, processes = found.get(name, (None, 0))
+            profiles.append(dict(mount_point=name, run=run, processes=processes,
+                                 remaining=remaining.get(name, 0)))
+        return json.dumps({"profiles": profiles})
+    data = profiling.merged_profile(profile_dir, mount_point)
+    if data is None:
+        response.code = httplib.NOT_FOUND
+        response.add_header("Content-Type", "text/plain")
+        return "No profile for %r\n" % (mount_point,)
+    response.add_header("Content-Type", "application/octet-stream")
+    response.add_header("Content-Disposition",
+                        'attachment; filename="%s.prof"' % (mount_point or "root",))
+    return data
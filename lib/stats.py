@@ -0,0 +1,433 @@
+"""Shared-memory request statistics for the Akara server processes
+
+This is an internal module and should not be used by other libraries.
+
+For each mount point Akara counts the requests, the responses in each
+status class (1xx to 5xx), the body bytes sent and the time taken,
+with a histogram of the times. The master creates the table as a
+memory-mapped file (the "StatsFile" setting) before it forks any
+children, and the counts cover everything since the server started.
+
+Like the scoreboard (see akara.scoreboard) each child has its own
+region, one per scoreboard slot, and only that child writes to it,
+so the counters are updated with plain memory writes and no locking.
+A new child in a reused slot carries on from the counts its
+predecessor left behind. Readers add up every region.
+
+The mount points share one table of names. A child takes the file
+lock only the first time it sees a mount point, to find or add its
+entry. Requests which didn't reach a service (a 404, say) are counted
+under the mount point "-", as are any mount points past MAX_KEYS.
+
+Pipeline stages with a cache (see akara.pipeline) count their cache
+hits and misses in the entry for the pipeline's mount point and the
+stage's service ident. Those entries have no requests of their own.
+
+The histogram buckets are log-linear, as in HdrHistogram: four
+buckets for each power of two from 61 microseconds to 64 seconds, so
+any time is within 25% of its bucket's upper bound.
+
+"""
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = "AKST"
+VERSION = 2
+
+MAX_KEYS = 128
+OTHER_KEY = 0       # index of the "-" entry
+OTHER_MOUNT_POINT = "-"
+
+# Upper bounds, in seconds. The last bucket is for everything slower.
+BUCKET_BOUNDS = tuple([2.0 ** -14] +
+                      [2.0 ** e * (1 + (i + 1) / 4.0)
+                       for e in range(-14, 6) for i in range(4)])
+NUM_BUCKETS = len(BUCKET_BOUNDS) + 1
+
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+_HEADER = struct.Struct("=4sIIIIid")  # magic, version, num_slots, max keys,
+                                      # buckets, master pid, start time
+_KEY = struct.Struct("=64s192s")      # mount point, service ident
+_KEYS_OFFSET = _HEADER.size
+_SLOTS_OFFSET = _KEYS_OFFSET + _KEY.size * MAX_KEYS
+
+# The counters for one mount point in one slot
+_COUNTERS = struct.Struct("=QQQQQQQdQQ%dQ" % (NUM_BUCKETS,))
+_REQUESTS = 0
+_STATUS = 8
+_BYTES = 48
+_SECONDS = 56
+_CACHE_HITS = 64
+_CACHE_MISSES = 72
+_BUCKETS = 80
+_SLOT_SIZE = _COUNTERS.size * MAX_KEYS
+
+_Q = struct.Struct("=Q")
+_D = struct.Struct("=d")
+
+class Error(Exception):
+    pass
+
+class Stats(object):
+    """The per-mount-point request statistics, in a memory-mapped file
+
+    Use Stats.create() in the master and Stats.open() to read an
+    existing file from another process.
+    """
+    def __init__(self, filename, f, mm, num_slots):
+        self.filename = filename
+        self._file = f   # for the lock, in the writers
+        self._mm = mm
+        self.num_slots = num_slots
+
+    @classmethod
+    def create(cls, filename, num_slots):
+        # Built to the side then renamed into place, as with the
+        # scoreboard. Most of the file is never written, so leave
+        # it sparse.
+        size = _SLOTS_OFFSET + _SLOT_SIZE * num_slots
+        tmp_filename = "%s.%d" % (filename, os.getpid())
+        f = open(tmp_filename, "w+b")
+        try:
+            f.truncate(size)
+            mm = mmap.mmap(f.fileno(), size)
+        except:
+            f.close()
+            raise
+        _HEADER.pack_into(mm, 0, MAGIC, VERSION, num_slots, MAX_KEYS, NUM_BUCKETS,
+                          os.getpid(), time.time())
+        _KEY.pack_into(mm, _KEYS_OFFSET + _KEY.size * OTHER_KEY, OTHER_MOUNT_POINT, "")
+        os.rename(tmp_filename, filename)
+        return cls(filename, f, mm, num_slots)
+
+    @classmethod
+    def open(cls, filename):
+        f = open(filename, "rb")
+        try:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), err:
+                raise Error("Cannot map statistics file %r: %s" % (filename, err))
+        finally:
+            f.close()
+        if len(mm) < _HEADER.size:
+            raise Error("Statistics file %r is too small" % (filename,))
+        (magic, version, num_slots, max_keys, num_buckets,
+         master_pid, start_time) = _HEADER.unpack_from(mm, 0)
+        if (magic != MAGIC or version != VERSION or
+            max_keys != MAX_KEYS or num_buckets != NUM_BUCKETS):
+            raise Error("File %r is not a version %d Akara statistics file" %
+                        (filename, VERSION))
+        if len(mm) < _SLOTS_OFFSET + _SLOT_SIZE * num_slots:
+            raise Error("Statistics file %r is truncated" % (filename,))
+        return cls(filename, None, mm, num_slots)
+
+    def close(self):
+        self._mm.close()
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def start_time(self):
+        return _HEADER.unpack_from(self._mm, 0)[6]
+
+    def _key(self, index):
+        mount_point, ident = _KEY.unpack_from(self._mm, _KEYS_OFFSET + _KEY.size * index)
+        return mount_point.rstrip("\0"), ident.rstrip("\0")
+
+    ## Used by the writers
+
+    def key_index(self, mount_point, ident):
+        "Find or add the table entry for a mount point"
+        mount_point = mount_point[:64]
+        ident = (ident or "")[:192]
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            for i in range(MAX_KEYS):
+                key = self._key(i)
+                if key == (mount_point, ident):
+                    return i
+                if not key[0]:
+                    _KEY.pack_into(self._mm, _KEYS_OFFSET + _KEY.size * i,
+                                   mount_point, ident)
+                    return i
+            return OTHER_KEY
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def add(self, slot, index, status, nbytes, seconds):
+        mm = self._mm
+        offset = _SLOTS_OFFSET + _SLOT_SIZE * slot + _COUNTERS.size * index
+        unpack, pack = _Q.unpack_from, _Q.pack_into
+        pos = offset + _REQUESTS
+        pack(mm, pos, unpack(mm, pos)[0] + 1)
+        status_class = status // 100
+        if 1 <= status_class <= 5:
+            pos = offset + _STATUS + 8 * (status_class - 1)
+            pack(mm, pos, unpack(mm, pos)[0] + 1)
+        pos = offset + _BYTES
+        pack(mm, pos, unpack(mm, pos)[0] + nbytes)
+        pos = offset + _SECONDS
+        _D.pack_into(mm, pos, _D.unpack_from(mm, pos)[0] + seconds)
+        pos = offset + _BUCKETS + 8 * bisect.bisect_left(BUCKET_BOUNDS, seconds)
+        pack(mm, pos, unpack(mm, pos)[0] + 1)
+
+    def add_cache(self, slot, index, hit):
+        mm = self._mm
+        pos = (_SLOTS_OFFSET + _SLOT_SIZE * slot + _COUNTERS.size * index +
+               (_CACHE_HITS if hit else _CACHE_MISSES))
+        _Q.pack_into(mm, pos, _Q.unpack_from(mm, pos)[0] + 1)
+
+    ## Used by readers
+
+    def report(self):
+        """Return the totals for each mount point, as a list of dictionaries
+
+        Each has the "mount_point", the service "ident", "requests",
+        "status" (a dictionary from "1xx" etc. to a count), "bytes",
+        "seconds" (the total time), "buckets" (the histogram
+        counts, one for each of BUCKET_BOUNDS and one more), and the
+        pipeline stage "cache_hits" and "cache_misses".
+        """
+        keys = []
+        for i in range(MAX_KEYS):
+            mount_point, ident = self._key(i)
+            if not mount_point:
+                break
+            keys.append((i, mount_point, ident))
+
+        result = []
+        mm = self._mm
+        unpack = _COUNTERS.unpack_from
+        for i, mount_point, ident in keys:
+            totals = None
+            for slot in range(self.num_slots):
+                values = unpack(mm, _SLOTS_OFFSET + _SLOT_SIZE * slot + _COUNTERS.size * i)
+                if not (values[0] or values[8] or values[9]):
+                    continue
+                if totals is None:
+                    totals = list(values)
+                else:
+                    totals = [a + b for (a, b) in zip(totals, values)]
+            if totals is None:
+                continue
+            result.append(dict(mount_point = mount_point,
+                               ident = ident or None,
+                               requests = totals[0],
+                               status = dict(zip(STATUS_CLASSES, totals[1:6])),
+                               bytes = totals[6],
+                               seconds = totals[7],
+                               cache_hits = totals[8],
+                               cache_misses = totals[9],
+                               buckets = totals[10:]))
+        return result
+
+
+def quantile(buckets, q):
+    """Estimate the 'q' quantile (0.0 to 1.0) from the histogram counts
+
+    Returns the upper bound of the bucket it falls in, or None if
+    there are no counts. The overflow bucket gives infinity.
+    """
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    count = 0
+    for bound, n in zip(BUCKET_BOUNDS, buckets):
+        count += n
+        if count >= rank:
+            return bound
+    return float("inf")
+
+def by_service(report):
+    "Combine the report() entries for each service ident"
+    services = {}
+    for entry in report:
+        if entry["ident"] is None or not entry["requests"]:
+            continue
+        total = services.get(entry["ident"])
+        if total is None:
+            total = services[entry["ident"]] = dict(
+                ident = entry["ident"], mount_points = [],
+                requests = 0, bytes = 0, seconds = 0.0, buckets = [0] * NUM_BUCKETS,
+                status = dict.fromkeys(STATUS_CLASSES, 0))
+        total["mount_points"].append(entry["mount_point"])
+        for name in ("requests", "bytes", "seconds"):
+            total[name] += entry[name]
+        for name in STATUS_CLASSES:
+            total["status"][name] += entry["status"][name]
+        total["buckets"] = [a + b for (a, b) in zip(total["buckets"], entry["buckets"])]
+    return sorted(services.values(), key=lambda total: total["ident"])
+
+
+def _summary(entry):
+    summary = dict((name, entry[name]) for name in ("requests", "status", "bytes", "seconds"))
+    if entry["requests"]:
+        summary["mean_seconds"] = entry["seconds"] / entry["requests"]
+    else:
+        summary["mean_seconds"] = None
+    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        value = quantile(entry["buckets"], q)
+        if value == float("inf"):
+            value = None   # Not valid JSON
+        summary[name + "_seconds"] = value
+    summary["histogram"] = [[bound, n] for (bound, n) in zip(BUCKET_BOUNDS, entry["buckets"]) if n]
+    if entry["buckets"][-1]:
+        summary["histogram"].append([None, entry["buckets"][-1]])
+    return summary
+
+def json_document(report):
+    """Return the statistics as a JSON-compatible dictionary
+
+    Latencies are in seconds. The "histogram" lists the non-empty
+    buckets as [upper bound, count], with None for the overflow bucket.
+    The "pipeline_cache" has the cache hits and misses of the pipeline
+    stages, by the pipeline's mount point and the stage's ident.
+    """
+    mount_points = []
+    for entry in report:
+        if not entry["requests"]:
+            continue
+        summary = _summary(entry)
+        summary["mount_point"] = entry["mount_point"]
+        summary["ident"] = entry["ident"]
+        mount_points.append(summary)
+    services = []
+    for entry in by_service(report):
+        summary = _summary(entry)
+        summary["ident"] = entry["ident"]
+        summary["mount_points"] = entry["mount_points"]
+        services.append(summary)
+    pipeline_cache = []
+    for entry in report:
+        if entry["cache_hits"] or entry["cache_misses"]:
+            pipeline_cache.append(dict(mount_point = entry["mount_point"],
+                                       ident = entry["ident"],
+                                       hits = entry["cache_hits"],
+                                       misses = entry["cache_misses"]))
+    return {"mount_points": mount_points, "services": services,
+            "pipeline_cache": pipeline_cache}
+
+def _label(value):
+    return (value or "").replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def prometheus_text(report):
+    "Return the statistics in the Prometheus text exposition format"
+    lines = []
+    def metric(name, kind, help):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+    def labels(entry):
+        return 'mount_point="%s",ident="%s"' % (_label(entry["mount_point"]),
+                                               _label(entry["ident"]))
+
+    cached = [entry for entry in report if entry["cache_hits"] or entry["cache_misses"]]
+    report = [entry for entry in report if entry["requests"]]
+    metric("akara_requests_total", "counter", "Requests handled, by status class")
+    for entry in report:
+        for name in STATUS_CLASSES:
+            lines.append('akara_requests_total{%s,status="%s"} %d' %
+                         (labels(entry), name, entry["status"][name]))
+    metric("akara_response_bytes_total", "counter", "Response body bytes sent")
+    for entry in report:
+        lines.append("akara_response_bytes_total{%s} %d" % (labels(entry), entry["bytes"]))
+    metric("akara_request_duration_seconds", "histogram", "Time taken to handle a request")
+    for entry in report:
+        count = 0
+        for bound, n in zip(BUCKET_BOUNDS + ("+Inf",), entry["buckets"]):
+            count += n
+            if bound != "+Inf":
+                bound = repr(bound)
+            lines.append('akara_request_duration_seconds_bucket{%s,le="%s"} %d' %
+                         (labels(entry), bound, count))
+        lines.append("akara_request_duration_seconds_sum{%s} %r" %
+                     (labels(entry), entry["seconds"]))
+        lines.append("akara_request_duration_seconds_count{%s} %d" %
+                     (labels(entry), entry["requests"]))
+    if cached:
+        metric("akara_pipeline_cache_total", "counter", "Pipeline stage cache lookups")
+        for entry in cached:
+            lines.append('akara_pipeline_cache_total{%s,result="hit"} %d' %
+                         (labels(entry), entry["cache_hits"]))
+            lines.append('akara_pipeline_cache_total{%s,result="miss"} %d' %
+                         (labels(entry), entry["cache_misses"]))
+    return "\n".join(lines) + "\n"
+
+
+class StatsWriter(object):
+    "Used by a child process to add to its own region"
+    def __init__(self, stats, slot):
+        self.stats = stats
+        self.slot = slot
+        self._keys = {}
+
+    def record(self, mount_point, ident, status, nbytes, seconds):
+        """Count a finished request
+
+        'mount_point' is None if the request didn't get to a service.
+        'status' is the numeric HTTP status, or 0 if there wasn't one.
+        """
+        if mount_point is None:
+            index = OTHER_KEY
+        else:
+            index = self._keys.get((mount_point, ident))
+            if index is None:
+                index = self._keys[(mount_point, ident)] = \
+                        self.stats.key_index(mount_point, ident)
+        self.stats.add(self.slot, index, status, nbytes, seconds)
+
+    def record_cache(self, mount_point, ident, hit):
+        "Count a cache hit or miss for the 'ident' stage of the pipeline at 'mount_point'"
+        index = self._keys.get((mount_point, ident))
+        if index is None:
+            index = self._keys[(mount_point, ident)] = \
+                    self.stats.key_index(mount_point, ident)
+        self.stats.add_cache(self.slot, index, hit)
+
+class SharedStatsWriter(StatsWriter):
+    "Used by a child process which handles several connections at once"
+    def __init__(self, stats, slot):
+        StatsWriter.__init__(self, stats, slot)
+        self._lock = threading.Lock()
+
+    def record(self, mount_point, ident, status, nbytes, seconds):
+        self._lock.acquire()
+        try:
+            StatsWriter.record(self, mount_point, ident, status, nbytes, seconds)
+        finally:
+            self._lock.release()
+
+    def record_cache(self, mount_point, ident, hit):
+        self._lock.acquire()
+        try:
+            StatsWriter.record_cache(self, mount_point, ident, hit)
+        finally:
+            self._lock.release()
+
+class _NullStatsWriter(object):
+    "Used when there are no statistics (e.g., outside of the server)"
+    def record(self, mount_point, ident, status, nbytes, seconds):
+        pass
+    def record_cache(self, mount_point, ident, hit):
+        pass
+
+
+# The statistics for this server, and the writer for this process.
+# The master sets 'current' and each child gets it through fork().
+current = None
+current_writer = _NullStatsWriter()
+
+def attach_child(slot, shared=False):
+    "Called in a newly forked child to use the given scoreboard slot"
+    global current_writer
+    if shared:
+        current_writer = SharedStatsWriter(current, slot)
+    else:
+        current_writer = StatsWriter(current, slot)
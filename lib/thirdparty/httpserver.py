@@ -14,8 +14,8 @@ if pyOpenSSL is installed, it also provides SSL capabilities.
 # @@: add in protection against HTTP/1.0 clients who claim to
 #     be 1.1 but do not send a Content-Length
 
-# @@: add support for chunked encoding, this is not a 1.1 server
-#     till this is completed.
+# @@: add support for chunked request bodies, this is not a 1.1 server
+#     till this is completed. (Akara sends chunked responses.)
 
 import atexit
 import traceback
@@ -24,6 +24,9 @@ import posixpath
 import time
 import thread
 import os
+import errno
+import select
+import stat
 from itertools import count
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from SocketServer import ThreadingMixIn
@@ -37,7 +40,18 @@ except ImportError:
     # Not available, probably no ctypes
     killthread = None
 
-__all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'serve']
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # (Akara) pysendfile, for Python versions before 3.3
+        from sendfile import sendfile
+    except ImportError:
+        # Not available; file_wrapper responses are read and written
+        sendfile = None
+
+__all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'serve',
+           'FileWrapper']
 __version__ = "0.5"
 
 # Copied from paste.util.converters for use in Akara.
@@ -99,6 +113,73 @@ class ContinueHook(object):
         self._ContinueFile_send()
         return self._ContinueFile_rfile.readlines(sizehint)
 
+class FileWrapper(object):
+    """
+    The ``wsgi.file_wrapper`` (see PEP 333). Iterating over it reads
+    ``blksize`` blocks from ``filelike``.
+
+    (Akara) ``offset`` and ``length`` select part of the file; by
+    default it's sent from the current position to the end. When
+    ``filelike`` is a regular file the handler copies it to the
+    client with sendfile(), if available, instead of iterating.
+    """
+    def __init__(self, filelike, blksize=8192, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        if self.offset is not None:
+            self.filelike.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize
+            if remaining is not None:
+                size = min(size, remaining)
+            data = self.filelike.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def fileno(self):
+        """
+        Return the file descriptor if ``filelike`` is a regular
+        file, otherwise None.
+        """
+        try:
+            fd = self.filelike.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return None
+        return fd
+
+    def start_offset(self):
+        """
+        Return the offset of the first byte to send. Only for
+        regular files.
+        """
+        if self.offset is not None:
+            return self.offset
+        return self.filelike.tell()
+
+    def size(self):
+        """
+        Return the number of bytes to send, or None if that isn't
+        known.
+        """
+        if self.length is not None:
+            return self.length
+        fd = self.fileno()
+        if fd is None:
+            return None
+        return max(os.fstat(fd).st_size - self.start_offset(), 0)
+
 class WSGIHandlerMixin:
     """
     WSGI mix-in for HTTPRequestHandler
@@ -146,25 +227,119 @@ class WSGIHandlerMixin:
             code, message = status.split(" ", 1)
             self.send_response(int(code), message)
             #
-            # HTTP/1.1 compliance; either send Content-Length or
-            # signal that the connection is being closed.
+            # HTTP/1.1 compliance; either send Content-Length,
+            # use chunked encoding, or signal that the connection
+            # is being closed.
             #
             send_close = True
+            has_connection = False
             for (k, v) in  headers:
                 lk = k.lower()
                 if 'content-length' == lk:
                     send_close = False
                 if 'connection' == lk:
+                    has_connection = True
                     if 'close' == v.lower():
                         self.close_connection = 1
                         send_close = False
                 self.send_header(k, v)
-            if send_close:
+            if code in ('204', '304'):
+                # (Akara) These never have a body, so there's no need
+                # to close the connection to mark its end
+                send_close = False
+            if send_close and self._can_send_chunked(code):
+                # (Akara) Stream a response of unknown length without
+                # giving up the persistent connection
+                self.wsgi_chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            elif send_close:
                 self.close_connection = 1
                 self.send_header('Connection', 'close')
+            elif self.close_connection and not has_connection:
+                # (Akara) The handler already decided to close the
+                # connection, e.g. at the end of a keep-alive series.
+                # Tell the client so it doesn't pipeline more requests.
+                self.send_header('Connection', 'close')
 
             self.end_headers()
-        self.wfile.write(chunk)
+        if self.wsgi_chunked:
+            if chunk:
+                # An empty chunk would end the body
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+        else:
+            self.wfile.write(chunk)
+
+    def wsgi_write_file(self, wrapper):
+        """
+        (Akara) Write the file from a ``FileWrapper``. Send headers if
+        they have not already been sent. Regular files are copied
+        straight to the socket with sendfile(), when possible.
+        """
+        fd = wrapper.fileno()
+        if (sendfile is None or fd is None or
+            not hasattr(self.connection, 'fileno') or
+            hasattr(self.connection, 'get_context')):
+            for chunk in wrapper:
+                self.wsgi_write_chunk(chunk)
+            return
+        offset = wrapper.start_offset()
+        length = wrapper.size()
+        self.wsgi_write_chunk('')
+        if not length:
+            return
+        if self.wsgi_chunked:
+            self.wfile.write('%x\r\n' % length)
+        self.wfile.flush()
+        if self.wsgi_sendfile(fd, offset, length) < length:
+            # The file is shorter than promised. Closing the
+            # connection is the only way to tell the client.
+            self.close_connection = 1
+            self.wsgi_chunked = False
+            return
+        if self.wsgi_chunked:
+            self.wfile.write('\r\n')
+
+    def wsgi_sendfile(self, fd, offset, length):
+        """
+        (Akara) Copy ``length`` bytes of ``fd``, starting at
+        ``offset``, to the client. Return the number of bytes sent,
+        which is less than ``length`` only at the end of the file.
+        """
+        out = self.connection.fileno()
+        sent = 0
+        while sent < length:
+            try:
+                n = sendfile(out, fd, offset + sent, length - sent)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.EAGAIN:
+                    # The socket has a timeout, so it's non-blocking
+                    select.select([], [out], [])
+                    continue
+                raise socket.error(err.errno, err.strerror)
+            if not n:
+                break
+            sent += n
+        return sent
+
+    def _can_send_chunked(self, code):
+        # (Akara) Only for an HTTP/1.1 client on a connection which
+        # stays open, and only if the response can have a body
+        return (not self.close_connection and
+                self.request_version == 'HTTP/1.1' and
+                self.protocol_version == 'HTTP/1.1' and
+                self.command != 'HEAD' and
+                not code.startswith('1') and code not in ('204', '304'))
+
+    def wsgi_write_end(self):
+        """
+        Finish the response body. This sends the last chunk of a
+        chunked response.
+        """
+        if self.wsgi_chunked:
+            self.wsgi_chunked = False
+            self.wfile.write('0\r\n\r\n')
 
     def wsgi_start_response(self, status, response_headers, exc_info=None):
         if exc_info:
@@ -205,7 +380,7 @@ class WSGIHandlerMixin:
         rfile = self.rfile
         if 'HTTP/1.1' == self.protocol_version and \
                 '100-continue' == self.headers.get('Expect','').lower():
-            rfile = ContinueHook(rfile, self.wfile.write)
+            rfile = ContinueHook(rfile, self._write_continue)
         else:
             # We can put in the protection to keep from over-reading the
             # file
@@ -225,6 +400,7 @@ class WSGIHandlerMixin:
                ,'wsgi.url_scheme': 'http'
                ,'wsgi.input': rfile
                ,'wsgi.errors': sys.stderr
+               ,'wsgi.file_wrapper': FileWrapper
                ,'wsgi.multithread': True
                ,'wsgi.multiprocess': False
                ,'wsgi.run_once': False
@@ -265,11 +441,7 @@ class WSGIHandlerMixin:
             self.server.thread_pool.worker_tracker[thread.get_ident()][1] = self.wsgi_environ
             self.wsgi_environ['paste.httpserver.thread_pool'] = self.server.thread_pool
 
-        for k, v in self.headers.items():
-            key = 'HTTP_' + k.replace("-","_").upper()
-            if key in ('HTTP_CONTENT_TYPE','HTTP_CONTENT_LENGTH'):
-                continue
-            self.wsgi_environ[key] = ','.join(self.headers.getheaders(k))
+        self.wsgi_environ.update(self.wsgi_header_environ())
 
         if hasattr(self.connection,'get_context'):
             self.wsgi_environ['wsgi.url_scheme'] = 'https'
@@ -284,6 +456,26 @@ class WSGIHandlerMixin:
 
         self.wsgi_curr_headers = None
         self.wsgi_headers_sent = False
+        self.wsgi_chunked = False
+
+    def wsgi_header_environ(self):
+        """
+        (Akara) Return the ``HTTP_*`` environ entries for the request
+        headers.
+        """
+        environ = {}
+        for k, v in self.headers.items():
+            key = 'HTTP_' + k.replace("-","_").upper()
+            if key in ('HTTP_CONTENT_TYPE','HTTP_CONTENT_LENGTH'):
+                continue
+            environ[key] = ','.join(self.headers.getheaders(k))
+        return environ
+
+    def _write_continue(self, data):
+        # (Akara) The client waits for this before sending the body,
+        # so don't leave it in an output buffer
+        self.wfile.write(data)
+        self.wfile.flush()
 
     def wsgi_connection_drop(self, exce, environ=None):
         """
@@ -303,10 +495,14 @@ class WSGIHandlerMixin:
             result = self.server.wsgi_application(self.wsgi_environ,
                                                   self.wsgi_start_response)
             try:
-                for chunk in result:
-                    self.wsgi_write_chunk(chunk)
+                if isinstance(result, FileWrapper):
+                    self.wsgi_write_file(result)
+                else:
+                    for chunk in result:
+                        self.wsgi_write_chunk(chunk)
                 if not self.wsgi_headers_sent:
                     self.wsgi_write_chunk('')
+                self.wsgi_write_end()
             finally:
                 if hasattr(result,'close'):
                     result.close()
@@ -322,6 +518,10 @@ class WSGIHandlerMixin:
                     [('Content-type', 'text/plain'),
                      ('Content-length', str(len(error_msg)))])
                 self.wsgi_write_chunk("Internal Server Error\n")
+            elif self.wsgi_chunked:
+                # (Akara) Don't end the body; the client must not
+                # take the partial response as complete
+                self.close_connection = 1
             raise
 
 
@@ -64,6 +64,78 @@ if not hasattr(socket, 'socketpair'):
 
     socket.socketpair = socketpair
 
+class SelectPoller(object):
+    """
+    Wait for readable child sockets using select.select(). This is the
+    portable fallback; every call passes the whole set of descriptors
+    to the kernel.
+    """
+    def __init__(self):
+        self._fds = set()
+
+    def register(self, fd):
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+
+    def poll(self, timeout=None):
+        """Return a list of readable file descriptors."""
+        try:
+            r, w, e = select.select(list(self._fds), [], [], timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+        return r
+
+    def close(self):
+        self._fds.clear()
+
+class EpollPoller(object):
+    """
+    Wait for readable child sockets using epoll (Linux). Descriptors
+    are registered once, when the child is spawned, so the cost of a
+    wakeup depends on the number of ready children and not on the
+    total number of children.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        setCloseOnExec(self._epoll)
+
+    def register(self, fd):
+        self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError), e:
+            # Already gone (e.g. the kernel dropped it on close)
+            if e[0] not in (errno.ENOENT, errno.EBADF):
+                raise
+
+    def poll(self, timeout=None):
+        """Return a list of readable file descriptors."""
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except (IOError, OSError), e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+        # EPOLLHUP and EPOLLERR are reported as readable so the
+        # caller's recv() sees the EOF and marks the child as dead.
+        return [fd for (fd, event) in events]
+
+    def close(self):
+        self._epoll.close()
+
+if hasattr(select, 'epoll'):
+    DefaultPoller = EpollPoller
+else:
+    DefaultPoller = SelectPoller
+
 class PreforkServer(object):
     """
     A preforked server model conceptually similar to Apache httpd(2). At
@@ -83,7 +155,20 @@ class PreforkServer(object):
     jobClass should have a run() method (taking no arguments) that does
     the actual work. When run() returns, the request is considered
     complete and the child process moves to idle state.
+
+    The master waits on the child sockets using pollerClass, which is
+    EpollPoller where available and SelectPoller otherwise.
+
+    Each child belongs to a generation. On SIGHUP the master calls
+    _reload(). By default that ends the main loop, and run() returns
+    True. A subclass may instead call _newGeneration(), after which
+    the master keeps running and replaces the children one by one.
+    Children of the old generation are told to exit (their socket is
+    closed, so they finish their current job first) as new ones report
+    that they are ready by sending their first status byte.
     """
+    pollerClass = DefaultPoller
+
     def __init__(self, minSpare=1, maxSpare=5, maxChildren=50,
                  maxRequests=0, jobClass=None, jobArgs=()):
         self._minSpare = minSpare
@@ -98,10 +183,21 @@ class PreforkServer(object):
         # individidual child and 'avail' is whether or not the child is
         # free to process requests.
         self._children = {}
+        # Reverse map from the fileno of each child socket to its pid.
+        # Only children with an open socket are present.
+        self._fdToPid = {}
+        self._poller = None
 
         self._children_to_purge = []
         self._last_purge = 0
 
+        # Children are spawned into the current generation. When there
+        # are children from earlier generations, _rollTarget is the
+        # number of new children needed to replace them.
+        self._generation = 0
+        self._rollTarget = 0
+        self._reloadRequested = False
+
         if minSpare < 1:
             raise ValueError("minSpare must be at least 1!")
         if maxSpare < minSpare:
@@ -116,6 +212,7 @@ class PreforkServer(object):
         # Set up signal handlers.
         self._keepGoing = True
         self._hupReceived = False
+        self._reloadRequested = False
         self._installSignalHandlers()
 
         # Don't want operations on main socket to block.
@@ -123,22 +220,33 @@ class PreforkServer(object):
 
         # Set close-on-exec
         setCloseOnExec(sock)
-        
+
+        self._poller = self.pollerClass()
+
         # Main loop.
         while self._keepGoing:
+            if self._reloadRequested:
+                self._reloadRequested = False
+                self._reload()
+                if not self._keepGoing:
+                    break
+
             # Maintain minimum number of children. Note that we are checking
             # the absolute number of children, not the number of "available"
             # children. We explicitly test against _maxSpare to maintain
             # an *optimistic* absolute minimum. The number of children will
-            # always be in the range [_maxSpare, _maxChildren].
-            while len(self._children) < self._maxSpare:
+            # always be in the range [_maxSpare, _maxChildren]. During a
+            # rolling restart only the current generation counts, and
+            # it grows to replace the old one.
+            minimum = self._maxSpare
+            if self._rollTarget:
+                minimum = max(minimum, self._rollTarget)
+            while (self._countCurrent() < minimum and
+                   len(self._children) < self._maxChildren):
                 if not self._spawnChild(sock): break
 
-            # Wait on any socket activity from live children.
-            r = [x['file'] for x in self._children.values()
-                 if x['file'] is not None]
-
-            if len(r) == len(self._children) and not self._children_to_purge:
+            if (len(self._fdToPid) == len(self._children) and
+                not self._children_to_purge and not self._rollTarget):
                 timeout = None
             else:
                 # There are dead children that need to be reaped, ensure
@@ -146,86 +254,162 @@ class PreforkServer(object):
                 # children that need to die.
                 timeout = 2
 
-            w = []
-            if (time.time() > self._last_purge + 10):
-                w = [x for x in self._children_to_purge if x.fileno() != -1]
-            try:
-                r, w, e = select.select(r, w, [], timeout)
-            except select.error, e:
-                if e[0] != errno.EINTR:
-                    raise
+            # Wait on any socket activity from live children.
+            r = self._poller.poll(self._pollTimeout(timeout))
 
             # Scan child sockets and tend to those that need attention.
-            for child in r:
-                # Receive status byte.
+            for fd in r:
+                pid = self._fdToPid.get(fd)
+                if pid is None:
+                    # Closed earlier in this pass.
+                    continue
+                d = self._children[pid]
+                # Receive status bytes. Only the most recent one matters.
                 try:
-                    state = child.recv(1)
+                    state = d['file'].recv(64)
                 except socket.error, e:
                     if e[0] in (errno.EAGAIN, errno.EINTR):
                         # Guess it really didn't need attention?
                         continue
                     raise
-                # Try to match it with a child. (Do we need a reverse map?)
-                for pid,d in self._children.items():
-                    if child is d['file']:
-                        if state:
-                            # Set availability status accordingly.
-                            self._children[pid]['avail'] = state != '\x00'
-                        else:
-                            # Didn't receive anything. Child is most likely
-                            # dead.
-                            d = self._children[pid]
-                            d['file'].close()
-                            d['file'] = None
-                            d['avail'] = False
-
-            for child in w:
+                if state:
+                    # Set availability status accordingly.
+                    d['avail'] = state[-1] != '\x00'
+                    d['ready'] = True
+                else:
+                    # Didn't receive anything. Child is most likely
+                    # dead.
+                    self._closeChild(pid)
+
+            if (self._children_to_purge and
+                time.time() > self._last_purge + 10):
                 # purging child
-                child.send('bye, bye')
-                del self._children_to_purge[self._children_to_purge.index(child)]
+                pid = self._children_to_purge.pop(0)
+                d = self._children.get(pid)
+                if d is not None and d['file'] is not None:
+                    try:
+                        d['file'].send('bye, bye')
+                    except socket.error:
+                        pass
+                    self._closeChild(pid)
                 self._last_purge = time.time()
 
-                # Try to match it with a child. (Do we need a reverse map?)
-                for pid,d in self._children.items():
-                    if child is d['file']:
-                        d['file'].close()
-                        d['file'] = None
-                        d['avail'] = False
-                break
-
             # Reap children.
             self._reapChildren()
 
-            # See who and how many children are available.
-            availList = filter(lambda x: x[1]['avail'], self._children.items())
-            avail = len(availList)
-
-            if avail < self._minSpare:
-                # Need to spawn more children.
-                while avail < self._minSpare and \
-                      len(self._children) < self._maxChildren:
-                    if not self._spawnChild(sock): break
-                    avail += 1
-            elif avail > self._maxSpare:
-                # Too many spares, kill off the extras.
-                pids = [x[0] for x in availList]
-                pids.sort()
-                pids = pids[self._maxSpare:]
-                for pid in pids:
-                    d = self._children[pid]
-                    d['file'].close()
-                    d['file'] = None
-                    d['avail'] = False
+            if self._rollTarget:
+                self._retireOldChildren()
+
+            self._adjustChildren(sock)
 
         # Clean up all child processes.
         self._cleanupChildren()
 
+        self._poller.close()
+        self._poller = None
+
         # Restore signal handlers.
         self._restoreSignalHandlers()
 
         # Return bool based on whether or not SIGHUP was received.
         return self._hupReceived
 
+    def _pollTimeout(self, timeout):
+        """
+        Return the timeout for waiting on the children. 'timeout' is
+        what the main loop needs (None means no timeout). Override to
+        wake up more often.
+        """
+        return timeout
+
+    def _adjustChildren(self, sock):
+        """
+        Start or stop children to keep between minSpare and maxSpare
+        of them available. Called each time through the main loop.
+        """
+        # See who and how many children are available. Children
+        # from an earlier generation are on their way out.
+        availList = [x for x in self._children.items()
+                     if x[1]['avail'] and x[1]['generation'] == self._generation]
+        avail = len(availList)
+
+        if avail < self._minSpare:
+            # Need to spawn more children.
+            while avail < self._minSpare and \
+                  len(self._children) < self._maxChildren:
+                if not self._spawnChild(sock): break
+                avail += 1
+        elif avail > self._maxSpare:
+            # Too many spares, kill off the extras.
+            pids = [x[0] for x in availList]
+            pids.sort()
+            pids = pids[self._maxSpare:]
+            for pid in pids:
+                self._closeChild(pid)
+
+    def _countCurrent(self):
+        """Return the number of children in the current generation."""
+        n = 0
+        for d in self._children.values():
+            if d['generation'] == self._generation:
+                n += 1
+        return n
+
+    def _newGeneration(self):
+        """
+        Start a rolling restart. Children spawned from now on are in a
+        new generation, and the current children are retired as the new
+        ones become ready.
+        """
+        if not self._rollTarget:
+            # Replace as many children as are running now. (If a
+            # rolling restart is already under way, keep its target.)
+            self._rollTarget = len([d for d in self._children.values()
+                                    if d['file'] is not None])
+        self._rollTarget = min(max(self._rollTarget, self._maxSpare),
+                               self._maxChildren)
+        self._generation += 1
+
+    def _retireOldChildren(self):
+        """
+        Close the sockets to old-generation children, keeping enough of
+        them to cover for the new children which aren't ready yet.
+        """
+        old = [(not d['avail'], pid) for (pid, d) in self._children.items()
+               if d['generation'] != self._generation and d['file'] is not None]
+        if not old:
+            # Done. Normal spare management takes over from here.
+            self._rollTarget = 0
+            return
+        new = [d for d in self._children.values()
+               if d['generation'] == self._generation]
+        ready = len([d for d in new if d['ready']])
+        keep = max(self._rollTarget - ready, 0)
+        if (keep and ready == len(new) and
+            len(self._children) >= self._maxChildren):
+            # Old children fill the remaining slots, so no more new
+            # ones can start. Give up one to make room.
+            keep -= 1
+        # Idle children go first
+        old.sort()
+        for busy, pid in old[:max(len(old) - keep, 0)]:
+            self._closeChild(pid)
+
+    def _closeChild(self, pid):
+        """
+        Close the socket to a child, which tells an idle child to exit.
+        The child is still tracked (as unavailable) until it is reaped.
+        """
+        d = self._children[pid]
+        if d['file'] is not None:
+            fd = d['file'].fileno()
+            del self._fdToPid[fd]
+            if self._poller is not None:
+                self._poller.unregister(fd)
+            d['file'].close()
+            d['file'] = None
+        d['avail'] = False
+
     def _cleanupChildren(self):
         """
         Closes all child sockets (letting those that are available know
@@ -236,10 +420,9 @@ class PreforkServer(object):
         """
         # Let all children know it's time to go.
         for pid,d in self._children.items():
-            if d['file'] is not None:
-                d['file'].close()
-                d['file'] = None
-            if not d['avail']:
+            avail = d['avail']
+            self._closeChild(pid)
+            if not avail:
                 # Child is unavailable. SIGINT it.
                 try:
                     os.kill(pid, signal.SIGINT)
@@ -264,6 +447,7 @@ class PreforkServer(object):
                     break
             if self._children.has_key(pid):
                 del self._children[pid]
+                self._childExited(pid)
 
         signal.signal(signal.SIGALRM, oldSIGALRM)
 
@@ -274,6 +458,7 @@ class PreforkServer(object):
             except OSError, e:
                 if e[0] != errno.ESRCH:
                     raise
+            self._childExited(pid)
 
     def _reapChildren(self):
         """Cleans up self._children whenever children die."""
@@ -287,10 +472,9 @@ class PreforkServer(object):
             if pid <= 0:
                 break
             if self._children.has_key(pid): # Sanity check.
-                if self._children[pid]['file'] is not None:
-                    self._children[pid]['file'].close()
-                    self._children[pid]['file'] = None
+                self._closeChild(pid)
                 del self._children[pid]
+                self._childExited(pid)
 
     def _spawnChild(self, sock):
         """
@@ -322,6 +506,10 @@ class PreforkServer(object):
                       if x['file'] is not None]:
                 f.close()
             self._children = {}
+            self._fdToPid = {}
+            if self._poller is not None:
+                self._poller.close()
+                self._poller = None
             try:
                 # Enter main loop.
                 self._child(sock, parent)
@@ -334,8 +522,32 @@ class PreforkServer(object):
             d = self._children[pid] = {}
             d['file'] = child
             d['avail'] = True
+            d['ready'] = False
+            d['generation'] = self._generation
+            fd = child.fileno()
+            self._fdToPid[fd] = pid
+            if self._poller is not None:
+                self._poller.register(fd)
+            self._childSpawned(pid)
             return True
 
+    def _reload(self):
+        """
+        Called in the main loop after a SIGHUP. The default stops the
+        main loop so run() returns True. Override to call
+        _newGeneration() for a rolling restart instead.
+        """
+        self._keepGoing = False
+        self._hupReceived = True
+
+    def _childSpawned(self, pid):
+        """Override to track new children. Called in the parent."""
+        pass
+
+    def _childExited(self, pid):
+        """Override to track children which have exited. Called in the parent."""
+        pass
+
     def _isClientAllowed(self, addr):
         """Override to provide access control."""
         return True
@@ -417,8 +629,8 @@ class PreforkServer(object):
     # Signal handlers
 
     def _hupHandler(self, signum, frame):
-        self._keepGoing = False
-        self._hupReceived = True
+        # Handled in the main loop, by _reload()
+        self._reloadRequested = True
 
     def _intHandler(self, signum, frame):
         self._keepGoing = False
@@ -428,7 +640,7 @@ class PreforkServer(object):
         pass
 
     def _usr1Handler(self, signum, frame):
-        self._children_to_purge = [x['file'] for x in self._children.values()
+        self._children_to_purge = [pid for (pid, x) in self._children.items()
                                    if x['file'] is not None]
 
     def _installSignalHandlers(self):
@@ -0,0 +1,61 @@
+"""Module attributes with a separate value in each thread
+
+This is an internal module and should not be used by other libraries.
+
+akara.request and akara.response hold the data for the HTTP request
+being handled. Extension modules use them as plain module attributes,
+as in "request.environ" and "response.code = 404". That's fine when a
+process handles one request at a time, but when it handles several
+at once (the "ThreadsPerServer" setting) each thread needs its own
+values.
+
+install() replaces a module in sys.modules with an instance of a
+ModuleType subclass where the named attributes are properties stored
+in a threading.local(). The rest of the module is unchanged, and
+existing code like "from akara import response" keeps working.
+
+Functions in the original module see the original globals, not the
+per-thread values. They need to go through the replacement module
+(the return value of install()) instead.
+
+"""
+import sys
+import threading
+import types
+
+def _local_property(name, default_factory):
+    def get_value(self):
+        local = self._akara_local
+        try:
+            return local.__dict__[name]
+        except KeyError:
+            value = local.__dict__[name] = default_factory()
+            return value
+    def set_value(self, value):
+        self._akara_local.__dict__[name] = value
+    return property(get_value, set_value)
+
+
+def install(module_name, defaults):
+    """Make some of the attributes of module 'module_name' thread-local
+
+    'defaults' is a dictionary mapping each attribute name to a
+    function which returns the initial value of that attribute in a
+    new thread. Returns the replacement module.
+    """
+    module = sys.modules[module_name]
+    properties = {}
+    for name, default_factory in defaults.items():
+        properties[name] = _local_property(name, default_factory)
+    klass = type("ThreadLocalModule", (types.ModuleType,), properties)
+
+    new_module = klass(module_name, module.__doc__)
+    for name, value in module.__dict__.items():
+        if name not in defaults:
+            new_module.__dict__[name] = value
+    new_module._akara_local = threading.local()
+    # Python 2 sets a module's globals to None when the module object
+    # is deleted. Keep the original alive since its functions use them.
+    new_module._akara_module = module
+    sys.modules[module_name] = new_module
+    return new_module
@@ -0,0 +1,158 @@
+"""Per-request tracing
+
+A trace is a timeline of one request: reading and parsing it, finding
+the service, getting the function arguments, calling the function,
+converting the result to bytes, any notify_before/notify_after
+services, each pipeline stage, and writing the response to the socket.
+Each step is a "span" with a start time and a duration.
+
+Tracing is off by default. With "TraceSampleRate" set (0.0 to 1.0)
+that fraction of the requests is traced, and with "TraceHeader" set
+(for example to "X-Akara-Trace") a request with that header is always
+traced. The traces go to "TraceFile" in the Trace Event format used by
+chrome://tracing and Perfetto: a JSON array of complete ("X") events.
+Each request gets its own row (the "tid" is a per-process request
+number) and the "pid" is the server process. The array is never
+closed; the format allows that, so every process can append to the
+same file.
+
+The current trace is in environ["akara.trace"], which the pipeline
+stages and the notify services get with their copy of the environ.
+Services can add their own spans:
+
+    from akara import request, tracing
+
+    with tracing.span(request.environ, "fetch the feed", url=url):
+        ...
+
+When the request isn't being traced, span() costs a dictionary lookup.
+
+"""
+import fcntl
+import itertools
+import os
+import random
+import time
+
+from akara import logger
+from amara.thirdparty import json
+
+__all__ = ("span", "add_span")
+
+_trace_file = None
+_sample_rate = 0.0
+_header = None
+_trace_numbers = itertools.count(1)
+
+def configure(settings):
+    "Set up tracing from the server settings"
+    global _trace_file, _sample_rate, _header
+    _trace_file = settings.get("trace_file")
+    _sample_rate = settings.get("trace_sample_rate", 0.0)
+    _header = settings.get("trace_header")
+
+def start(headers, start_time=None):
+    """Return a new Trace if this request should be traced, else None
+
+    'headers' are the request headers.
+    """
+    if not _trace_file:
+        return None
+    if _header is not None:
+        value = headers.get(_header)
+        if value is not None:
+            if value.strip() in ("", "0"):
+                return None
+            return Trace(start_time)
+    if _sample_rate and random.random() < _sample_rate:
+        return Trace(start_time)
+    return None
+
+
+class Trace(object):
+    "The spans for one request"
+    def __init__(self, start_time=None):
+        if start_time is None:
+            start_time = time.time()
+        self.start_time = start_time
+        self.pid = os.getpid()
+        self.tid = _trace_numbers.next()
+        self.events = []
+
+    def add(self, name, start, end, cat="akara", **args):
+        "Add a span which ran from 'start' to 'end' (from time.time())"
+        event = {"name": name, "cat": cat, "ph": "X",
+                 "ts": int(start * 1000000), "dur": int((end - start) * 1000000),
+                 "pid": self.pid, "tid": self.tid}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def span(self, name, cat="akara", **args):
+        return _Span(self, name, cat, args)
+
+    def finish(self, name, **args):
+        "Add the span for the whole request and write the trace"
+        self.add(name, self.start_time, time.time(), "request", **args)
+        # Sort so a parent comes before the spans inside it
+        self.events.sort(key=lambda event: (event["ts"], -event["dur"]))
+        data = "".join(json.dumps(event) + ",\n" for event in self.events)
+        try:
+            _append(_trace_file, data)
+        except (IOError, OSError), err:
+            logger.error("Cannot write to the trace file %r: %s" % (_trace_file, err))
+
+def _append(filename, data):
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        if os.fstat(fd).st_size == 0:
+            # The first writer starts the JSON array. The lock is
+            # released when the file is closed.
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                data = "[\n" + data
+        # Written all at once, so traces from different processes
+        # don't get mixed up
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class _Span(object):
+    def __init__(self, trace, name, cat, args):
+        self.trace = trace
+        self.name = name
+        self.cat = cat
+        self.args = args
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.time(), self.cat, **self.args)
+        return False
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_null_span = _NullSpan()
+
+def span(environ, name, cat="akara", **args):
+    """Time a 'with' block as part of the request's trace, if it has one
+
+    'args' are extra details for the trace viewer.
+    """
+    trace = environ.get("akara.trace")
+    if trace is None:
+        return _null_span
+    return trace.span(name, cat, **args)
+
+def add_span(environ, name, start, end, cat="akara", **args):
+    "Add a span which has already finished, if the request has a trace"
+    trace = environ.get("akara.trace")
+    if trace is not None:
+        trace.add(name, start, end, cat, **args)
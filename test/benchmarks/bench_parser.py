@@ -0,0 +1,91 @@
+"""Compare Akara's request parser with BaseHTTPRequestHandler's
+
+Each run parses the same request over and over, the way a server
+process does: read the request line, parse_request(), then build the
+WSGI environ with wsgi_setup(). There are no sockets, so this is the
+most one child could parse per second, not a server benchmark.
+
+"paste" is paste's WSGIHandler, which uses BaseHTTPRequestHandler's
+parse_request() and mimetools.Message. "akara" is AkaraWSGIHandler.
+
+Usage:
+    python bench_parser.py [--requests 20000] [--headers 0,10,30]
+
+--headers is the number of extra headers added to a typical browser
+request (which already has 8).
+"""
+
+import sys
+import time
+import new
+import optparse
+from cStringIO import StringIO
+
+from akara.thirdparty import httpserver
+from akara.multiprocess_http import AkaraWSGIHandler
+
+REQUEST = (
+    "GET /akara.services?service=http%3A//purl.org/xml3k/akara/services/registry HTTP/1.1\r\n"
+    "Host: localhost:8880\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Language: en-US,en;q=0.5\r\n"
+    "Accept-Encoding: gzip, deflate\r\n"
+    "Connection: keep-alive\r\n"
+    "Cookie: session=0123456789abcdef; theme=dark\r\n"
+    "Cache-Control: max-age=0\r\n"
+    )
+
+
+class Server(object):
+    server_address = ("localhost", 8880)
+
+class Connection(object):
+    pass
+
+
+def make_request(num_headers):
+    extra = "".join("X-Extra-Header-%d: value %d\r\n" % (i, i)
+                    for i in range(num_headers))
+    return REQUEST + extra + "\r\n"
+
+def bench(handler_class, request, num_requests):
+    # Skip __init__, which would handle a whole connection
+    handler = new.instance(handler_class)
+    handler.server = Server()
+    handler.connection = Connection()
+    handler.client_address = ("127.0.0.1", 12345)
+    handler.wfile = StringIO()
+
+    t1 = time.time()
+    for i in xrange(num_requests):
+        handler.rfile = StringIO(request)
+        handler.raw_requestline = handler.rfile.readline()
+        if not handler.parse_request():
+            raise AssertionError(handler.wfile.getvalue())
+        handler.wsgi_setup()
+    return time.time() - t1
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--requests", type="int", default=20000,
+                      help="number of requests to parse per run")
+    parser.add_option("--headers", default="0,10,30",
+                      help="comma separated list of extra header counts")
+    options, args = parser.parse_args(argv)
+
+    handlers = [("paste", httpserver.WSGIHandler), ("akara", AkaraWSGIHandler)]
+
+    print "%8s %-8s %10s %10s" % ("headers", "parser", "req/s", "us/req")
+    for num_headers in [int(x) for x in options.headers.split(",")]:
+        request = make_request(num_headers)
+        for name, handler_class in handlers:
+            elapsed = bench(handler_class, request, options.requests)
+            print "%8d %-8s %10.0f %10.1f" % (
+                num_headers + 8, name, options.requests / elapsed,
+                elapsed / options.requests * 1e6)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Measure the overhead of a pipeline for each of its stages
+
+Pipelines of trivial stages, like the "service:rot13" and
+"service:base64-encode" test services, alternating between the two.
+
+"direct" calls the stages' handlers one after the other, with only
+what a stage needs: a new environ and a StringIO of the input.
+"compiled" runs the pipeline as the server does, after the first
+request has compiled it (see Pipeline.compile). "uncompiled" throws
+away the compiled plan before each request, which is about what every
+request used to cost: looking up each stage's service and working out
+its environ again.
+
+The "overhead" is the time per stage over "direct".
+
+Usage:
+    python bench_pipeline.py [--requests 20000] [--stages 2,4,8] [--size 100]
+"""
+
+import sys
+import time
+import optparse
+from cStringIO import StringIO
+
+from akara import registry, pipeline
+from akara.services import simple_service
+
+
+@simple_service("POST", "bench:rot13", "bench_rot13")
+def rot13(query_body, query_content_type):
+    return query_body.encode("rot13")
+
+@simple_service("POST", "bench:base64-encode", "bench_base64_encode")
+def base64_encode(query_body, query_content_type):
+    return query_body.encode("base64")
+
+IDENTS = ["bench:rot13", "bench:base64-encode"]
+
+def make_environ(body):
+    return {"REQUEST_METHOD": "POST", "SCRIPT_NAME": "", "PATH_INFO": "/",
+            "QUERY_STRING": "", "CONTENT_TYPE": "text/plain",
+            "CONTENT_LENGTH": str(len(body)), "wsgi.input": StringIO(body),
+            "SERVER_NAME": "localhost", "SERVER_PORT": "8880",
+            "SERVER_PROTOCOL": "HTTP/1.1", "HTTP_HOST": "localhost:8880",
+            "HTTP_USER_AGENT": "bench_pipeline", "HTTP_ACCEPT": "*/*",
+            "REMOTE_ADDR": "127.0.0.1", "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http", "wsgi.multithread": False,
+            "wsgi.multiprocess": True, "wsgi.run_once": False}
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+def direct(handlers, body):
+    for handler in handlers:
+        body = "".join(handler(make_environ(body), start_response))
+    return body
+
+def run(app, body):
+    return "".join(app(make_environ(body), start_response))
+
+def bench(func, num_requests):
+    t1 = time.time()
+    for i in xrange(num_requests):
+        func()
+    return time.time() - t1
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--requests", type="int", default=20000,
+                      help="number of requests per run")
+    parser.add_option("--stages", default="2,4,8",
+                      help="comma separated list of pipeline lengths")
+    parser.add_option("--size", type="int", default=100,
+                      help="number of bytes in the request body")
+    options, args = parser.parse_args(argv)
+    # Quiet "Created new mount point" messages
+    registry.logger.setLevel(40)
+
+    body = "Andrew" * (options.size // 6 + 1)
+    body = body[:options.size]
+    print "%6s %-11s %10s %11s %14s" % ("stages", "run", "requests/s", "us/request",
+                                         "overhead us/stage")
+    for num_stages in [int(x) for x in options.stages.split(",")]:
+        idents = [IDENTS[i % 2] for i in range(num_stages)]
+        handlers = [registry.get_a_service_by_id(ident).handler for ident in idents]
+        app = pipeline.Pipeline("bench:pipeline%d" % (num_stages,), "bench_pipeline",
+                                [pipeline.Stage(ident) for ident in idents], "")
+        def uncompiled():
+            app._plan = (None, None)
+            return run(app, body)
+        cases = [
+            ("direct", lambda: direct(handlers, body)),
+            ("compiled", lambda: run(app, body)),
+            ("uncompiled", uncompiled),
+            ]
+        expected = direct(handlers, body)
+        baseline = None
+        for name, func in cases:
+            assert func() == expected, name
+            elapsed = bench(func, options.requests)
+            per_request = elapsed / options.requests * 1e6
+            if baseline is None:
+                baseline = per_request
+                overhead = "-"
+            else:
+                overhead = "%.2f" % ((per_request - baseline) / num_stages,)
+            print "%6d %-11s %10.0f %11.2f %14s" % (
+                num_stages, name, options.requests / elapsed, per_request, overhead)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Compare child start-up time and memory with and without PreloadModules
+
+For each mode this forks a number of children the way the Akara
+master does. Without preloading, each child imports the extension
+modules itself. With preloading, the parent imports them once before
+forking. Each child reports how long after the fork it was ready to
+handle requests, and its resident and private (unshared) memory, from
+/proc/self/smaps (so this is Linux only).
+
+Usage:
+    python bench_preload.py [-f akara.conf] [--children 10]
+
+Without -f, a configuration with a few of the larger demo modules is
+used.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import optparse
+
+DEFAULT_MODULES = [
+    "akara.demo.akara_tests",
+    "akara.demo.oaitools",
+    "akara.demo.markuptools",
+    "akara.demo.xslt",
+    "akara.demo.atomtools",
+    ]
+
+DEFAULT_CONFIG = """
+class Akara:
+    ConfigRoot = %(config_root)r
+    LogLevel = "ERROR"
+
+MODULES = %(modules)r
+"""
+
+def memory_kb():
+    "Return (rss, private) in kB for this process"
+    rss = private = 0
+    for line in open("/proc/self/smaps"):
+        if line.startswith("Rss:"):
+            rss += int(line.split()[1])
+        elif line.startswith(("Private_Clean:", "Private_Dirty:")):
+            private += int(line.split()[1])
+    return rss, private
+
+def worker(config_filename, preload, num_children):
+    # Set things up like akara.run does
+    import gc
+    import akara
+    from akara import read_config, run, multiprocess_http
+    settings, config = read_config.read_config(config_filename)
+    akara.raw_config = config
+    run.set_global_config(settings)
+
+    if preload:
+        multiprocess_http._init_modules(config)
+        gc.collect()
+
+    r_pipe, w_pipe = os.pipe()
+    pids = []
+    for i in range(num_children):
+        t1 = time.time()
+        pid = os.fork()
+        if not pid:
+            os.close(r_pipe)
+            if not preload:
+                multiprocess_http._init_modules(config)
+            multiprocess_http._run_post_fork_hooks()
+            elapsed = time.time() - t1
+            rss, private = memory_kb()
+            os.write(w_pipe, "%f %d %d\n" % (elapsed, rss, private))
+            # Stay alive so the shared pages stay shared
+            time.sleep(60)
+            os._exit(0)
+        pids.append(pid)
+        # Don't let the children compete with each other for the CPU
+        f = os.fdopen(os.dup(r_pipe))
+        line = f.readline()
+        f.close()
+        sys.stdout.write(line)
+    for pid in pids:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+
+def run_mode(config_filename, preload, num_children):
+    args = [sys.executable, __file__, "--worker", "-f", config_filename,
+            "--children", str(num_children)]
+    if preload:
+        args.append("--preload")
+    output = subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
+    results = [map(float, line.split()) for line in output.splitlines()]
+    n = float(len(results))
+    return (sum(x[0] for x in results)/n,
+            sum(x[1] for x in results)/n,
+            sum(x[2] for x in results)/n)
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("-f", dest="config_filename", default=None)
+    parser.add_option("--children", type="int", default=10)
+    parser.add_option("--worker", action="store_true")
+    parser.add_option("--preload", action="store_true")
+    options, args = parser.parse_args()
+
+    if options.worker:
+        worker(options.config_filename, options.preload, options.children)
+        return
+
+    config_filename = options.config_filename
+    tmpdir = None
+    if config_filename is None:
+        tmpdir = tempfile.mkdtemp(prefix="akara_bench_")
+        config_filename = os.path.join(tmpdir, "akara.conf")
+        f = open(config_filename, "w")
+        f.write(DEFAULT_CONFIG % dict(config_root=tmpdir, modules=DEFAULT_MODULES))
+        f.close()
+    try:
+        print "%-16s %14s %12s %14s" % ("mode", "spawn (ms)", "RSS (kB)", "private (kB)")
+        for preload in (False, True):
+            spawn, rss, private = run_mode(config_filename, preload, options.children)
+            print "%-16s %14.1f %12.0f %14.0f" % (
+                ["PreloadModules=0", "PreloadModules=1"][preload],
+                spawn*1000, rss, private)
+    finally:
+        if tmpdir is not None:
+            import shutil
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
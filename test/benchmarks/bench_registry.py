@@ -0,0 +1,93 @@
+"""Compare the service registry's lookups with the old linear scans
+
+The registry used to find a service by ident by scanning a copy of
+every registered service, which pipelines, notify_before/notify_after,
+akara.caching and get_service_url() do on each request. Now it keeps
+an ident index, and it finds a request's service in a trie of path
+segments.
+
+"scan" is the old get_a_service_by_id(). "index" is the new one.
+"dict" is the old dispatch: shift_path_info() then a dictionary lookup
+of the mount point. "trie" is the new one: Registry.match() then
+shift_path_info(). "trie 3-seg" is Registry.match() alone on a
+three-segment templated path.
+
+Usage:
+    python bench_registry.py [--lookups 100000] [--services 10,1000,10000]
+"""
+
+import sys
+import time
+import optparse
+
+from akara import registry
+from wsgiref.util import shift_path_info
+
+
+def handler(environ, start_response):
+    "A service"
+
+def make_registry(num_services):
+    reg = registry.Registry()
+    for i in range(num_services):
+        reg.register_service("http://example.com/service/%d" % (i,), "service%d" % (i,),
+                             handler)
+    reg.register_service("http://example.com/page", "wiki/pages/{name}", handler)
+    return reg
+
+def scan(reg, ident):
+    # The old get_a_service_by_id()
+    for path, service in reg._registered_services.items():
+        if service.ident == ident:
+            return service
+    return None
+
+def bench(func, num_lookups):
+    t1 = time.time()
+    for i in xrange(num_lookups):
+        func()
+    return time.time() - t1
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--lookups", type="int", default=100000,
+                      help="number of lookups per run")
+    parser.add_option("--services", default="10,1000,10000",
+                      help="comma separated list of registered service counts")
+    options, args = parser.parse_args(argv)
+    # Quiet "Created new mount point" messages
+    registry.logger.setLevel(40)
+
+    print "%9s %-12s %10s %10s" % ("services", "lookup", "lookups/s", "us/lookup")
+    for num_services in [int(x) for x in options.services.split(",")]:
+        reg = make_registry(num_services)
+        ident = "http://example.com/service/%d" % (num_services // 2,)
+        mount_point = "service%d" % (num_services // 2,)
+        path_info = "/" + mount_point + "/extra"
+        def old_dispatch():
+            environ = {"SCRIPT_NAME": "", "PATH_INFO": path_info}
+            return reg.get_service(shift_path_info(environ))
+        def new_dispatch():
+            # As AkaraWSGIDispatcher does it
+            environ = {"SCRIPT_NAME": "", "PATH_INFO": path_info}
+            route = reg.match(path_info)
+            for i in range(route[1]):
+                shift_path_info(environ)
+            return route
+        cases = [
+            ("scan", lambda: scan(reg, ident), options.lookups // max(num_services // 100, 1)),
+            ("index", lambda: reg.get_service_by_id(ident), options.lookups),
+            ("dict", old_dispatch, options.lookups),
+            ("trie", new_dispatch, options.lookups),
+            ("trie 3-seg", lambda: reg.match("/wiki/pages/Home"), options.lookups),
+            ]
+        for name, func, num_lookups in cases:
+            assert func() is not None
+            elapsed = bench(func, num_lookups)
+            print "%9d %-12s %10.0f %10.2f" % (
+                num_services, name, num_lookups / elapsed, elapsed / num_lookups * 1e6)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Compare the shared listening socket with ReusePort as the child count grows
+
+Each run starts a PreforkServer master with a fixed number of children
+(MinSpare = MaxSpare = MaxChildren) and makes a number of short
+connections to it, one at a time. With the shared socket every idle
+child wakes up for each connection and all but one of them get EAGAIN
+from accept(). With ReusePort each child listens on its own socket and
+the kernel hands the connection to one of them.
+
+For each run this reports the connection rate, the accept latency
+(from the start of connect() until the child's first byte arrives)
+and the context switches made by the children, read from
+/proc/<pid>/status before and after the connections. That is Linux
+only, as is SO_REUSEPORT load balancing.
+
+Usage:
+    python bench_reuseport.py [--children 10,50,150] [--requests 2000]
+"""
+
+import os
+import sys
+import socket
+import signal
+import time
+import optparse
+
+from akara.thirdparty import preforkserver
+from akara.multiprocess_http import _reuse_port_listener
+
+
+class NullJob(object):
+    def __init__(self, sock, addr):
+        self._sock = sock
+    def run(self):
+        self._sock.sendall("x")
+        self._sock.close()
+
+
+class ReusePortServer(preforkserver.PreforkServer):
+    def _child(self, sock, parent):
+        preforkserver.PreforkServer._child(self, _reuse_port_listener(sock), parent)
+
+
+def child_pids(master_pid):
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            f = open("/proc/%s/stat" % name)
+            try:
+                stat = f.read()
+            finally:
+                f.close()
+        except IOError:
+            continue
+        # The command name is in parentheses and may contain spaces
+        ppid = int(stat[stat.rindex(")")+2:].split()[1])
+        if ppid == master_pid:
+            pids.append(int(name))
+    return pids
+
+def context_switches(pids):
+    total = 0
+    for pid in pids:
+        try:
+            f = open("/proc/%d/status" % pid)
+            try:
+                for line in f:
+                    # voluntary_ctxt_switches and nonvoluntary_ctxt_switches
+                    if "ctxt_switches:" in line:
+                        total += int(line.split()[1])
+            finally:
+                f.close()
+        except IOError:
+            pass
+    return total
+
+
+def bench(num_children, num_requests, reuse_port):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # As in akara.run: bind, but only the children listen
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("localhost", 0))
+    if not reuse_port:
+        sock.listen(socket.SOMAXCONN)
+    address = sock.getsockname()
+
+    pid = os.fork()
+    if not pid:
+        if reuse_port:
+            server_class = ReusePortServer
+        else:
+            server_class = preforkserver.PreforkServer
+        server = server_class(minSpare=num_children, maxSpare=num_children,
+                              maxChildren=num_children, jobClass=NullJob)
+        server.run(sock)
+        os._exit(0)
+
+    # Give the children a chance to start
+    time.sleep(0.5 + num_children * 0.01)
+    pids = child_pids(pid)
+    switches = context_switches(pids)
+
+    latencies = []
+    t1 = time.time()
+    for i in range(num_requests):
+        t = time.time()
+        client = socket.create_connection(address)
+        client.recv(1)
+        latencies.append(time.time() - t)
+        client.close()
+    elapsed = time.time() - t1
+    switches = context_switches(pids) - switches
+
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    sock.close()
+
+    latencies.sort()
+    return (elapsed, switches,
+            latencies[len(latencies)//2], latencies[len(latencies)*99//100])
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--children", default="10,50,150",
+                      help="comma separated list of child counts")
+    parser.add_option("--requests", type="int", default=2000,
+                      help="number of connections per run")
+    options, args = parser.parse_args(argv)
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("SO_REUSEPORT is not supported on this platform")
+
+    print "%8s %-10s %8s %10s %10s %14s" % (
+        "children", "listener", "req/s", "p50(us)", "p99(us)", "ctxsw/req")
+    for num_children in [int(x) for x in options.children.split(",")]:
+        for reuse_port in (False, True):
+            elapsed, switches, p50, p99 = bench(num_children, options.requests,
+                                                reuse_port)
+            print "%8d %-10s %8.0f %10.0f %10.0f %14.1f" % (
+                num_children, reuse_port and "reuseport" or "shared",
+                options.requests / elapsed, p50 * 1e6, p99 * 1e6,
+                float(switches) / options.requests)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
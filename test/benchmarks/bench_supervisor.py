@@ -0,0 +1,103 @@
+"""Measure the CPU used by the PreforkServer master as the child count grows
+
+Each run starts a PreforkServer master with a fixed number of children
+(MinSpare = MaxSpare = MaxChildren), makes a number of short
+connections to it, shuts it down, and reports the master's own user
+and system CPU time. Every request makes the handling child send two
+status bytes to the master, so this is mostly a measure of the
+supervisor loop.
+
+Usage:
+    python bench_supervisor.py [--children 10,50,150] [--requests 2000]
+
+Each child count is run with both the select() and the epoll()
+supervisor (when epoll is available).
+"""
+
+import os
+import sys
+import socket
+import signal
+import time
+import optparse
+import resource
+
+from akara.thirdparty import preforkserver
+
+
+class NullJob(object):
+    def __init__(self, sock, addr):
+        self._sock = sock
+    def run(self):
+        self._sock.sendall("x")
+        self._sock.close()
+
+
+def run_master(sock, num_children, poller_class, w_pipe):
+    # In the forked master process
+    class Server(preforkserver.PreforkServer):
+        pollerClass = poller_class
+    server = Server(minSpare=num_children, maxSpare=num_children,
+                    maxChildren=num_children, jobClass=NullJob)
+    server.run(sock)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    os.write(w_pipe, "%f %f\n" % (usage.ru_utime, usage.ru_stime))
+    os._exit(0)
+
+
+def bench(num_children, num_requests, poller_class):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("localhost", 0))
+    sock.listen(socket.SOMAXCONN)
+    address = sock.getsockname()
+
+    r_pipe, w_pipe = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r_pipe)
+        run_master(sock, num_children, poller_class, w_pipe)
+    os.close(w_pipe)
+    sock.close()
+
+    # Give the children a chance to start
+    time.sleep(0.5 + num_children * 0.01)
+
+    t1 = time.time()
+    for i in range(num_requests):
+        client = socket.create_connection(address)
+        client.recv(1)
+        client.close()
+    elapsed = time.time() - t1
+
+    os.kill(pid, signal.SIGTERM)
+    user, system = map(float, os.read(r_pipe, 100).split())
+    os.close(r_pipe)
+    os.waitpid(pid, 0)
+    return elapsed, user, system
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--children", default="10,50,150",
+                      help="comma separated list of child counts")
+    parser.add_option("--requests", type="int", default=2000,
+                      help="number of connections per run")
+    options, args = parser.parse_args(argv)
+
+    pollers = [preforkserver.SelectPoller]
+    if hasattr(preforkserver, "EpollPoller") and hasattr(preforkserver.select, "epoll"):
+        pollers.append(preforkserver.EpollPoller)
+
+    print "%8s %-14s %8s %9s %9s %12s" % (
+        "children", "poller", "req/s", "user(s)", "sys(s)", "cpu/req(us)")
+    for num_children in [int(x) for x in options.children.split(",")]:
+        for poller_class in pollers:
+            elapsed, user, system = bench(num_children, options.requests, poller_class)
+            print "%8d %-14s %8.0f %9.3f %9.3f %12.1f" % (
+                num_children, poller_class.__name__, options.requests / elapsed,
+                user, system, (user + system) / options.requests * 1e6)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -66,6 +66,9 @@ class Akara:
   # These affect test_server.py:test_restart
   MaxServers = 5
   MaxRequestsPerServer = 5
+  # These affect test_server.py:test_keep_alive*
+  KeepAliveTimeout = 2
+  MaxKeepAliveRequests = 4
 
 class atomtools:
   entries = %(atom_entries)r
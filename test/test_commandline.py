@@ -135,6 +135,43 @@ def test_status(config_root):
     # I can't think of a good way to test for a PID which does not exist.
     # That test is done manually.
 
+@tmpdir
+def test_print_scoreboard(config_root):
+    from akara import scoreboard
+    filename = os.path.join(config_root, "akara.scoreboard")
+    capture = CaptureStdout()
+    with capture:
+        commandline.print_scoreboard(filename)
+    assert "Cannot read the scoreboard" in capture.content, capture.content
+
+    board = scoreboard.Scoreboard.create(filename, 4)
+    try:
+        for pid in (1234, 5678):
+            board.assign_slot(board.reserve_slot(), pid)
+        writer = scoreboard.SlotWriter(board, 1)
+        writer.idle()
+        writer.begin_request("GET", "10.0.0.1")
+        writer.set_mount_point("moinrest")
+        writer.add_bytes(100)
+        writer.add_bytes(23)
+        board.set_scaling(dict(enabled=1, arrival_rate=12.5, arrival_rate_slow=3.25,
+                               service_time=0.125, backlog=2, target=6, high_target=9,
+                               spawned=10, stopped=4))
+    finally:
+        board.close()
+
+    with capture:
+        commandline.print_scoreboard(filename)
+    assert "Server processes: 2 (1 busy, 1 starting)" in capture.content, capture.content
+    lines = capture.content.splitlines()
+    assert lines[-2].split()[:3] == ["0", "1234", "starting"], lines[-2]
+    fields = lines[-1].split()
+    assert fields[1:5] == ["5678", "busy", "0", "123"], fields
+    assert fields[-3:] == ["GET", "/moinrest", "(10.0.0.1)"], fields
+    assert ("Predictive scaling: 12.50 requests/s (3.25 long term), 0.125s/request, backlog 2"
+            in capture.content), capture.content
+    assert "target 6-9 servers, 10 started, 4 stopped" in capture.content, capture.content
+
 @tmpdir
 def test_setup_config_file(config_root):
     config_file = os.path.join(config_root, "blah_subdir", "test_config.ini")
@@ -38,3 +38,489 @@ def test_convert_body_list():
     result = convert_body(["blah"], None, None, None)
     assert result == (["blah"], "text/plain", None), result
 
+
+# akara.request and akara.response must be per-thread when a server
+# handles requests in several threads (the ThreadsPerServer setting)
+def test_request_response_are_thread_local():
+    import threading
+    from akara import request, response, services
+
+    services.new_request({"PATH_INFO": "/main"})
+    response.add_header("X-Thread", "main")
+
+    seen = []
+    def other_thread():
+        seen.append( (request.environ, response.code, list(response.headers)) )
+        services.new_request({"PATH_INFO": "/other"})
+        response.code = "404 Not Found"
+        response.add_header("X-Thread", "other")
+        seen.append( (request.environ, response.code, list(response.headers)) )
+    t = threading.Thread(target=other_thread)
+    t.start()
+    t.join()
+
+    assert seen == [(None, None, []),
+                    ({"PATH_INFO": "/other"}, "404 Not Found", [("X-Thread", "other")])], seen
+    assert request.environ == {"PATH_INFO": "/main"}, request.environ
+    assert response.code == "200 OK", response.code
+    assert response.headers == [("X-Thread", "main")], response.headers
+
+def test_run_blocking():
+    from akara.eventloop import run_blocking, Return
+    def returns_value():
+        raise Return(5)
+        yield None
+    assert run_blocking(returns_value()) == 5
+
+    def returns_nothing():
+        if 0:
+            yield None
+    assert run_blocking(returns_nothing()) is None
+
+    # Yielding something other than an http_request() raises a
+    # TypeError in the generator
+    def bad_yield():
+        try:
+            yield "http://example.com/"
+        except TypeError, err:
+            raise Return(str(err))
+    msg = run_blocking(bad_yield())
+    assert "must yield an http_request()" in msg, msg
+
+def test_scaler():
+    from akara import scaling
+    scaler = scaling.Scaler(min_spare=2, max_spare=4, max_servers=50)
+    # Quiet: nothing to do with the minimum number of servers
+    scaler.update(0.0, 0, 0.0)
+    assert scaler.decide(0.0, 4, 4, 0) == 0
+
+    # A burst of 100 requests/second at 0.2 seconds each keeps about
+    # 20 servers busy. Start them all before they are needed.
+    for t in range(1, 11):
+        scaler.update(float(t), 100*t, 20.0*t)
+    assert 95 < scaler.arrival_rate <= 100, scaler.arrival_rate
+    assert abs(scaler.service_time - 0.2) < 1e-6, scaler.service_time
+    n = scaler.decide(10.0, 4, 4, 0)
+    assert n == scaler.target - 4, (n, scaler.target)
+    assert 20 <= scaler.target <= 22, scaler.target
+
+    # Connections waiting in the listen queue need servers too
+    target = scaler.target
+    scaler.decide(10.0, 4, 0, 10)
+    assert scaler.target == target + 10, (scaler.target, target)
+
+    # The load stops. Shrink one server at a time, and only after a while.
+    for t in range(11, 100):
+        scaler.update(float(t), 1000, 200.0)
+    assert scaler.decide(100.0, 30, 30, 0) == 0
+    assert scaler.decide(100.0 + scaling.SHRINK_DELAY, 30, 30, 0) == -1
+    assert scaler.decide(100.0 + scaling.SHRINK_DELAY, 29, 29, 0) == 0
+    # Unless the load comes back
+    assert scaler.decide(200.0, 29, 0, 0) > 0
+
+def test_reuse_port_listener():
+    import socket
+    if not hasattr(socket, "SO_REUSEPORT"):
+        return
+    from akara.multiprocess_http import _reuse_port_listener
+    # Set up the way akara.run does it: bound, but not listening
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("localhost", 0))
+    address = sock.getsockname()
+    listener = _reuse_port_listener(sock)
+    try:
+        assert listener.getsockname() == address, (listener.getsockname(), address)
+        client = socket.create_connection(address)
+        client.sendall("x")
+        import select
+        select.select([listener], [], [], 5)
+        conn, addr = listener.accept()
+        assert conn.recv(1) == "x"
+        conn.close()
+        client.close()
+    finally:
+        listener.close()
+
+def test_read_headers():
+    from cStringIO import StringIO
+    from akara.multiprocess_http import _read_headers, _HeaderError, MAX_REQUEST_HEADERS
+    f = StringIO("Host: localhost\r\n"
+                 "Content-Type: text/plain\r\n"
+                 "X-Spam: eggs\r\n"
+                 "x-spam: more\r\n"
+                 "  eggs\r\n"
+                 "\r\n"
+                 "body")
+    headers, environ = _read_headers(f)
+    assert f.read() == "body"
+    assert headers.get("content-type") == "text/plain", headers.get("content-type")
+    assert headers.getheaders("X-SPAM") == ["eggs", "more eggs"], headers.getheaders("X-SPAM")
+    assert headers.get("X-Spam") == "more eggs", headers.get("X-Spam")
+    assert headers.get("Missing", "") == ""
+    assert environ == {"HTTP_HOST": "localhost",
+                       "HTTP_X_SPAM": "eggs,more eggs"}, environ
+
+    for bad in ("No colon here\r\n\r\n",
+                "Space before colon : x\r\n\r\n",
+                "X: y\r\n" * (MAX_REQUEST_HEADERS + 1) + "\r\n",
+                "X: " + "y" * (64 * 1024) + "\r\n\r\n"):
+        try:
+            _read_headers(StringIO(bad))
+        except _HeaderError, err:
+            assert err.code == 400, err.code
+        else:
+            raise AssertionError("Accepted %r" % (bad[:40],))
+
+def test_compress():
+    import zlib, tempfile
+    from akara import compression
+    from akara.thirdparty.httpserver import FileWrapper
+    text = "When the hurlyburly's done,\n" * 100
+    def call(app, accept_encoding=None):
+        environ = {}
+        if accept_encoding is not None:
+            environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.append((status, dict(headers)))
+        body = "".join(compression.compress(app)(environ, start_response))
+        return started[0][1], body
+    def app(body, content_type="text/plain", status="200 OK"):
+        def wsgi_app(environ, start_response):
+            start_response(status, [("Content-Type", content_type)])
+            return body
+        return wsgi_app
+
+    # A list is compressed and gets a Content-Length
+    headers, body = call(app([text]), "deflate, gzip;q=0.5")
+    assert headers["Content-Encoding"] == "deflate", headers
+    assert headers["Vary"] == "Accept-Encoding", headers
+    assert headers["Content-Length"] == str(len(body)), headers
+    assert zlib.decompress(body) == text
+
+    # An iterator is compressed as it's read
+    headers, body = call(app(iter([text, text])), "gzip")
+    assert headers["Content-Encoding"] == "gzip", headers
+    assert "Content-Length" not in headers, headers
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == text + text
+
+    # Not compressed
+    for args in ((app([text]), None),
+                 (app([text]), "gzip;q=0, identity"),
+                 (app(["short"]), "gzip"),
+                 (app([text], "image/png"), "gzip"),
+                 (app([text], status="404 Not Found"), "gzip")):
+        headers, body = call(*args)
+        assert "Content-Encoding" not in headers, (args, headers)
+        assert body in (text, "short"), (args, body[:40])
+
+    # Files are compressed once
+    f = tempfile.NamedTemporaryFile()
+    f.write(text)
+    f.flush()
+    file_app = lambda environ, start_response: app(FileWrapper(open(f.name)))(
+        environ, start_response)
+    headers, body1 = call(file_app, "gzip")
+    headers, body2 = call(file_app, "gzip")
+    assert zlib.decompress(body1, 16 + zlib.MAX_WBITS) == text
+    assert body1 is body2
+
+    # Through simple_service, which sends an int Content-Length
+    from akara.services import simple_service
+    @simple_service("GET", "http://example.com/test/compressed", "test_compressed",
+                    compress=True)
+    def compressed():
+        return text
+    for accept_encoding in ("gzip", None):
+        environ = {"REQUEST_METHOD": "GET", "QUERY_STRING": ""}
+        if accept_encoding is not None:
+            environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.append(dict(headers))
+        body = "".join(compressed(environ, start_response))
+        if accept_encoding is None:
+            assert "Content-Encoding" not in started[0], started
+            assert body == text
+        else:
+            assert started[0]["Content-Encoding"] == "gzip", started
+            assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == text
+
+def test_log_writer():
+    import os, shutil, tempfile, logging
+    from akara import logwriter
+    dirname = tempfile.mkdtemp()
+    try:
+        error_log = os.path.join(dirname, "error.log")
+        access_log = os.path.join(dirname, "access.log")
+        writer = logwriter.LogWriter(error_log, access_log, flush_interval=0.1)
+        writer.start()
+        pid = os.fork()
+        if not pid:
+            # A listener process
+            try:
+                error_handler, access_handler = writer.child_handlers()
+                for handler in (error_handler, access_handler):
+                    handler.setFormatter(logging.Formatter("%(message)s"))
+                def log(handler, message):
+                    handler.handle(logging.makeLogRecord({"msg": message}))
+                log(error_handler, "short")
+                log(error_handler, "x" * 10000)  # Takes many frames
+                for i in range(100):
+                    log(access_handler, "request %d" % i)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # Rotate the logs
+        os.rename(error_log, error_log + ".old")
+        writer.reopen(error_log, access_log)
+        writer.stop()
+
+        assert open(error_log + ".old").read() == "short\n" + "x" * 10000 + "\n"
+        assert open(error_log).read() == ""
+        lines = open(access_log).read().splitlines()
+        assert lines == ["request %d" % i for i in range(100)], lines
+    finally:
+        shutil.rmtree(dirname)
+
+def test_log_writer_frames():
+    import threading
+    from akara import logwriter
+    # A record from this thread, and one from another thread, like
+    # the ones of a ThreadsPerServer listener
+    traceback = list(logwriter._frames(logwriter.ERROR, "t" * 10000))
+    access = []
+    t = threading.Thread(target=lambda: access.extend(
+        logwriter._frames(logwriter.ACCESS, "a" * 5000)))
+    t.start()
+    t.join()
+    assert len(traceback) == 3 and len(access) == 2
+    writer = logwriter._Writer(None, {}, 1.0, None)
+    # The frames of the two records, mixed together
+    mixed = [traceback[0], access[0], traceback[1], access[1], traceback[2]]
+    assert writer._read_frames("".join(mixed)) == ""
+    assert writer.pending == {logwriter.ERROR: ["t" * 10000],
+                              logwriter.ACCESS: ["a" * 5000]}, writer.pending
+
+    # The sender gave up on a record after two frames. Its next
+    # record from that thread is written without them.
+    writer = logwriter._Writer(None, {}, 1.0, None)
+    next = list(logwriter._frames(logwriter.ERROR, "next"))
+    assert writer._read_frames("".join(traceback[:2] + next + traceback[2:])) == ""
+    assert writer.pending[logwriter.ERROR] == ["next"], writer.pending
+
+def test_stats():
+    import os, shutil, tempfile
+    from akara import stats
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, "akara.stats")
+        table = stats.Stats.create(filename, 4)
+        # Two children
+        writer1 = stats.StatsWriter(table, 0)
+        writer2 = stats.SharedStatsWriter(table, 3)
+        for i in range(90):
+            writer1.record("echo", "http://example.com/echo", 200, 10, 0.001)
+        for i in range(10):
+            writer2.record("echo", "http://example.com/echo", 500, 5, 1.0)
+        writer2.record("other", "http://example.com/echo", 404, 1, 0.002)
+        writer2.record(None, None, 404, 100, 0.0001)
+        writer2.record("bad", "http://example.com/bad", 0, 0, 1000.0)
+        writer1.record_cache("pipe", "http://example.com/echo", True)
+        writer2.record_cache("pipe", "http://example.com/echo", True)
+        writer2.record_cache("pipe", "http://example.com/echo", False)
+
+        reader = stats.Stats.open(filename)
+        report = dict((entry["mount_point"], entry) for entry in reader.report())
+        reader.close()
+        table.close()
+
+        assert sorted(report) == ["-", "bad", "echo", "other", "pipe"], sorted(report)
+        assert report["pipe"]["requests"] == 0
+        assert (report["pipe"]["cache_hits"], report["pipe"]["cache_misses"]) == (2, 1)
+        assert report["echo"]["cache_hits"] == 0
+        echo = report["echo"]
+        assert echo["ident"] == "http://example.com/echo"
+        assert echo["requests"] == 100
+        assert echo["status"] == {"1xx": 0, "2xx": 90, "3xx": 0, "4xx": 0, "5xx": 10}
+        assert echo["bytes"] == 950
+        assert abs(echo["seconds"] - 10.09) < 1e-9, echo["seconds"]
+        assert 0.001 <= stats.quantile(echo["buckets"], 0.5) < 0.00125
+        assert 1.0 <= stats.quantile(echo["buckets"], 0.99) < 1.25
+        assert report["-"]["ident"] is None
+        assert report["bad"]["status"]["5xx"] == 0
+        assert stats.quantile(report["bad"]["buckets"], 0.5) == float("inf")
+
+        services = stats.by_service(report.values())
+        assert [s["ident"] for s in services] == ["http://example.com/bad",
+                                                  "http://example.com/echo"]
+        assert services[1]["requests"] == 101
+        assert sorted(services[1]["mount_points"]) == ["echo", "other"]
+
+        document = stats.json_document(report.values())
+        assert "pipe" not in [entry["mount_point"] for entry in document["mount_points"]]
+        assert document["pipeline_cache"] == [dict(mount_point="pipe",
+            ident="http://example.com/echo", hits=2, misses=1)], document["pipeline_cache"]
+
+        text = stats.prometheus_text(report.values())
+        assert ('akara_pipeline_cache_total{mount_point="pipe",ident="http://example.com/echo",'
+                'result="miss"} 1') in text, text
+        assert ('akara_requests_total{mount_point="echo",ident="http://example.com/echo",'
+                'status="2xx"} 90') in text, text
+        assert ('akara_request_duration_seconds_bucket{mount_point="echo",'
+                'ident="http://example.com/echo",le="+Inf"} 100') in text, text
+    finally:
+        shutil.rmtree(dirname)
+
+def test_tracing():
+    import os, shutil, tempfile, json
+    from akara import tracing
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, "trace.json")
+        tracing.configure(dict(trace_file=filename, trace_sample_rate=0.0,
+                               trace_header="X-Akara-Trace"))
+        assert tracing.start({}) is None
+        assert tracing.start({"X-Akara-Trace": "0"}) is None
+
+        # Nothing happens without a trace
+        environ = {}
+        with tracing.span(environ, "not traced"):
+            pass
+
+        for i in range(2):
+            trace = tracing.start({"X-Akara-Trace": "1"}, 100.0)
+            environ = {"akara.trace": trace}
+            tracing.add_span(environ, "parse request", 100.0, 100.5)
+            try:
+                with tracing.span(environ, "call echo", size=3):
+                    raise ValueError
+            except ValueError:
+                pass
+            trace.finish("GET /echo", status="200 OK")
+
+        # The array is left open so every process can append to it
+        text = open(filename).read()
+        assert text.startswith("[\n") and text.endswith(",\n"), text
+        events = json.loads(text.rstrip(",\n") + "]")
+        assert len(events) == 6, events
+        request, parse, call = events[:3]
+        assert request["name"] == "GET /echo"
+        assert request["ts"] == 100000000
+        assert request["args"] == {"status": "200 OK"}
+        assert parse["name"] == "parse request"
+        assert parse["dur"] == 500000
+        assert call["args"] == {"size": 3, "error": "ValueError"}
+        assert events[3]["tid"] == request["tid"] + 1
+    finally:
+        tracing.configure({})
+        shutil.rmtree(dirname)
+
+def test_profiling():
+    import os, shutil, tempfile, marshal
+    from akara import profiling
+    dirname = tempfile.mkdtemp()
+    try:
+        control = profiling.Control.create(os.path.join(dirname, profiling.CONTROL_FILE))
+        settings = dict(profile_dir=dirname, profile_mount_points=["always"],
+                        profile_secret="sekrit")
+        profiler = profiling.Profiler(settings, control)
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            # Work done while the response is read is included
+            for i in range(3):
+                yield sum(range(1000)) and "x"
+        def call(mount_point, environ={}):
+            return profiler.call(mount_point, app, environ, lambda *args: None)
+
+        # Not asked for, so nothing is profiled
+        call("echo")
+        assert profiling.list_profiles(dirname) == {}
+
+        run = control.request("echo", 2)
+        assert run == 1
+        assert control.entries() == [("echo", 1, 2)]
+        for i in range(3):
+            assert list(call("echo")) == ["x", "x", "x"]
+        assert control.entries() == [("echo", 1, 0)]
+        assert profiling.list_profiles(dirname) == {"echo": (1, 1)}
+
+        # ProfileMountPoints and signed headers
+        call("always")
+        good = profiling.signature("sekrit", "signed", 2000000000)
+        bad = profiling.signature("guess", "signed", 2000000000)
+        call("signed", {profiling.HEADER_ENVIRON_KEY: bad})
+        assert "signed" not in profiling.list_profiles(dirname)
+        call("signed", {profiling.HEADER_ENVIRON_KEY: good})
+        assert profiling.list_profiles(dirname)["signed"] == (0, 1)
+        assert profiling.list_profiles(dirname)["always"] == (0, 1)
+
+        data = profiling.merged_profile(dirname, "echo")
+        stats = marshal.loads(data)
+        calls = [(key[2], value[1]) for (key, value) in stats.items()]
+        assert ("<sum>", 6) in calls, calls
+        assert profiling.merged_profile(dirname, "missing") is None
+
+        # A new run leaves the old one behind
+        assert control.request("echo", 1) == 2
+        profiling.remove_old_runs(dirname, "echo", 2)
+        assert "echo" not in profiling.list_profiles(dirname)
+        call("echo")
+        assert profiling.list_profiles(dirname)["echo"] == (2, 1)
+        control.close()
+    finally:
+        shutil.rmtree(dirname)
+
+def test_registry_routes():
+    from akara import registry
+    reg = registry.Registry()
+    def handler(environ, start_response):
+        "Test handler"
+    reg.register_service("urn:echo", "echo", handler)
+    reg.register_service("urn:root", "", handler)
+    reg.register_service("urn:page", "wiki/pages/{name}", handler)
+    reg.register_service("urn:history", "wiki/pages/{name}/history/{rev}", handler)
+    reg.register_service("urn:front", "wiki/pages/front", handler)
+
+    def match(path_info):
+        route = reg.match(path_info)
+        if route is None:
+            return None
+        service, num_segments, args = route
+        return service.ident, num_segments, args
+
+    assert match("/") == ("urn:root", 1, {})
+    assert match("/echo") == ("urn:echo", 1, {})
+    assert match("/echo/more/stuff") == ("urn:echo", 1, {})
+    assert match("/missing") is None
+    assert match("/wiki") is None
+    assert match("/wiki/pages/") is None
+    assert match("/wiki/pages/Home") == ("urn:page", 3, {"name": "Home"})
+    assert match("/wiki/pages/Home/") == ("urn:page", 3, {"name": "Home"})
+    assert match("/wiki//pages/Home") == ("urn:page", 3, {"name": "Home"})
+    assert match("/wiki/pages/front") == ("urn:front", 3, {})
+    assert match("/wiki/pages/Home/history/12") == (
+        "urn:history", 5, {"name": "Home", "rev": "12"})
+    # The longest registered prefix
+    assert match("/wiki/pages/Home/history") == ("urn:page", 3, {"name": "Home"})
+
+    assert reg.get_service_by_id("urn:page").path == "wiki/pages/{name}"
+    assert reg.get_service_by_id("urn:missing") is None
+    # Replacing a path updates the ident index
+    reg.register_service("urn:echo2", "echo", handler)
+    assert reg.get_service_by_id("urn:echo") is None
+    assert reg.get_service_by_id("urn:echo2").path == "echo"
+    assert match("/echo") == ("urn:echo2", 1, {})
+
+    for bad_path in ("/echo", "echo/", "a//b", "a/./b", "a/{x", "a/x{y}",
+                     "a/{1x}", "{x}/{x}"):
+        try:
+            reg.register_service("urn:bad", bad_path, handler)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Registered %r" % (bad_path,))
@@ -1,9 +1,16 @@
 import hashlib
+import os
+import tempfile
+import threading
+import time
 import urllib2
+from cStringIO import StringIO
 
 from test_services import GET
 
-from akara import pipeline
+from akara import pipeline, registry
+from akara.thirdparty import httpserver
+from amara.thirdparty import json
 
 def test_pipeline_missing_stages():
     for stages in (None, [], ()):
@@ -53,6 +60,400 @@ def test_stage_error_combinations():
 
 
 
+def test_stage_pipe():
+    closed = []
+    class Output(object):
+        def __iter__(self):
+            return iter(["ab", "", "c\nde", "f\n", "g"])
+        def close(self):
+            closed.append(True)
+    pipe = pipeline._StagePipe(Output())
+    assert pipe.read(1) == "a"
+    assert pipe.readline() == "bc\n"
+    assert pipe.readline(2) == "de"
+    assert list(pipe) == ["f\n", "g"]
+    assert pipe.read() == ""
+    assert closed == [True]
+
+    pipe = pipeline._StagePipe(["ab", "cd"])
+    assert pipe.read(3) == "abc"
+    assert pipe.read() == "d"
+    pipe.close()
+
+def test_simple_service_stages():
+    from akara.services import simple_service
+    # send_headers() gives the Content-Length as an int
+    @simple_service("POST", "http://example.com/test/shout", "test_shout")
+    def shout(body, ctype):
+        return body.upper() + "!"
+    @simple_service("POST", "http://example.com/test/bracket", "test_bracket")
+    def bracket(body, ctype):
+        return "[" + body + "]"
+    app = pipeline.Pipeline("http://example.com/test/p0", "test_p0",
+                            [pipeline.Stage("http://example.com/test/shout"),
+                             pipeline.Stage("http://example.com/test/bracket")], "")
+    assert _run(app, "hi") == ("200 OK", "[HI!]")
+
+def _run(app, body="", **extra):
+    environ = {"REQUEST_METHOD": "POST", "QUERY_STRING": "",
+               "SCRIPT_NAME": "", "PATH_INFO": "/",
+               "CONTENT_LENGTH": str(len(body)), "CONTENT_TYPE": "text/plain",
+               "wsgi.input": StringIO(body)}
+    environ.update(extra)
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+    result = app(environ, start_response)
+    try:
+        return response[0], "".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+def test_streamed_stages():
+    seen = []
+    def produce(environ, start_response):
+        # A generator, so start_response() is only called once it starts
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+        for word in body.split():
+            yield word + "\n"
+    def upper(environ, start_response):
+        seen.append((type(environ["wsgi.input"]), environ["CONTENT_LENGTH"]))
+        body = environ["wsgi.input"].read()
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [body.upper()]
+    upper.pipeline_input = "stream"
+    def seeker(environ, start_response):
+        f = environ["wsgi.input"]
+        seen.append((type(f), environ["CONTENT_LENGTH"]))
+        f.seek(0, 2)
+        size = f.tell()
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [str(size)]
+    pipeline.seekable_input(seeker)
+
+    registry.register_service("http://example.com/test/produce", "test_produce", produce)
+    registry.register_service("http://example.com/test/upper", "test_upper", upper)
+    registry.register_service("http://example.com/test/seeker", "test_seeker", seeker)
+
+    app = pipeline.Pipeline("http://example.com/test/p1", "test_p1",
+                            [pipeline.Stage("http://example.com/test/produce"),
+                             pipeline.Stage("http://example.com/test/upper")], "")
+    assert _run(app, "a b c") == ("200 OK", "A\nB\nC\n")
+    assert seen == [(pipeline._StagePipe, "")], seen
+
+    del seen[:]
+    app = pipeline.Pipeline("http://example.com/test/p2", "test_p2",
+                            [pipeline.Stage("http://example.com/test/produce"),
+                             pipeline.Stage("http://example.com/test/seeker")], "")
+    assert _run(app, "a b c") == ("200 OK", "6")
+    assert seen[0][1] == "6", seen
+
+def test_file_passthrough():
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, "file contents")
+    os.close(fd)
+    seen = []
+    def send_file(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return httpserver.FileWrapper(open(filename, "rb"))
+    def read_all(environ, start_response):
+        f = environ["wsgi.input"]
+        seen.append((getattr(f, "name", None), environ["CONTENT_LENGTH"]))
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [f.read(int(environ["CONTENT_LENGTH"]))]
+    try:
+        registry.register_service("http://example.com/test/send_file", "test_send_file", send_file)
+        registry.register_service("http://example.com/test/read_all", "test_read_all", read_all)
+        app = pipeline.Pipeline("http://example.com/test/p3", "test_p3",
+                                [pipeline.Stage("http://example.com/test/send_file"),
+                                 pipeline.Stage("http://example.com/test/read_all")], "")
+        assert _run(app) == ("200 OK", "file contents")
+        assert seen == [(filename, "13")], seen
+    finally:
+        os.unlink(filename)
+
+
+def _register_branches():
+    release = threading.Event()
+    def text(environ, start_response):
+        body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["<%s>" % (body,)]
+    def xml(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/xml")])
+        return ['<?xml version="1.0"?>\n<q>%s</q>' % (environ["QUERY_STRING"],)]
+    def json_output(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return ['{"n": 1}']
+    def slow(environ, start_response):
+        release.wait(5)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["slow"]
+    def missing(environ, start_response):
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return ["no"]
+    for name, handler in (("text", text), ("xml", xml), ("json", json_output),
+                          ("slow", slow), ("missing", missing)):
+        registry.register_service("http://example.com/test/branch/" + name,
+                                  "test_branch_" + name, handler)
+    return release
+
+def test_parallel():
+    release = _register_branches()
+    B = "http://example.com/test/branch/"
+    app = pipeline.Pipeline("http://example.com/test/p4", "test_p4", [
+        pipeline.Parallel([B + "text", ("t2", B + "text")])], "")
+    assert _run(app, "in") == ("200 OK", "<in><in>")
+
+    app = pipeline.Pipeline("http://example.com/test/p5", "test_p5", [
+        pipeline.Stage(B + "text"),
+        pipeline.Parallel([("a", B + "text"), ("b", pipeline.Stage(B + "xml", x="1")),
+                           ("c", B + "missing")], merge="xml")], "")
+    assert _run(app, "in") == ("200 OK",
+        '<results><result stage="a">&lt;&lt;in&gt;&gt;</result>'
+        '<result stage="b">\n<q>x=1</q></result>'
+        '<result stage="c" error="404"/></results>')
+
+    app = pipeline.Pipeline("http://example.com/test/p6", "test_p6", [
+        pipeline.Parallel([("a", B + "json"), ("b", B + "text"), ("c", B + "slow")],
+                          merge="json", timeout=5, timeouts={"c": 0.1})], "")
+    start = time.time()
+    status, body = _run(app, "in")
+    release.set()
+    assert time.time() - start < 2
+    assert status == "200 OK", status
+    assert json.loads(body) == {"a": {"n": 1}, "b": "<in>", "c": None}, body
+
+    app = pipeline.Pipeline("http://example.com/test/p7", "test_p7", [
+        pipeline.Parallel([B + "missing"])], "")
+    assert _run(app)[0] == "502 Bad Gateway"
+
+    # More nested Parallel stages than pool threads, with no timeouts
+    registry.register_service(B + "nested", "test_branch_nested",
+                              pipeline.Parallel([B + "text", ("t2", B + "text")]))
+    names = [str(i) for i in range(pipeline._pool_size + 2)]
+    app = pipeline.Pipeline("http://example.com/test/p18", "test_p18", [
+        pipeline.Parallel([(name, B + "nested") for name in names],
+                          merge="json", timeout=5)], "")
+    start = time.time()
+    status, body = _run(app, "in")
+    assert time.time() - start < 2
+    assert json.loads(body) == dict((name, "<in><in>") for name in names), body
+
+    for args in (([],), ([B + "text", B + "text"],), ([B + "text"], "yaml")):
+        try:
+            pipeline.Parallel(*args)
+        except (TypeError, ValueError):
+            pass
+        else:
+            raise AssertionError("allowed %r" % (args,))
+
+
+def test_stage_cache():
+    calls = []
+    def count(environ, start_response):
+        body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+        calls.append(body)
+        if body == "bad":
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            return ["bad"]
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [body, str(len(calls))]
+    def upper(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["wsgi.input"].read().upper()]
+    upper.pipeline_input = "stream"
+    registry.register_service("http://example.com/test/count", "test_count", count)
+    registry.register_service("http://example.com/test/upper2", "test_upper2", upper)
+
+    cache = pipeline.StageCache(max_entries=2)
+    app = pipeline.Pipeline("http://example.com/test/p8", "test_p8",
+                            [pipeline.Stage("http://example.com/test/count", cache=cache),
+                             pipeline.Stage("http://example.com/test/upper2")], "")
+    assert _run(app, "a") == ("200 OK", "A1")
+    assert _run(app, "a") == ("200 OK", "A1")
+    assert _run(app, "b") == ("200 OK", "B2")
+    assert _run(app, "bad") == ("400 Bad Request", "bad")
+    assert _run(app, "bad") == ("400 Bad Request", "bad")
+    assert calls == ["a", "b", "bad", "bad"], calls
+    # Only two are kept, so "a" goes
+    assert _run(app, "c") == ("200 OK", "C5")
+    assert _run(app, "a") == ("200 OK", "A6")
+    assert len(cache) == 2
+
+    # A cached stage after another one, and as the last stage
+    app = pipeline.Pipeline("http://example.com/test/p9", "test_p9",
+                            [pipeline.Stage("http://example.com/test/upper2"),
+                             pipeline.Stage("http://example.com/test/count", cache=True)], "")
+    del calls[:]
+    assert _run(app, "x") == ("200 OK", "X1")
+    assert _run(app, "x") == ("200 OK", "X1")
+    assert calls == ["X"], calls
+
+    # A compressed response only goes to clients which accept it
+    import zlib
+    from akara.services import simple_service
+    @simple_service("POST", "http://example.com/test/repeat2", "test_repeat2",
+                    compress=True)
+    def repeat(body, ctype):
+        calls.append(body)
+        return body * 100
+    app = pipeline.Pipeline("http://example.com/test/p16", "test_p16",
+                            [pipeline.Stage("http://example.com/test/repeat2", cache=True)], "")
+    del calls[:]
+    status, body = _run(app, "xyz", HTTP_ACCEPT_ENCODING="gzip")
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "xyz" * 100
+    assert _run(app, "xyz") == ("200 OK", "xyz" * 100)
+    assert _run(app, "xyz", HTTP_ACCEPT_ENCODING="identity") == ("200 OK", "xyz" * 100)
+    status, body = _run(app, "xyz", HTTP_ACCEPT_ENCODING="x-gzip")
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "xyz" * 100
+    assert calls == ["xyz", "xyz"], calls
+
+    cache = pipeline.StageCache(ttl=-1)
+    cache.put("key", "200 OK", [], "output")
+    assert cache.get("key") is None
+    cache = pipeline.StageCache(max_bytes=10)
+    cache.put("key1", "200 OK", [], "x" * 6)
+    cache.put("key2", "200 OK", [], "y" * 6)
+    cache.put("key3", "200 OK", [], "z" * 11)
+    assert cache.get("key1") is None
+    assert cache.get("key2") == ("200 OK", [], "y" * 6)
+    assert cache.get("key3") is None
+
+
+def test_compiled_plan():
+    def first(environ, start_response):
+        # Like send_headers(), with an int Content-Length
+        start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", 5)])
+        return ["first"]
+    def second(environ, start_response):
+        body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [body + " " + environ["QUERY_STRING"]]
+    registry.register_service("http://example.com/test/first", "test_first", first)
+    registry.register_service("http://example.com/test/second", "test_second", second)
+    app = pipeline.Pipeline("http://example.com/test/p10", "test_p10",
+                            [pipeline.Stage("http://example.com/test/first"),
+                             pipeline.Stage("http://example.com/test/second", a="1")], "")
+    assert _run(app) == ("200 OK", "first a=1")
+    steps = app._plan[1]
+    assert _run(app) == ("200 OK", "first a=1")
+    assert app._plan[1] is steps
+
+    # Replacing a stage's service recompiles the pipeline
+    def second_again(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["replaced"]
+    registry.register_service("http://example.com/test/second", "test_second", second_again)
+    assert _run(app) == ("200 OK", "replaced")
+    assert app._plan[1] is not steps
+
+
+def test_tree_passing():
+    import amara
+    from amara import tree
+    from akara.services import simple_service
+    inputs = []
+    @simple_service("POST", "http://example.com/test/make_tree", "test_make_tree")
+    def make_tree(body, ctype):
+        return amara.parse(body)
+    @pipeline.tree_input
+    @simple_service("POST", "http://example.com/test/take_tree", "test_take_tree",
+                    "text/plain")
+    def take_tree(body, ctype):
+        inputs.append(isinstance(body, tree.entity))
+        if not isinstance(body, tree.entity):
+            body = amara.parse(body)
+        return str(len(body.xml_select(u"//b")))
+    @simple_service("POST", "http://example.com/test/echo_xml", "test_echo_xml",
+                    "text/plain")
+    def echo_xml(body, ctype):
+        return body
+
+    T = "http://example.com/test/"
+    xml = "<a><b/><b/></a>"
+    app = pipeline.Pipeline(T + "p11", "test_p11", [pipeline.Stage(T + "make_tree"),
+                                                    pipeline.Stage(T + "take_tree")], "")
+    assert _run(app, xml) == ("200 OK", "2")
+    assert inputs == [True], inputs
+
+    # Not after a stage which returns bytes
+    app = pipeline.Pipeline(T + "p12", "test_p12", [pipeline.Stage(T + "echo_xml"),
+                                                    pipeline.Stage(T + "take_tree")], "")
+    assert _run(app, xml) == ("200 OK", "2")
+    assert inputs == [True, False], inputs
+
+    # Other stages, and the client, get XML
+    app = pipeline.Pipeline(T + "p13", "test_p13", [pipeline.Stage(T + "make_tree"),
+                                                    pipeline.Stage(T + "echo_xml"),
+                                                    pipeline.Stage(T + "make_tree")], "")
+    status, body = _run(app, xml)
+    assert status == "200 OK", status
+    assert "<b/>" in body and "<a>" in body, body
+
+    # The notify_before services of a stage which takes a tree get XML
+    notified = []
+    @simple_service("POST", "http://example.com/test/note_xml", "test_note_xml")
+    def note_xml(body, ctype):
+        notified.append(body)
+        return ""
+    @pipeline.tree_input
+    @simple_service("POST", "http://example.com/test/take_tree2", "test_take_tree2",
+                    "text/plain", notify_before=[T + "note_xml"])
+    def take_tree2(body, ctype):
+        inputs.append(isinstance(body, tree.entity))
+        return str(len(body.xml_select(u"//b")))
+    app = pipeline.Pipeline(T + "p19", "test_p19", [pipeline.Stage(T + "make_tree"),
+                                                    pipeline.Stage(T + "take_tree2")], "")
+    del inputs[:]
+    assert _run(app, xml) == ("200 OK", "2")
+    assert inputs == [True], inputs
+    assert len(notified) == 1 and "<b/>" in notified[0], notified
+
+
+def test_compressed_stages():
+    import zlib
+    from akara.services import simple_service
+    @simple_service("POST", "http://example.com/test/repeat", "test_repeat",
+                    compress=True)
+    def repeat(body, ctype):
+        return body * 100
+    @simple_service("POST", "http://example.com/test/size", "test_size")
+    def size(body, ctype):
+        return str(len(body))
+    T = "http://example.com/test/"
+    # Only the response to the client is compressed
+    app = pipeline.Pipeline(T + "p14", "test_p14", [pipeline.Stage(T + "repeat"),
+                                                    pipeline.Stage(T + "size"),
+                                                    pipeline.Stage(T + "repeat")], "")
+    status, body = _run(app, "abc", HTTP_ACCEPT_ENCODING="gzip")
+    assert status == "200 OK", status
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "300" * 100
+
+    app = pipeline.Pipeline(T + "p15", "test_p15", [
+        pipeline.Parallel([("a", T + "repeat"), ("b", T + "repeat")], merge="json")], "")
+    status, body = _run(app, "abc", HTTP_ACCEPT_ENCODING="gzip")
+    assert json.loads(body) == {"a": "abc" * 100, "b": "abc" * 100}, body[:40]
+
+def test_templated_path():
+    from akara.services import simple_service
+    @simple_service("POST", "http://example.com/test/lower", "test_lower")
+    def lower(body, ctype):
+        return body.lower()
+    T = "http://example.com/test/"
+    app = pipeline.Pipeline(T + "p17", "p17/{fmt}", [
+        pipeline.Stage(T + "lower"),
+        pipeline.Parallel([("a", T + "lower")], merge="json")], "")
+    registry.register_service(app.ident, app.path, app)
+    service, num_segments, route_args = registry.match("/p17/XML")
+    assert route_args == {"fmt": "XML"}, route_args
+    # The stages don't get the pipeline's {fmt}
+    status, body = _run(app, "ABC", **{"wsgiorg.routing_args": ((), route_args)})
+    assert status == "200 OK", (status, body)
+    assert json.loads(body) == {"a": "abc"}, body
+
 def test_hash_encode():
     result = GET("hash_encode", data="This is a test")
     expected = hashlib.md5("secretThis is a test").digest().encode("base64")
@@ -1,4 +1,11 @@
-from server_support import server
+import server_support
+from server_support import server, httplib_server
+import httplib
+import os
+import signal
+import socket
+import threading
+import time
 import urllib2
 from urllib2 import urlopen
 from collections import defaultdict
@@ -60,6 +67,34 @@ def test_index_search_no_hits():
     assert xml == ('<?xml version="1.0" encoding="utf-8"?>\n'
                    '<services/>'), repr(xml)
 
+def test_index_conditional_get():
+    from amara.thirdparty import json
+    response = urlopen(server() + "?format=json")
+    assert response.info()["Content-Type"] == "application/json"
+    etag = response.info()["ETag"]
+    last_modified = response.info()["Last-Modified"]
+    document = json.load(response)
+    paths = [entry["path"] for entry in document["services"]]
+    assert "test_echo_simple_get" in paths, paths
+
+    # The same in every server process
+    for i in range(10):
+        assert urlopen(server()).info()["Last-Modified"] == last_modified
+
+    for header, value in (("If-None-Match", etag),
+                          ("If-Modified-Since", last_modified)):
+        request = urllib2.Request(server() + "?format=json", headers={header: value})
+        try:
+            urlopen(request)
+            raise AssertionError("Expected a 304 for %s" % (header,))
+        except urllib2.HTTPError, err:
+            assert err.code == 304, err.code
+
+    # The XML document has its own ETag
+    response = urlopen(urllib2.Request(server(), headers={"If-None-Match": etag}))
+    assert response.info()["ETag"] != etag
+    assert response.read().startswith("<?xml")
+
 def test_404_error_message():
     url = server() + "this_does_not_exist/I_mean_it/Anybody_want_a_peanut?"
     try:
@@ -91,8 +126,202 @@ def test_405_error_message_mega(n=100):
     if n / (t2-t1+0.00001) < 2:
         raise AssertionError("Should be able to handle more than 2 failure requests/seconds")
 
+# Persistent connections. The test server uses
+#   KeepAliveTimeout = 2 and MaxKeepAliveRequests = 4
+
+def _send_pipelined(paths):
+    conn = httplib_server()
+    conn.connect()
+    sock = conn.sock
+    sock.sendall("".join("GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path
+                         for path in paths))
+    return sock
+
+def _read_response(sock):
+    response = httplib.HTTPResponse(sock, strict=True)
+    response.begin()
+    return response.status, response.getheader("connection"), response.read()
+
+def test_keep_alive_pipelining():
+    sock = _send_pipelined(["test_get_call_count", "test_args?a=Andrew",
+                            "test_get_call_count"])
+    status, connection, body1 = _read_response(sock)
+    assert status == 200, status
+    assert connection is None, connection
+    status, connection, body2 = _read_response(sock)
+    assert (status, body2) == (200, "Hi Andrew and 3"), (status, body2)
+    status, connection, body3 = _read_response(sock)
+    assert status == 200, status
+    # All three requests were handled by the same child
+    count1, pid1 = body1.split()
+    count3, pid3 = body3.split()
+    assert pid1 == pid3, (body1, body3)
+    assert int(count3) == int(count1) + 1, (body1, body3)
+    sock.close()
+
+def test_keep_alive_chunked():
+    # A response without a Content-Length is chunked, not closed
+    sock = _send_pipelined(["test_iterator", "test_args?a=Andrew"])
+    response = httplib.HTTPResponse(sock, strict=True)
+    response.begin()
+    assert response.status == 200, response.status
+    assert response.getheader("transfer-encoding") == "chunked", response.getheaders()
+    assert response.getheader("connection") is None, response.getheaders()
+    body = response.read()
+    assert body.startswith("When shall we three meet again?\n"), body
+    assert body.endswith("When the battle's lost and won.\n"), body
+    status, connection, body = _read_response(sock)
+    assert (status, body) == (200, "Hi Andrew and 3"), (status, body)
+    sock.close()
+
+def _send_raw(request):
+    conn = httplib_server()
+    conn.connect()
+    sock = conn.sock
+    sock.sendall(request)
+    return sock
+
+def test_request_body_too_large():
+    sock = _send_raw("POST /test_echo_simple_post HTTP/1.1\r\nHost: localhost\r\n"
+                     "Content-Type: text/plain\r\nContent-Length: 10000000000\r\n\r\n"
+                     "some of the body")
+    status, connection, body = _read_response(sock)
+    assert status == 413, status
+    assert connection == "close", connection
+    assert sock.recv(100) == "", "server did not close the connection"
+    sock.close()
+
+def test_chunked_request_body():
+    # The chunk would otherwise be read as a second request
+    smuggled = "GET /test_get_call_count HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    sock = _send_raw("POST /test_echo_simple_post HTTP/1.1\r\nHost: localhost\r\n"
+                     "Content-Type: text/plain\r\nTransfer-Encoding: chunked\r\n\r\n"
+                     "%x\r\n%s\r\n0\r\n\r\n" % (len(smuggled), smuggled))
+    status, connection, body = _read_response(sock)
+    assert status == 411, status
+    assert connection == "close", connection
+    assert sock.recv(100) == "", "server did not close the connection"
+    sock.close()
+
+def test_keep_alive_max_requests():
+    sock = _send_pipelined(["test_get_call_count"] * 6)
+    for i in range(4):
+        status, connection, body = _read_response(sock)
+        assert status == 200, status
+    # The last allowed request says that the connection will close
+    assert connection == "close", connection
+    assert sock.recv(100) == "", "server did not close the connection"
+    sock.close()
+
+def test_keep_alive_timeout():
+    conn = httplib_server()
+    conn.request("GET", "/test_get_call_count")
+    assert conn.getresponse().read()
+    t1 = time.time()
+    # The server closes the idle connection after the timeout
+    assert conn.sock.recv(100) == ""
+    t2 = time.time()
+    assert 1.0 < t2-t1 < 10.0, t2-t1
+    conn.close()
+
+def test_post_fork():
+    # The post-fork function is called exactly once in this process
+    for i in range(5):
+        pids = urlopen(server() + "test_post_fork").read().split()
+        assert len(pids) == 2, pids
+        assert pids[0] == pids[1], pids
+
+def test_concurrent_requests():
+    # Overlapping requests each get their own akara.request and
+    # akara.response, whether they are in different processes or
+    # in different threads of the same process.
+    results = {}
+    def fetch(name):
+        f = urlopen(server() + "test_per_request_state?name=%s" % name)
+        results[name] = (f.headers["X-Akara-Name"], f.read())
+    names = ["req%d" % i for i in range(3)]
+    threads = [threading.Thread(target=fetch, args=(name,)) for name in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for name in names:
+        assert results[name] == (name, "%s name=%s" % (name, name)), results
+
+def test_async_service():
+    f = urlopen(server() + "test_async_fetch?a=X&b=Y")
+    assert f.read() == "Hi X and 3|Hi Y and 3|'x' -> 'X'\n"
+    assert f.headers["X-Upstream-Status"] == "200", f.headers
+
+def test_async_service_error():
+    assert urlopen(server() + "test_async_error?catch=1").read() == "caught"
+    try:
+        urlopen(server() + "test_async_error")
+    except urllib2.HTTPError, err:
+        assert err.code == 500, err.code
+    else:
+        raise AssertionError("uncaught UpstreamError should give a 500")
+
+def test_server_status():
+    url = server() + "akara.server-status"
+    tree = amara.parse(urlopen(url))
+    status = tree.xml_select(u"/server-status")[0]
+    assert int(status.xml_attributes[u"master-pid"]) > 0
+    servers = tree.xml_select(u"/server-status/server")
+    assert len(servers) >= 3, len(servers) # MinSpareServers = 3
+    # This request is in progress
+    me = tree.xml_select(u"/server-status/server[request/@mount-point='akara.server-status']")
+    assert len(me) == 1, tree.xml_encode()
+    assert me[0].xml_attributes[u"state"] == u"busy", me[0].xml_attributes[u"state"]
+    request = me[0].xml_select(u"request")[0]
+    assert request.xml_attributes[u"method"] == u"GET"
+    assert request.xml_attributes[u"client"] == u"127.0.0.1"
+    assert int(status.xml_attributes[u"busy"]) >= 1
+
+def _server_status():
+    tree = amara.parse(urlopen(server() + "akara.server-status"))
+    status = tree.xml_select(u"/server-status")[0]
+    pids = set(int(s.xml_attributes[u"pid"])
+               for s in tree.xml_select(u"/server-status/server"))
+    return int(status.xml_attributes[u"master-pid"]), pids
+
+def test_rolling_restart():
+    # "akara restart" replaces the servers while the master keeps
+    # handling requests
+    master_pid, old_pids = _server_status()
+    if server_support.server_pid != master_pid:
+        print "Not my server; skipping"
+        return
+    os.kill(master_pid, signal.SIGHUP)
+    end_time = time.time() + 30
+    while 1:
+        # None of these should fail
+        urlopen(server() + "test_get_call_count").read()
+        new_master_pid, pids = _server_status()
+        assert new_master_pid == master_pid
+        if not (pids & old_pids):
+            break
+        assert time.time() < end_time, "old servers are still running: %r" % (pids & old_pids,)
+        time.sleep(0.1)
+    assert len(pids) >= 3, pids # MinSpareServers = 3
+
 if __name__ == "__main__":
     def server():
         #return "http://192.168.2.101:8880/"
         return "http://localhost:8880/"
     test_405_error_message_mega(1000)
+
+def test_stats():
+    from amara.thirdparty import json
+    urlopen(server() + "akara.echo", "Hello").read()
+    document = json.load(urlopen(server() + "akara.stats"))
+    echo = [entry for entry in document["mount_points"]
+            if entry["mount_point"] == "akara.echo"]
+    assert len(echo) == 1, document
+    assert echo[0]["requests"] >= 1, echo
+    assert echo[0]["status"]["2xx"] >= 1, echo
+    assert echo[0]["p50_seconds"] > 0, echo
+    assert "uptime" in document
+
+    text = urlopen(server() + "akara.stats?format=prometheus").read()
+    assert 'akara_requests_total{mount_point="akara.echo"' in text, text
@@ -91,6 +91,27 @@ When the hurlyburly's done,
 When the battle's lost and won.
 """, body
 
+def test_file_wrapper():
+    code, headers, body = GET3("test_file_wrapper")
+    assert headers["Content-Length"] == "50000", headers["Content-Length"]
+    assert body == ("0123456789" * 5001)[5:50005], body[:100]
+
+def test_compress():
+    import zlib
+    url = server() + "test_compress"
+    f = urlopen(urllib2.Request(url, headers={"Accept-Encoding": "gzip"}))
+    assert f.headers["Content-Encoding"] == "gzip", f.headers
+    assert f.headers["Vary"] == "Accept-Encoding", f.headers
+    body = f.read()
+    assert len(body) == int(f.headers["Content-Length"])
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "When shall we three meet again?\n" * 100
+
+    # Not for clients which don't ask for it
+    f = urlopen(url)
+    assert "Content-Encoding" not in f.headers, f.headers
+    assert f.headers["Vary"] == "Accept-Encoding", f.headers
+    assert f.read() == "When shall we three meet again?\n" * 100
+
 
 def test_args1():
     body = GET("test_args", dict(a="Andrew"))